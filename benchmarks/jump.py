@@ -0,0 +1,445 @@
+import resource
+
+import numpy
+from astropy.convolution import convolve
+
+from stcal.jump.jump import (
+    detect_jumps,
+    find_faint_extended,
+    find_shower_events,
+    flag_events,
+    flag_large_events,
+    nan_convolve,
+    ring_kernel,
+)
+from stcal.jump.streaming import StreamingJumpDetector
+from stcal.jump.twopoint_difference import calc_med_first_diffs, cr_candidates, find_crs, find_crs_sweep
+
+DQFLAGS = {"JUMP_DET": 4, "SATURATED": 2, "DO_NOT_USE": 1}
+
+
+def make_ramps(dataset, ngroups, nrows, ncols, seed=0):
+    """
+    Simulated ramps in electrons, with read noise of 10 electrons.
+
+    dataset is 'dark' (no flux), 'bright' (sources up to saturation) or
+    'cosmic_rays' (a jump in 1% of the groups).
+    """
+    rng = numpy.random.default_rng(seed)
+    flux = numpy.zeros((1, 1, nrows, ncols))
+    if dataset == "bright":
+        flux = rng.exponential(200, size=(1, 1, nrows, ncols))
+    diffs = flux + rng.normal(size=(1, ngroups, nrows, ncols)) * 10
+    if dataset == "cosmic_rays":
+        diffs += (rng.random(diffs.shape) < 0.01) * rng.uniform(50, 5000, diffs.shape)
+    data = numpy.cumsum(diffs, axis=1).astype(numpy.float32)
+    gdq = numpy.zeros(data.shape, dtype=numpy.uint32)
+    gdq[data > 60000] = DQFLAGS["SATURATED"]
+    readnoise = numpy.full((nrows, ncols), 10, dtype=numpy.float32)
+    return data, gdq, readnoise
+
+
+def run_find_crs(data, gdq, readnoise, precision, prefilter=True):
+    return find_crs(data, gdq, readnoise, 4.0, 5.0, 6.0, 1, True, 200, 10, DQFLAGS,
+                    precision=precision, prefilter=prefilter)[0]
+
+
+class MedianFirstDiffs:
+    """
+    Clipped median of the first differences of one integration, for
+    realistic numbers of groups on a 1024x1032 frame.
+    """
+    params = ([5, 10, 50, 100, 200], [0.0, 0.05])
+    param_names = ["ngroups", "unusable_fraction"]
+
+    def setup(self, ngroups, unusable_fraction):
+        nrows, ncols = 1024, 1032
+        rng = numpy.random.default_rng(0)
+        self.first_diffs = (rng.normal(size=(ngroups - 1, nrows, ncols)) * 10 + 100).astype(numpy.float32)
+        self.first_diffs[rng.random(self.first_diffs.shape) < unusable_fraction] = numpy.nan
+        self.median_diffs = numpy.empty((nrows, ncols))
+
+    def time_calc_med_first_diffs(self, ngroups, unusable_fraction):
+        calc_med_first_diffs(self.first_diffs, out=self.median_diffs)
+
+
+class RingConvolve:
+    """
+    NaN-aware convolution of one 1024x1032 ratio frame with the ring kernel
+    of the shower detection.
+    """
+    params = (["filter2d", "astropy"], [0.0, 0.01])
+    param_names = ["convolve_method", "nan_fraction"]
+
+    def setup(self, convolve_method, nan_fraction):
+        rng = numpy.random.default_rng(0)
+        self.ratio = numpy.abs(rng.normal(size=(1024, 1032)))
+        self.ratio[rng.random(self.ratio.shape) < nan_fraction] = numpy.nan
+        self.kernel = ring_kernel(1, 2)
+
+    def time_ring_convolve(self, convolve_method, nan_fraction):
+        if convolve_method == "filter2d":
+            nan_convolve(self.ratio, self.kernel.array)
+        else:
+            convolve(self.ratio, self.kernel)
+
+
+class FindFaintExtended:
+    """
+    Shower detection on a MIRI-sized 1024x1032 integration with 60 groups.
+    """
+    params = ["filter2d", "astropy"]
+    param_names = ["convolve_method"]
+    timeout = 300
+
+    def setup(self, convolve_method):
+        ngroups, nrows, ncols = 60, 1024, 1032
+        rng = numpy.random.default_rng(0)
+        diffs = rng.normal(size=(1, ngroups, nrows, ncols)).astype(numpy.float32) * 10
+        # a faint shower in the middle of the integration
+        yy, xx = numpy.mgrid[:nrows, :ncols]
+        diffs[0, ngroups // 2:, (yy - 500) ** 2 + (xx - 500) ** 2 < 40 ** 2] += 15
+        self.data = numpy.cumsum(diffs, axis=1)
+        self.gdq = numpy.zeros(self.data.shape, dtype=numpy.uint8)
+        # cosmic rays already flagged as jumps are masked in the ratio
+        self.gdq[rng.random(self.gdq.shape) < 0.001] = 4
+        self.readnoise = numpy.full((nrows, ncols), 10, dtype=numpy.float32)
+
+    def time_find_faint_extended(self, convolve_method):
+        find_faint_extended(self.data, self.gdq.copy(), self.readnoise, 1,
+                            convolve_method=convolve_method)
+
+
+class ReflagShowers(FindFaintExtended):
+    """
+    Flagging the catalog of showers of FindFaintExtended with new expansion
+    parameters, without detecting them again.
+    """
+    params = [1.1, 1.5]
+    param_names = ["ellipse_expand"]
+
+    def setup(self, ellipse_expand):
+        super().setup("filter2d")
+        # a low threshold, so that the faint shower is found
+        self.events = find_shower_events(self.data, self.gdq, self.readnoise, 1, snr_threshold=1.1)
+
+    def time_flag_events(self, ellipse_expand):
+        flag_events(self.gdq.copy(), self.events, 2, 4, ellipse_expand=ellipse_expand)
+
+
+class FindCrsPrecision:
+    """
+    Two-point difference jump detection on one 1024x1032 integration in
+    double and single precision.
+    """
+    params = (["float64", "float32"], [10, 50])
+    param_names = ["precision", "ngroups"]
+    timeout = 300
+
+    def setup(self, precision, ngroups):
+        self.data, self.gdq, self.readnoise = make_ramps("cosmic_rays", ngroups, 1024, 1032)
+
+    def time_find_crs(self, precision, ngroups):
+        run_find_crs(self.data, self.gdq, self.readnoise, precision)
+
+    def peakmem_find_crs(self, precision, ngroups):
+        run_find_crs(self.data, self.gdq, self.readnoise, precision)
+
+
+class FindCrsPrecisionFlags:
+    """
+    Validation of the single precision mode of find_crs: the number of group
+    dq values that differ from the double precision results on each dataset.
+    """
+    params = ["dark", "bright", "cosmic_rays"]
+    param_names = ["dataset"]
+    unit = "flags"
+    timeout = 300
+
+    def setup(self, dataset):
+        self.data, self.gdq, self.readnoise = make_ramps(dataset, 20, 512, 512)
+
+    def track_flag_differences(self, dataset):
+        gdq64 = run_find_crs(self.data, self.gdq, self.readnoise, "float64")
+        gdq32 = run_find_crs(self.data, self.gdq, self.readnoise, "float32")
+        return int(numpy.sum(gdq64 != gdq32))
+
+
+class FindCrsPrefilter:
+    """
+    Two-point difference jump detection on one 1024x1032 integration with
+    and without the prefilter of the pixels that can't have a jump.
+    """
+    params = (["dark", "bright", "cosmic_rays"], [10, 50], [True, False])
+    param_names = ["dataset", "ngroups", "prefilter"]
+    timeout = 300
+
+    def setup(self, dataset, ngroups, prefilter):
+        self.data, self.gdq, self.readnoise = make_ramps(dataset, ngroups, 1024, 1032)
+
+    def time_find_crs(self, dataset, ngroups, prefilter):
+        run_find_crs(self.data, self.gdq, self.readnoise, "float64", prefilter)
+
+
+class PrefilterPrunedFraction:
+    """
+    Fraction of the pixels pruned by the prefilter of find_crs.
+    """
+    params = (["dark", "bright", "cosmic_rays"], [5, 10, 50, 100])
+    param_names = ["dataset", "ngroups"]
+    unit = "fraction"
+
+    def setup(self, dataset, ngroups):
+        data, gdq, readnoise = make_ramps(dataset, ngroups, 256, 256)
+        data[gdq == DQFLAGS["SATURATED"]] = numpy.nan
+        self.first_diffs = numpy.diff(data[0], axis=0)
+        self.read_noise_frame = readnoise.astype(numpy.float64) ** 2
+
+    def track_pruned_fraction(self, dataset, ngroups):
+        return 1 - float(numpy.mean(cr_candidates(self.first_diffs, self.read_noise_frame, 4.0)))
+
+
+class FindCrsSweep:
+    """
+    Jump detection on one 1024x1032 integration with cosmic rays for eight
+    settings of the thresholds, one call of find_crs for each setting or one
+    sweep returning the flags or only the numbers of CRs.
+    """
+    params = ["find_crs", "sweep_flags", "sweep_counts"]
+    param_names = ["method"]
+    timeout = 300
+
+    def setup(self, method):
+        self.data, self.gdq, self.readnoise = make_ramps("cosmic_rays", 10, 1024, 1032)
+        self.settings = [
+            {"rejection_thresh": thresh, "two_diff_rej_thresh": thresh + 1,
+             "three_diff_rej_thresh": thresh + 2, "max_jump_to_flag_neighbors": 200,
+             "min_jump_to_flag_neighbors": 10}
+            for thresh in numpy.linspace(3, 6.5, 8)]
+
+    def time_threshold_sweep(self, method):
+        if method == "find_crs":
+            for setting in self.settings:
+                find_crs(self.data, self.gdq, self.readnoise, nframes=1, flag_4_neighbors=True,
+                         dqflags=DQFLAGS, **setting)
+        else:
+            find_crs_sweep(self.data, self.gdq, self.readnoise, self.settings, 1, True, DQFLAGS,
+                           return_flags=method == "sweep_flags")
+
+
+class StreamingPush:
+    """
+    Streaming jump detection of one 1024x1032 group pushed after a window
+    of differences.
+    """
+    params = [4, 8, 16]
+    param_names = ["window"]
+    timeout = 300
+
+    def setup(self, window):
+        self.data, self.gdq, self.readnoise = make_ramps("cosmic_rays", window + 2, 1024, 1032)
+        self.detector = StreamingJumpDetector(self.readnoise, 4.0, 5.0, 6.0, 1, True, 200, 10,
+                                              DQFLAGS, window=window)
+        for group in range(window + 1):
+            self.detector.push(self.data[0, group], self.gdq[0, group])
+
+    def time_push(self, window):
+        self.detector.push(self.data[0, -1], self.gdq[0, -1])
+
+
+# Production-scale exposures: (nints, ngroups, nrows, ncols)
+EXPOSURES = {
+    "nir_full_frame": (1, 10, 2048, 2048),
+    "miri_full_frame": (1, 40, 1024, 1032),
+    "tso_subarray": (50, 10, 64, 2048),
+}
+GAIN = 2.0
+READNOISE = 7.0
+JUMP_DQFLAGS = {**DQFLAGS, "GOOD": 0, "NO_GAIN_VALUE": 8}
+
+
+def make_exposure(exposure, cr_fraction=0.001, n_snowballs=0, n_showers=0, seed=0):
+    """
+    Simulated exposure in DN, with the group DQ flags of the saturation step.
+
+    A fraction `cr_fraction` of the groups of each pixel have a cosmic ray.
+    Each integration has `n_snowballs` snowballs, large jumps with a
+    saturated core, and `n_showers` faint showers, extended jumps in one
+    group, at random positions and groups.
+    """
+    nints, ngroups, nrows, ncols = EXPOSURES[exposure]
+    rng = numpy.random.default_rng(seed)
+    rate = rng.exponential(20, size=(nrows, ncols)).astype(numpy.float32)
+    # the read noise is the noise of a difference, with the Poisson noise
+    noise = numpy.sqrt(READNOISE ** 2 + rate / GAIN)
+    data = numpy.empty((nints, ngroups, nrows, ncols), dtype=numpy.float32)
+    for integ in range(nints):
+        diffs = rng.standard_normal((ngroups, nrows, ncols), dtype=numpy.float32)
+        diffs *= noise
+        diffs += rate
+        crs = rng.random((ngroups, nrows, ncols), dtype=numpy.float32) < cr_fraction
+        diffs[crs] += rng.uniform(20, 2000, numpy.count_nonzero(crs)).astype(numpy.float32)
+        for radius, amplitude, count in [(15, 30000, n_snowballs), (40, 25, n_showers)]:
+            for _ in range(count):
+                group = rng.integers(1, ngroups)
+                row, col = rng.integers(0, nrows), rng.integers(0, ncols)
+                rows = slice(max(0, row - radius), min(nrows, row + radius + 1))
+                cols = slice(max(0, col - radius), min(ncols, col + radius + 1))
+                yy, xx = numpy.ogrid[rows, cols]
+                dist2 = (yy - row) ** 2 + (xx - col) ** 2
+                # a disk with a core that saturates for the snowballs
+                diffs[group, rows, cols] += amplitude * (dist2 < radius ** 2)
+                diffs[group, rows, cols] += 3 * amplitude * (dist2 < (radius // 3) ** 2)
+        numpy.cumsum(diffs, axis=0, out=data[integ])
+    gdq = numpy.zeros(data.shape, dtype=numpy.uint8)
+    saturated = data > 60000
+    gdq[numpy.maximum.accumulate(saturated, axis=1)] = DQFLAGS["SATURATED"]
+    gain = numpy.full((nrows, ncols), GAIN, dtype=numpy.float32)
+    readnoise = numpy.full((nrows, ncols), READNOISE, dtype=numpy.float32)
+    return data, gdq, gain, readnoise
+
+
+class DetectJumps:
+    """
+    The jump step on production-scale exposures, with the snowball flagging
+    of the NIR detectors or the shower flagging of MIRI.
+    """
+    params = (list(EXPOSURES), ["none", "half", "all"])
+    param_names = ["exposure", "max_cores"]
+    timeout = 1200
+    number = 1
+    repeat = 1
+
+    def setup(self, exposure, max_cores):
+        self.data, self.gdq, self.gain, self.readnoise = make_exposure(
+            exposure, n_snowballs=5, n_showers=2 if exposure == "miri_full_frame" else 0)
+        self.pdq = numpy.zeros(self.data.shape[2:], dtype=numpy.uint32)
+        self.err = numpy.zeros(self.data.shape, dtype=numpy.float32)
+        self.miri = exposure == "miri_full_frame"
+
+    def run(self, max_cores):
+        detect_jumps(1, self.data, self.gdq, self.pdq, self.err, self.gain, self.readnoise,
+                     4.0, 5.0, 6.0, max_cores, 200, 10, True, JUMP_DQFLAGS,
+                     after_jump_flag_dn1=500, after_jump_flag_n1=2,
+                     expand_large_events=not self.miri, find_showers=self.miri)
+
+    def time_detect_jumps(self, exposure, max_cores):
+        self.run(max_cores)
+
+    def peakmem_detect_jumps(self, exposure, max_cores):
+        self.run(max_cores)
+
+
+class DetectJumpsSharedMemory:
+    """
+    The two-point difference method of the jump step with half of the cores,
+    with the tiles of the exposure pickled to the workers or shared with
+    them. The peak RSS of the workers is tracked separately from that of the
+    benchmark process.
+    """
+    params = (["nir_full_frame", "tso_subarray"], [False, True])
+    param_names = ["exposure", "use_shared_memory"]
+    timeout = 1200
+    number = 1
+    repeat = 1
+
+    def setup(self, exposure, use_shared_memory):
+        self.data, self.gdq, self.gain, self.readnoise = make_exposure(exposure)
+        self.pdq = numpy.zeros(self.data.shape[2:], dtype=numpy.uint32)
+        self.err = numpy.zeros(self.data.shape, dtype=numpy.float32)
+
+    def run(self, use_shared_memory):
+        # the group dq is updated in place with shared memory
+        detect_jumps(1, self.data, self.gdq.copy(), self.pdq, self.err, self.gain,
+                     self.readnoise, 4.0, 5.0, 6.0, "half", 200, 10, True, JUMP_DQFLAGS,
+                     after_jump_flag_dn1=500, after_jump_flag_n1=2,
+                     use_shared_memory=use_shared_memory)
+
+    def time_detect_jumps(self, exposure, use_shared_memory):
+        self.run(use_shared_memory)
+
+    def peakmem_detect_jumps(self, exposure, use_shared_memory):
+        self.run(use_shared_memory)
+
+    def track_worker_peakmem(self, exposure, use_shared_memory):
+        self.run(use_shared_memory)
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    track_worker_peakmem.unit = "bytes"
+
+
+class FindCrs:
+    """
+    Two-point difference jump detection on production-scale exposures with
+    increasing densities of cosmic rays.
+    """
+    params = (list(EXPOSURES), [0.0, 0.001, 0.01])
+    param_names = ["exposure", "cr_fraction"]
+    timeout = 1200
+    number = 1
+    repeat = 1
+
+    def setup(self, exposure, cr_fraction):
+        data, self.gdq, gain, readnoise = make_exposure(exposure, cr_fraction=cr_fraction)
+        self.data = data * GAIN
+        self.readnoise = readnoise * GAIN
+
+    def time_find_crs(self, exposure, cr_fraction):
+        run_find_crs(self.data, self.gdq, self.readnoise, "float64")
+
+    def peakmem_find_crs(self, exposure, cr_fraction):
+        run_find_crs(self.data, self.gdq, self.readnoise, "float64")
+
+
+class FlagLargeEvents:
+    """
+    Snowball flagging on the group DQ flags of the NIR exposures, with
+    increasing numbers of snowballs in each integration.
+    """
+    params = (["nir_full_frame", "tso_subarray"], [0, 10, 100])
+    param_names = ["exposure", "n_snowballs"]
+    timeout = 1200
+    number = 1
+    repeat = 1
+
+    def setup(self, exposure, n_snowballs):
+        data, gdq, gain, readnoise = make_exposure(exposure, n_snowballs=n_snowballs)
+        self.gdq = run_find_crs(data * GAIN, gdq, readnoise * GAIN, "float64")
+
+    def time_flag_large_events(self, exposure, n_snowballs):
+        flag_large_events(self.gdq.copy(), DQFLAGS["JUMP_DET"], DQFLAGS["SATURATED"],
+                          min_jump_area=15, min_sat_area=1, expand_factor=2.0,
+                          sat_required_snowball=True, min_sat_radius_extend=2.5)
+
+    def peakmem_flag_large_events(self, exposure, n_snowballs):
+        flag_large_events(self.gdq.copy(), DQFLAGS["JUMP_DET"], DQFLAGS["SATURATED"],
+                          min_jump_area=15, min_sat_area=1, expand_factor=2.0,
+                          sat_required_snowball=True, min_sat_radius_extend=2.5)
+
+
+class FindFaintExtendedMiri:
+    """
+    Shower flagging on a production-scale MIRI exposure, with increasing
+    numbers of showers in each integration.
+    """
+    params = [0, 2, 10]
+    param_names = ["n_showers"]
+    timeout = 1200
+    number = 1
+    repeat = 1
+
+    def setup(self, n_showers):
+        self.data, gdq, self.gain, self.readnoise = make_exposure("miri_full_frame",
+                                                                  n_showers=n_showers)
+        self.gdq = run_find_crs(self.data * GAIN, gdq, self.readnoise * GAIN, "float64")
+
+    def run(self):
+        find_faint_extended(self.data, self.gdq.copy(), self.readnoise, 1, snr_threshold=1.2,
+                            min_shower_area=90, inner=1, outer=2.6, ellipse_expand=1.2,
+                            num_grps_masked=5, gain_2d=self.gain)
+
+    def time_find_faint_extended(self, n_showers):
+        self.run()
+
+    def peakmem_find_faint_extended(self, n_showers):
+        self.run()
@@ -1,5 +1,6 @@
 import numpy
 
+from stcal.ramp_fitting.ols_fit import calc_opt_sums
 from stcal.ramp_fitting.ramp_fit import ramp_fit_data
 from stcal.ramp_fitting.ramp_fit_class import RampData
 
@@ -656,3 +657,66 @@ def time_dq_multi_int_dnu():
     ramp_fit_data(
         ramp, bufsize, save_opt, rnoise, gain, algo, "optimal", ncores, dqflags
     )
+
+
+class OLSEngine:
+    """
+    Ramp fitting of a section of noisy ramps by each OLS engine, with jumps
+    and saturation in most ramps or in a few of them.
+    """
+
+    params = (["iterative", "table"], ["flagged", "mostly_clean"])
+    param_names = ["ols_engine", "ramps"]
+
+    def setup(self, ols_engine, ramps):
+        nints, ngroups, nrows, ncols = 1, 10, 256, 256
+        self.ramp_data, self.gain, self.rnoise = create_blank_ramp_data(
+            (nints, ngroups, nrows, ncols), (10.0, 2.0), (10.736, 1, 0))
+        rng = numpy.random.default_rng(0)
+        rate = rng.exponential(50.0, (nrows, ncols))
+        diffs = rate + rng.normal(scale=10.0, size=self.ramp_data.data.shape)
+        self.data = numpy.cumsum(diffs, axis=1).astype(numpy.float32)
+        gdq = self.ramp_data.groupdq
+        jump_fraction, sat_fraction = (0.03, 1.0) if ramps == "flagged" else (0.002, 0.02)
+        gdq[rng.random(gdq.shape) < jump_fraction] = JUMP
+        sat_start = rng.integers(1, ngroups + 3, (nints, 1, nrows, ncols))
+        saturates = rng.random((nints, 1, nrows, ncols)) < sat_fraction
+        sat_groups = numpy.arange(ngroups)[numpy.newaxis, :, numpy.newaxis, numpy.newaxis] >= sat_start
+        gdq[sat_groups & saturates] |= SAT
+        self.gdq = gdq.copy()
+
+    def time_ramp_fit_data(self, ols_engine, ramps):
+        # ramp fitting changes the data, group DQ and read noise in place
+        self.ramp_data.data = self.data.copy()
+        self.ramp_data.groupdq = self.gdq.copy()
+        ramp_fit_data(
+            self.ramp_data, 512, False, self.rnoise.copy(), self.gain, "OLS", "optimal", "none",
+            dqflags, ols_engine=ols_engine
+        )
+
+
+class OptSums:
+    """
+    Optimally weighted sums of a section of unflagged ramps, with the
+    tabulated weights for 10 groups and computed weights for many groups.
+    """
+
+    params = [10, 300]
+    param_names = ["ngroups"]
+
+    def setup(self, ngroups):
+        nrows, ncols = 64, 1024
+        rng = numpy.random.default_rng(0)
+        rate = rng.exponential(50.0, nrows * ncols)
+        diffs = rate + rng.normal(scale=10.0, size=(ngroups, nrows * ncols))
+        self.data = numpy.cumsum(diffs, axis=0).astype(numpy.float32)
+        self.mask = numpy.ones(self.data.shape, dtype=bool)
+        self.xvalues = numpy.tile(numpy.arange(ngroups)[:, numpy.newaxis], (1, nrows * ncols))
+        self.rnoise = numpy.full((nrows, ncols), 10.0, dtype=numpy.float32)
+        self.gain = numpy.full((nrows, ncols), 2.0, dtype=numpy.float32)
+        self.good_pix = numpy.arange(nrows * ncols)
+
+    def time_calc_opt_sums(self, ngroups):
+        # the sums change the data, mask and xvalues in place
+        calc_opt_sums(self.rnoise, self.gain, self.data.copy(), self.mask.copy(),
+                      self.xvalues.copy(), self.good_pix)
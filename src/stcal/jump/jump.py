@@ -1,5 +1,9 @@
+import functools
+import itertools
 import logging
 import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory
 import time
 
 import numpy as np
@@ -7,6 +11,7 @@ import cv2 as cv
 
 from astropy.convolution import Ring2DKernel
 from astropy.convolution import convolve
+from scipy.spatial import KDTree
 
 from . import constants
 from . import twopoint_difference as twopt
@@ -14,6 +19,12 @@ from . import twopoint_difference as twopt
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+# The catalog of large events: the ellipse of each snowball, saturated core
+# or shower, as returned by cv.minAreaRect, and the group where it was found
+EVENT_DTYPE = np.dtype([('integration', np.int32), ('group', np.int32),
+                        ('center', np.float64, (2,)), ('axes', np.float64, (2,)),
+                        ('angle', np.float64), ('kind', 'U10')])
+
 
 def detect_jumps(frames_per_group, data, gdq, pdq, err,
                  gain_2d, readnoise_2d, rejection_thresh,
@@ -34,7 +45,10 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
                  edge_size=25, extend_snr_threshold=1.2, extend_min_area=90,
                  extend_inner_radius=1, extend_outer_radius=2.6,
                  extend_ellipse_expand_ratio=1.2, grps_masked_after_shower=5,
-                 max_extended_radius=200):
+                 max_extended_radius=200, use_shared_memory=False,
+                 parallel_split='auto', large_event_workers='thread',
+                 precision='float64', tile_shape=None,
+                 extend_convolve_method='astropy'):
 
     """
     This is the high-level controlling routine for the jump detection process.
@@ -43,15 +57,14 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
     turn.
 
     Note that the detection methods are currently set up on the assumption
-    that the input science and error data arrays will be in units of
-    electrons, hence this routine scales those input arrays by the detector
-    gain. The methods assume that the read noise values will be in units
-    of DN.
+    that the input science data and read noise arrays will be in units of
+    electrons. The input arrays are in units of DN, and the detection methods
+    scale them by the detector gain one integration or slice at a time, so
+    the input arrays are not modified.
 
-    The gain is applied to the science data and error arrays using the
+    The gain is applied to the science data and read noise arrays using the
     appropriate instrument- and detector-dependent values for each pixel of an
-    image.  Also, a 2-dimensional read noise array with appropriate values for
-    each pixel is passed to the detection methods.
+    image.
 
     Parameters
     ----------
@@ -68,7 +81,7 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
         pixelg dq array
 
     err : float, 4D array
-        error array
+        error array, not used
 
     gain_2d : float, 2D array
         gain for all pixels
@@ -187,6 +200,38 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
         The minimum radius of the saturated core of a snowball for the core to
         be extended
 
+    use_shared_memory : bool
+        When multiprocessing, place the data, group dq and read noise arrays
+        in shared memory that the worker processes update in place, instead of
+        pickling slices of them to and from each process. The input group dq
+        array is then updated in place.
+
+    parallel_split : str
+        How the data is split when multiprocessing: 'rows' splits each
+        integration into slices of rows, 'integrations' splits the
+        integrations into groups, 'tiles' splits each integration into
+        tiles of rows and columns, and 'auto' (default) splits the
+        integrations into groups and their frames into tiles from the
+        numbers of integrations and slices.
+
+    large_event_workers : str
+        Type of the workers used for the flagging of snowballs and showers
+        when multiprocessing, 'thread' (default) or 'process'.
+
+    precision : str
+        Floating point precision of the temporary arrays of the two-point
+        difference method, 'float64' (default) or 'float32'.
+
+    tile_shape : tuple of int
+        (rows, columns) of the tiles when multiprocessing with 'tiles' or
+        'auto' parallel_split. By default, the frames are split into as many
+        tiles as there are slices for each group of integrations, with
+        shapes as close to square as possible.
+
+    extend_convolve_method : str
+        Convolution of the SNR ratio in the detection of MIRI showers,
+        'astropy' (default) or the faster 'filter2d'. See find_faint_extended.
+
     Returns
     -------
     gdq : int, 4D array
@@ -209,12 +254,10 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
         pdq[wh_g] = np.bitwise_or(pdq[wh_g], dqflags["NO_GAIN_VALUE"])
         pdq[wh_g] = np.bitwise_or(pdq[wh_g], dqflags["DO_NOT_USE"])
 
-    # Apply gain to the SCI, ERR, and readnoise arrays so they're in units
-    # of electrons
-    data *= gain_2d
-    err *= gain_2d
-    readnoise_2d *= gain_2d
-    # also apply to the after_jump thresholds
+    # The gain is applied to the SCI and readnoise arrays by the detection
+    # methods, one integration or slice at a time, so they're in units of
+    # electrons without modifying the input arrays. ERR is not used.
+    # Apply the gain to the after_jump thresholds
     after_jump_flag_e1 = after_jump_flag_dn1 * gain_2d
     after_jump_flag_e2 = after_jump_flag_dn2 * gain_2d
 
@@ -225,14 +268,8 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
     # Set parameters of input data shape
     n_rows = data.shape[-2]
     n_cols = data.shape[-1]
-    n_groups = data.shape[1]
     n_ints = data.shape[0]
 
-    row_above_gdq = np.zeros((n_ints, n_groups, n_cols), dtype=np.uint8)
-    previous_row_above_gdq = np.zeros((n_ints, n_groups, n_cols),
-                                      dtype=np.uint8)
-    row_below_gdq = np.zeros((n_ints, n_groups, n_cols), dtype=np.uint8)
-
     # figure out how many slices to make based on 'max_cores'
 
     max_available = multiprocessing.cpu_count()
@@ -254,147 +291,408 @@ def detect_jumps(frames_per_group, data, gdq, pdq, err,
                            after_jump_flag_e1=after_jump_flag_e1,
                            after_jump_flag_n1=after_jump_flag_n1,
                            after_jump_flag_e2=after_jump_flag_e2,
-                           after_jump_flag_n2=after_jump_flag_n2)
-
-        #  This is the flag that controls the flagging of either snowballs.
-        if expand_large_events:
-            flag_large_events(gdq, jump_flag, sat_flag, min_sat_area=min_sat_area,
-                              min_jump_area=min_jump_area,
-                              expand_factor=expand_factor,
-                              sat_required_snowball=sat_required_snowball,
-                              min_sat_radius_extend=min_sat_radius_extend,
-                              edge_size=edge_size, sat_expand=sat_expand,
-                              max_extended_radius=max_extended_radius)
-        if find_showers:
-            gdq, num_showers = find_faint_extended(data, gdq, readnoise_2d,
-                                                   frames_per_group,
-                                                   snr_threshold=extend_snr_threshold,
-                                                   min_shower_area=extend_min_area,
-                                                   inner=extend_inner_radius,
-                                                   outer=extend_outer_radius,
-                                                   sat_flag=sat_flag, jump_flag=jump_flag,
-                                                   ellipse_expand=extend_ellipse_expand_ratio,
-                                                   num_grps_masked=grps_masked_after_shower,
-                                                   max_extended_radius=max_extended_radius)
+                           after_jump_flag_n2=after_jump_flag_n2,
+                           precision=precision, gain_2d=gain_2d)
     else:
-        yinc = int(n_rows / n_slices)
-        slices = []
-        # Slice up data, gdq, readnoise_2d into slices
-        # Each element of slices is a tuple of
-        # (data, gdq, readnoise_2d, rejection_thresh, three_grp_thresh,
-        #  four_grp_thresh, nframes)
-
-        # must copy arrays here, find_crs will make copies but if slices
-        # are being passed in for multiprocessing then the original gdq will be
-        # modified unless copied beforehand
-        gdq = gdq.copy()
-        data = data.copy()
-        copy_arrs = False  # we dont need to copy arrays again in find_crs
-
-        for i in range(n_slices - 1):
-            slices.insert(i, (data[:, :, i * yinc:(i + 1) * yinc, :],
-                              gdq[:, :, i * yinc:(i + 1) * yinc, :],
-                              readnoise_2d[i * yinc:(i + 1) * yinc, :],
-                              rejection_thresh, three_grp_thresh, four_grp_thresh,
-                              frames_per_group, flag_4_neighbors,
-                              max_jump_to_flag_neighbors,
-                              min_jump_to_flag_neighbors, dqflags,
-                              after_jump_flag_e1, after_jump_flag_n1,
-                              after_jump_flag_e2, after_jump_flag_n2,
-                              copy_arrs))
-
-        # last slice get the rest
-        slices.insert(n_slices - 1, (data[:, :, (n_slices - 1) *
-                                     yinc:n_rows, :],
-                                     gdq[:, :, (n_slices - 1) *
-                                     yinc:n_rows, :],
-                                     readnoise_2d[(n_slices - 1) *
-                                     yinc:n_rows, :],
-                                     rejection_thresh, three_grp_thresh,
-                                     four_grp_thresh, frames_per_group,
-                                     flag_4_neighbors,
-                                     max_jump_to_flag_neighbors,
-                                     min_jump_to_flag_neighbors, dqflags,
-                                     after_jump_flag_e1, after_jump_flag_n1,
-                                     after_jump_flag_e2, after_jump_flag_n2,
-                                     copy_arrs))
-        log.info("Creating %d processes for jump detection " % n_slices)
-        pool = multiprocessing.Pool(processes=n_slices)
-        # Starts each slice in its own process. Starmap allows more than one
-        # parameter to be passed.
-        real_result = pool.starmap(twopt.find_crs, slices)
-        pool.close()
-        pool.join()
-        k = 0
-
-        # Reconstruct gdq, the row_above_gdq, and the row_below_gdq from the
-        # slice result
-        for resultslice in real_result:
-
-            if len(real_result) == k + 1:  # last result
-                gdq[:, :, k * yinc:n_rows, :] = resultslice[0]
-            else:
-                gdq[:, :, k * yinc:(k + 1) * yinc, :] = resultslice[0]
-            row_below_gdq[:, :, :] = resultslice[1]
-            row_above_gdq[:, :, :] = resultslice[2]
-            if k != 0:
-                # For all but the first slice, flag any CR neighbors in the top
-                # row of the previous slice and flag any neighbors in the
-                # bottom row of this slice saved from the top of the previous
-                # slice
-                gdq[:, :, k * yinc - 1, :] = \
-                    np.bitwise_or(gdq[:, :, k * yinc - 1, :],
-                                  row_below_gdq[:, :, :])
-                gdq[:, :, k * yinc, :] = \
-                    np.bitwise_or(gdq[:, :, k * yinc, :],
-                                  previous_row_above_gdq[:, :, :])
-
-            # save the neighbors to be flagged that will be in the next slice
-            previous_row_above_gdq = row_above_gdq.copy()
-            k += 1
-
-        #  This is the flag that controls the flagging of either
-        #  snowballs or showers.
-        if expand_large_events:
-            flag_large_events(gdq, jump_flag, sat_flag,
-                              min_sat_area=min_sat_area,
-                              min_jump_area=min_jump_area,
-                              expand_factor=expand_factor,
-                              sat_required_snowball=sat_required_snowball,
-                              min_sat_radius_extend=min_sat_radius_extend,
-                              edge_size=edge_size, sat_expand=sat_expand,
-                              max_extended_radius=max_extended_radius)
-        if find_showers:
-            gdq, num_showers = \
-                find_faint_extended(data, gdq, readnoise_2d,
-                                    frames_per_group,
-                                    snr_threshold=extend_snr_threshold,
-                                    min_shower_area=extend_min_area,
-                                    inner=extend_inner_radius,
-                                    outer=extend_outer_radius,
-                                    sat_flag=sat_flag,
-                                    jump_flag=jump_flag,
-                                    ellipse_expand=extend_ellipse_expand_ratio,
-                                    num_grps_masked=grps_masked_after_shower,
-                                    max_extended_radius=max_extended_radius)
+        # Split the data into tiles of integrations, rows and columns. Each
+        # tile is processed with a halo of one pixel on all four sides, so the
+        # neighbors of jumps just outside the tile are flagged inside it, and
+        # only the interior of the tile is kept.
+        jump_tiles = plan_jump_tiles(n_ints, n_rows, n_cols, n_slices,
+                                     parallel_split, tile_shape)
+        n_processes = min(len(jump_tiles), n_slices)
+        crs_args = (rejection_thresh, three_grp_thresh, four_grp_thresh,
+                    frames_per_group, flag_4_neighbors,
+                    max_jump_to_flag_neighbors, min_jump_to_flag_neighbors,
+                    dqflags)
+
+        if use_shared_memory:
+            # The workers attach to shared memory copies of data, gdq and
+            # readnoise_2d and write the interior of their tile to a shared
+            # output gdq, so the halos always see the input flags.
+            log.info("Creating %d processes for jump detection "
+                     "using shared memory" % n_processes)
+            gdq = find_crs_shared_memory(
+                data, gdq, readnoise_2d, jump_tiles, n_processes, crs_args,
+                after_jump_flag_e1, after_jump_flag_n1,
+                after_jump_flag_e2, after_jump_flag_n2, precision, gain_2d)
+        else:
+            slices = []
+            # Slice up data, gdq, readnoise_2d into tiles with their halos.
+            # Each element of slices is a tuple of
+            # (data, gdq, readnoise_2d, rejection_thresh, three_grp_thresh,
+            #  four_grp_thresh, nframes)
+            # Applying the gain to each tile of the data and readnoise makes
+            # new arrays, and the gdq tiles are copies once pickled.
+            copy_arrs = False  # we dont need to copy arrays again in find_crs
+            tile_indices = [tile_slices(jump_tile, n_rows, n_cols) for jump_tile in jump_tiles]
+
+            for tile, halo, interior in tile_indices:
+                frame = halo[2:]
+                gain_tile = gain_2d[frame]
+                slices.append((twopt.apply_gain(data[halo], gain_tile),
+                               gdq[halo],
+                               twopt.apply_gain(readnoise_2d[frame], gain_tile),
+                               *crs_args,
+                               after_jump_flag_e1[frame],
+                               after_jump_flag_n1,
+                               after_jump_flag_e2[frame],
+                               after_jump_flag_n2,
+                               copy_arrs))
+
+            log.info("Creating %d processes for jump detection " % n_processes)
+            pool = multiprocessing.Pool(processes=n_processes)
+            # Starts each tile in its own process. Starmap allows more than one
+            # parameter to be passed.
+            real_result = pool.starmap(functools.partial(twopt.find_crs,
+                                                         precision=precision),
+                                       slices)
+            pool.close()
+            pool.join()
+
+            # Reconstruct gdq from the interior of each tile result
+            gdq = gdq.copy()
+            for (tile, halo, interior), resultslice in zip(tile_indices, real_result):
+                gdq[tile] = resultslice[0][interior]
+
+    #  This is the flag that controls the flagging of either
+    #  snowballs or showers.
+    if expand_large_events:
+        flag_large_events(gdq, jump_flag, sat_flag,
+                          min_sat_area=min_sat_area,
+                          min_jump_area=min_jump_area,
+                          expand_factor=expand_factor,
+                          sat_required_snowball=sat_required_snowball,
+                          min_sat_radius_extend=min_sat_radius_extend,
+                          edge_size=edge_size, sat_expand=sat_expand,
+                          max_extended_radius=max_extended_radius,
+                          n_workers=n_slices, worker_type=large_event_workers)
+    if find_showers:
+        gdq, num_showers = \
+            find_faint_extended(data, gdq, readnoise_2d,
+                                frames_per_group,
+                                snr_threshold=extend_snr_threshold,
+                                min_shower_area=extend_min_area,
+                                inner=extend_inner_radius,
+                                outer=extend_outer_radius,
+                                sat_flag=sat_flag,
+                                jump_flag=jump_flag,
+                                ellipse_expand=extend_ellipse_expand_ratio,
+                                num_grps_masked=grps_masked_after_shower,
+                                max_extended_radius=max_extended_radius,
+                                n_workers=n_slices, worker_type=large_event_workers,
+                                convolve_method=extend_convolve_method,
+                                gain_2d=gain_2d)
+
     elapsed = time.time() - start
     log.info('Total elapsed time = %g sec' % elapsed)
 
-    # Back out the applied gain to the SCI, ERR, and readnoise arrays so they're
-    #    back in units of DN
-    data /= gain_2d
-    err /= gain_2d
-    readnoise_2d /= gain_2d
-
     # Return the updated data quality arrays
     return gdq, pdq
 
 
+def plan_jump_slices(n_ints, n_rows, n_slices, parallel_split='auto'):
+    """
+    Split the data into slices of integrations and rows for multiprocessing.
+
+    With 'auto', the integrations are split first, since they are processed
+    independently, and the rows of each group of integrations are split into
+    the remaining number of slices. An exposure with a single integration is
+    split by rows only, and one with at least as many integrations as slices
+    is split by integrations only.
+
+    Parameters
+    ----------
+    n_ints : int
+        number of integrations
+    n_rows : int
+        number of rows
+    n_slices : int
+        maximum number of slices
+    parallel_split : str
+        'auto', 'rows' or 'integrations'
+
+    Returns
+    -------
+    jump_slices : list of tuples
+        (int_start, int_stop, row_start, row_stop) of each slice
+    """
+    if parallel_split == 'rows':
+        n_int_slices = 1
+    elif parallel_split in ('auto', 'integrations'):
+        n_int_slices = min(n_ints, n_slices)
+    else:
+        raise ValueError(f"Unknown parallel_split: {parallel_split}")
+
+    if parallel_split == 'integrations':
+        n_row_slices = 1
+    else:
+        n_row_slices = max(1, min(n_slices // n_int_slices, n_rows))
+
+    return [(int_start, int_stop, row_start, row_stop)
+            for int_start, int_stop in slice_ranges(n_ints, n_int_slices)
+            for row_start, row_stop in slice_ranges(n_rows, n_row_slices)]
+
+
+def slice_ranges(n, n_slices):
+    """
+    Split range(n) into n_slices contiguous (start, stop) ranges of equal
+    size, with the last range getting the rest.
+    """
+    inc = n // n_slices
+    ranges = [(i * inc, (i + 1) * inc) for i in range(n_slices - 1)]
+    ranges.append(((n_slices - 1) * inc, n))
+    return ranges
+
+
+def plan_jump_tiles(n_ints, n_rows, n_cols, n_slices, parallel_split='auto',
+                    tile_shape=None):
+    """
+    Split the data into tiles of integrations, rows and columns for
+    multiprocessing.
+
+    'rows' and 'integrations' split the data as plan_jump_slices, into tiles
+    spanning all columns. 'tiles' splits each integration into 2-D tiles, and
+    'auto' splits the integrations first, since they are processed
+    independently, and the frames of each group of integrations into 2-D
+    tiles for the remaining number of slices.
+
+    Parameters
+    ----------
+    n_ints : int
+        number of integrations
+    n_rows : int
+        number of rows
+    n_cols : int
+        number of columns
+    n_slices : int
+        number of slices
+    parallel_split : str
+        'auto', 'rows', 'integrations' or 'tiles'
+    tile_shape : tuple of int
+        (rows, columns) of the 2-D tiles, the last tiles along the rows and columns
+        may be smaller. By default, the frames are split into the number of
+        slices left for each group of integrations by tile_grid.
+
+    Returns
+    -------
+    jump_tiles : list of tuples
+        (int_start, int_stop, row_start, row_stop, col_start, col_stop) of
+        each tile
+    """
+    if parallel_split in ('rows', 'integrations'):
+        return [(int_start, int_stop, row_start, row_stop, 0, n_cols)
+                for int_start, int_stop, row_start, row_stop in
+                plan_jump_slices(n_ints, n_rows, n_slices, parallel_split)]
+    elif parallel_split == 'tiles':
+        n_int_slices = 1
+    elif parallel_split == 'auto':
+        n_int_slices = min(n_ints, n_slices)
+    else:
+        raise ValueError(f"Unknown parallel_split: {parallel_split}")
+
+    if tile_shape is None:
+        n_row_tiles, n_col_tiles = tile_grid(n_rows, n_cols, max(1, n_slices // n_int_slices))
+        row_ranges = slice_ranges(n_rows, n_row_tiles)
+        col_ranges = slice_ranges(n_cols, n_col_tiles)
+    else:
+        tile_rows, tile_cols = tile_shape
+        if tile_rows < 1 or tile_cols < 1:
+            raise ValueError(f"Invalid tile_shape: {tile_shape}")
+        row_ranges = [(start, min(start + tile_rows, n_rows)) for start in range(0, n_rows, tile_rows)]
+        col_ranges = [(start, min(start + tile_cols, n_cols)) for start in range(0, n_cols, tile_cols)]
+
+    return [(int_start, int_stop, row_start, row_stop, col_start, col_stop)
+            for int_start, int_stop in slice_ranges(n_ints, n_int_slices)
+            for row_start, row_stop in row_ranges
+            for col_start, col_stop in col_ranges]
+
+
+def tile_grid(n_rows, n_cols, n_tiles):
+    """
+    Numbers of rows and columns of tiles that split a frame into n_tiles
+    tiles with shapes as close to square as possible, so a subarray with few
+    rows is split by columns and a full frame into blocks.
+
+    Returns
+    -------
+    n_row_tiles, n_col_tiles : int
+        numbers of tiles along the rows and columns
+    """
+    n_tiles = min(n_tiles, n_rows * n_cols)
+    while True:
+        grids = [(n_row_tiles, n_tiles // n_row_tiles)
+                 for n_row_tiles in range(1, min(n_tiles, n_rows) + 1)
+                 if n_tiles % n_row_tiles == 0 and n_tiles // n_row_tiles <= n_cols]
+        if grids:
+            return min(grids, key=lambda grid: abs(np.log(n_rows * grid[1] / (n_cols * grid[0]))))
+        n_tiles -= 1
+
+
+def tile_slices(jump_tile, n_rows, n_cols):
+    """
+    Index the data with a tile and its halo of one pixel on each side within
+    the frame.
+
+    Parameters
+    ----------
+    jump_tile : tuple
+        (int_start, int_stop, row_start, row_stop, col_start, col_stop)
+    n_rows, n_cols : int
+        shape of the frames
+
+    Returns
+    -------
+    tile : tuple of slices
+        index of the tile in the 4D arrays
+    halo : tuple of slices
+        index of the tile and its halo in the 4D arrays, halo[2:] indexes
+        the 2D arrays
+    interior : tuple of slices
+        index of the tile in the 4D arrays indexed by halo
+    """
+    int_start, int_stop, row_start, row_stop, col_start, col_stop = jump_tile
+    halo_row_start, halo_col_start = max(row_start - 1, 0), max(col_start - 1, 0)
+    tile = (slice(int_start, int_stop), slice(None),
+            slice(row_start, row_stop), slice(col_start, col_stop))
+    halo = (slice(int_start, int_stop), slice(None),
+            slice(halo_row_start, min(row_stop + 1, n_rows)),
+            slice(halo_col_start, min(col_stop + 1, n_cols)))
+    interior = (slice(None), slice(None),
+                slice(row_start - halo_row_start, row_stop - halo_row_start),
+                slice(col_start - halo_col_start, col_stop - halo_col_start))
+    return tile, halo, interior
+
+
+def find_crs_shared_memory(data, gdq, readnoise_2d, jump_tiles, n_processes,
+                           crs_args, after_jump_flag_e1, after_jump_flag_n1,
+                           after_jump_flag_e2, after_jump_flag_n2,
+                           precision='float64', gain_2d=None):
+    """
+    Run the two-point difference method on tiles of the data in separate
+    processes that share the data, group dq and read noise arrays.
+
+    The arrays are copied once into shared memory blocks. Each worker attaches
+    to the blocks, runs find_crs on its tile and halo and writes the interior
+    of the tile to an output group dq block, so the cubes are never pickled
+    and the halos are not changed by the other workers. The output is then
+    written to `gdq` in place, without another copy of the cube.
+
+    Parameters
+    ----------
+    data : float, 4D array
+        science array, in units of electrons unless gain_2d is given
+    gdq : int, 4D array
+        group dq array, updated in place
+    readnoise_2d : float, 2D array
+        readnoise for all pixels, in units of electrons unless gain_2d is
+        given
+    jump_tiles : list of tuples
+        (int_start, int_stop, row_start, row_stop, col_start, col_stop) of
+        each tile
+    n_processes : int
+        number of worker processes
+    crs_args : tuple
+        (rejection_thresh, three_grp_thresh, four_grp_thresh, nframes,
+        flag_4_neighbors, max_jump_to_flag_neighbors,
+        min_jump_to_flag_neighbors, dqflags) passed to find_crs
+    after_jump_flag_e1, after_jump_flag_e2 : float, 2D array
+        jump amplitude thresholds for flagging subsequent groups
+    after_jump_flag_n1, after_jump_flag_n2 : int
+        number of groups to flag after jumps above the thresholds
+    precision : str
+        floating point precision of find_crs, 'float64' or 'float32'
+    gain_2d : float, 2D array
+        gain of each pixel, applied to the data and readnoise as they are
+        copied to shared memory
+
+    Returns
+    -------
+    gdq : int, 4D array
+        the input group dq array, updated
+    """
+    n_rows, n_cols = gdq.shape[-2:]
+    blocks = []
+    shared = {}
+    try:
+        for name, arr in (('data', data), ('gdq', gdq), ('readnoise', readnoise_2d),
+                          ('gdq_out', gdq)):
+            block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            blocks.append(block)
+            shared_arr = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+            if gain_2d is not None and name == 'data':
+                # one integration at a time, to avoid a temporary cube
+                for integration in range(arr.shape[0]):
+                    shared_arr[integration] = twopt.apply_gain(arr[integration], gain_2d)
+            elif gain_2d is not None and name == 'readnoise':
+                shared_arr[...] = twopt.apply_gain(arr, gain_2d)
+            else:
+                shared_arr[...] = arr
+            shared[name] = (block.name, arr.shape, arr.dtype.str)
+
+        slices = []
+        for jump_tile in jump_tiles:
+            tile_index = tile_slices(jump_tile, n_rows, n_cols)
+            frame = tile_index[1][2:]
+            slices.append((shared, tile_index, crs_args,
+                           after_jump_flag_e1[frame], after_jump_flag_n1,
+                           after_jump_flag_e2[frame], after_jump_flag_n2,
+                           precision))
+        with multiprocessing.Pool(processes=n_processes) as pool:
+            pool.starmap(find_crs_shared_slice, slices)
+
+        shared_gdq = np.ndarray(gdq.shape, dtype=gdq.dtype, buffer=blocks[3].buf)
+        gdq[...] = shared_gdq
+        del shared_gdq
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return gdq
+
+
+def find_crs_shared_slice(shared, tile_index, crs_args,
+                          after_jump_flag_e1, after_jump_flag_n1,
+                          after_jump_flag_e2, after_jump_flag_n2,
+                          precision='float64'):
+    """
+    Worker for find_crs_shared_memory: attach to the shared memory blocks, run
+    find_crs on the tile and halo given by tile_index, the output of
+    tile_slices, and write the interior of the tile to the output gdq.
+
+    The data of the halo is used in place, since find_crs only sets its
+    saturated and do not use groups to NaN, which is the same for all the
+    workers. The group dq of the halo is copied, as the input flags must not
+    change for the other workers.
+    """
+    tile, halo, interior = tile_index
+    blocks = {name: shared_memory.SharedMemory(name=spec[0]) for name, spec in shared.items()}
+    try:
+        arrays = {name: np.ndarray(spec[1], dtype=spec[2], buffer=blocks[name].buf)
+                  for name, spec in shared.items()}
+        result = twopt.find_crs(arrays['data'][halo], arrays['gdq'][halo].copy(),
+                                arrays['readnoise'][halo[2:]],
+                                *crs_args,
+                                after_jump_flag_e1=after_jump_flag_e1,
+                                after_jump_flag_n1=after_jump_flag_n1,
+                                after_jump_flag_e2=after_jump_flag_e2,
+                                after_jump_flag_n2=after_jump_flag_n2,
+                                copy_arrs=False,
+                                precision=precision)
+        arrays['gdq_out'][tile] = result[0][interior]
+        del arrays, result
+    finally:
+        for block in blocks.values():
+            block.close()
+
+
 def flag_large_events(gdq, jump_flag, sat_flag, min_sat_area=1,
                       min_jump_area=6,
                       expand_factor=2.0,
                       sat_required_snowball=True, min_sat_radius_extend=2.5,
-                      sat_expand=2, edge_size=25, max_extended_radius=200):
+                      sat_expand=2, edge_size=25, max_extended_radius=200,
+                      n_workers=1, worker_type='thread'):
     """
     This routine controls the creation of expanded regions that are flagged as
     jumps.
@@ -432,59 +730,296 @@ def flag_large_events(gdq, jump_flag, sat_flag, min_sat_area=1,
         required for a snowball to be created
     max_extended_radius : int
         The largest radius that a snowball or shower can be extended
+    n_workers : int
+        The number of workers processing integrations in parallel. The groups
+        of an integration are processed in order, because the extension of
+        saturated cores changes the later groups.
+    worker_type : str
+        'thread' or 'process' workers
 
     Returns
     -------
-    Nothing, gdq array is modified.
+    events : structured array
+        The catalog of the snowballs and of their saturated cores, with the
+        EVENT_DTYPE fields, which can be flagged again with flag_events.
+        The gdq array is modified in place.
 
     """
 
     log.info('Flagging large Snowballs')
 
-    n_showers_grp = []
-    for integration in range(gdq.shape[0]):
-        for group in range(1, gdq.shape[1]):
-            current_gdq = 1.0 * gdq[integration, group, :, :]
-            prev_gdq = 1.0 * gdq[integration, group - 1, :, :]
-            diff_gdq = 1.0 * current_gdq - prev_gdq
-            diff_gdq[diff_gdq != sat_flag] = 0
-            new_sat = diff_gdq.astype('uint8')
-            # find the ellipse parameters for newly saturated pixels
-            sat_ellipses = find_ellipses(new_sat, sat_flag, min_sat_area)
-
-            # find the ellipse parameters for jump regions
-            jump_ellipses = find_ellipses(gdq[integration, group, :, :],
-                                          jump_flag, min_jump_area)
-            if sat_required_snowball:
-                low_threshold = edge_size
-                high_threshold = max(0, gdq.shape[2] - edge_size)
-
-                gdq, snowballs = make_snowballs(gdq, integration, group,
-                                                jump_ellipses, sat_ellipses,
-                                                low_threshold, high_threshold,
-                                                min_sat_radius_extend,
-                                                sat_expand, sat_flag,
-                                                max_extended_radius)
-            else:
-                snowballs = jump_ellipses
-            n_showers_grp.append(len(snowballs))
-            gdq, num_events = extend_ellipses(gdq, integration, group,
-                                              snowballs,
-                                              sat_flag, jump_flag,
-                                              expansion=expand_factor,
-                                              max_extended_radius=max_extended_radius)
+    snowball_args = (jump_flag, sat_flag, min_sat_area, min_jump_area,
+                     expand_factor, sat_required_snowball,
+                     min_sat_radius_extend, sat_expand, edge_size,
+                     max_extended_radius)
+    if worker_type == 'process' and n_workers > 1 and gdq.shape[0] > 1:
+        # The workers get a copy of each integration and return it
+        results = map_workers(flag_large_events_integration,
+                              [(gdq[integration:integration + 1].copy(), *snowball_args)
+                               for integration in range(gdq.shape[0])],
+                              n_workers, worker_type)
+        for integration, (gdq_integ, n_showers_grp, events) in enumerate(results):
+            gdq[integration] = gdq_integ[0]
+    else:
+        # The workers modify each integration in place
+        results = map_workers(flag_large_events_integration,
+                              [(gdq[integration:integration + 1], *snowball_args)
+                               for integration in range(gdq.shape[0])],
+                              n_workers, worker_type)
+
+    for integration, (gdq_integ, n_showers_grp, events) in enumerate(results):
+        events['integration'] = integration
         if np.all(np.array(n_showers_grp) == 0):
             log.info(f'No snowballs found in integration {integration}.')
         else:
             log.info(f' In integration {integration}, number of snowballs ' +
                      f'in each group = {n_showers_grp}')
 
+    return np.concatenate([result[2] for result in results]) if results else \
+        np.zeros(0, dtype=EVENT_DTYPE)
+
+
+def flag_large_events_integration(gdq, jump_flag, sat_flag, min_sat_area,
+                                  min_jump_area, expand_factor,
+                                  sat_required_snowball, min_sat_radius_extend,
+                                  sat_expand, edge_size, max_extended_radius):
+    """
+    Flag the snowballs of one integration, group by group. See
+    flag_large_events for the parameters.
+
+    Parameters
+    ----------
+    gdq : int, 4D array
+        Group dq array of a single integration, modified in place
+
+    Returns
+    -------
+    gdq : int, 4D array
+        updated group dq array
+    n_showers_grp : list
+        number of snowballs in each group
+    events : structured array
+        catalog of the snowballs and saturated cores, in integration 0
+    """
+    n_showers_grp = []
+    events = []
+    integration = 0
+    # The groups with any jump flag, in one pass over the integration. The
+    # flagging of a group can only remove jump flags from the later groups,
+    # so groups without jumps can be skipped: they have no snowballs.
+    jump_groups = np.any(np.bitwise_and(gdq[integration], jump_flag), axis=(1, 2))
+    for group in range(1, gdq.shape[1]):
+        if not jump_groups[group]:
+            n_showers_grp.append(0)
+            continue
+        current_gdq = gdq[integration, group, :, :]
+        prev_gdq = gdq[integration, group - 1, :, :]
+        # newly saturated pixels are those that increased by the saturation
+        # flag since the previous group
+        new_sat_pix = (current_gdq > prev_gdq) & (current_gdq - prev_gdq == sat_flag)
+        if np.any(new_sat_pix):
+            new_sat = np.zeros(current_gdq.shape, dtype=np.uint8)
+            new_sat[new_sat_pix] = sat_flag
+            # find the ellipse parameters for newly saturated pixels
+            sat_ellipses = find_ellipses(new_sat, sat_flag, min_sat_area)
+        else:
+            sat_ellipses = []
+
+        # find the ellipse parameters for jump regions
+        jump_ellipses = find_ellipses(gdq[integration, group, :, :],
+                                      jump_flag, min_jump_area)
+        if sat_required_snowball:
+            low_threshold = edge_size
+            high_threshold = max(0, gdq.shape[2] - edge_size)
+
+            snowballs, sat_cores = find_snowballs(gdq, integration, group,
+                                                  jump_ellipses, sat_ellipses,
+                                                  low_threshold, high_threshold,
+                                                  min_sat_radius_extend,
+                                                  sat_expand, sat_flag,
+                                                  max_extended_radius)
+        else:
+            snowballs, sat_cores = jump_ellipses, []
+        n_showers_grp.append(len(snowballs))
+
+        # extend the saturated cores, then flag the snowballs of this group
+        group_events = events_array(integration, group, sat_cores, 'saturation',
+                                    snowballs, 'snowball')
+        flag_events(gdq, group_events, sat_flag, jump_flag, expand_factor=expand_factor,
+                    sat_expand=sat_expand, min_sat_radius_extend=min_sat_radius_extend,
+                    max_extended_radius=max_extended_radius)
+        events.append(group_events)
+    events = np.concatenate(events) if events else np.zeros(0, dtype=EVENT_DTYPE)
+    return gdq, n_showers_grp, events
+
+
+def events_array(integration, group, *ellipses_kinds):
+    """
+    Make a catalog of events with EVENT_DTYPE.
+
+    Parameters
+    ----------
+    integration, group : int
+        The integration and group of the events
+    ellipses_kinds
+        Pairs of a list of ellipses, as returned by cv.minAreaRect, and their
+        kind: 'snowball', 'saturation' or 'shower'
+
+    Returns
+    -------
+    events : structured array
+        The events, in the order of the lists
+    """
+    records = [(integration, group, ellipse[0], ellipse[1], ellipse[2], kind)
+               for ellipses, kind in zip(ellipses_kinds[::2], ellipses_kinds[1::2])
+               for ellipse in ellipses]
+    return np.array(records, dtype=EVENT_DTYPE)
+
+
+def event_ellipses(events):
+    """
+    The ellipses of a catalog of events, in the ((x, y), (width, height),
+    angle) format of cv.minAreaRect.
+    """
+    return [((float(event['center'][0]), float(event['center'][1])),
+             (float(event['axes'][0]), float(event['axes'][1])),
+             float(event['angle'])) for event in events]
+
+
+def flag_events(gdq, events, sat_flag, jump_flag, expand_factor=2.0, sat_expand=2,
+                min_sat_radius_extend=2.5, ellipse_expand=1.1, num_grps_masked=25,
+                max_extended_radius=200):
+    """
+    Flag a catalog of snowballs and showers, without detecting them again.
+
+    The events are flagged in order, for runs of events of the same
+    integration, group and kind. The saturated cores are extended as
+    saturated in their group and all later groups, the snowballs are
+    expanded and flagged as jumps in their group, and the showers in their
+    group and the following num_grps_masked groups.
+
+    Flagging the catalog returned by flag_large_events or find_shower_events
+    on the group dq array they were given, with the same parameters, gives
+    the same flags. Other expansion parameters can be tried this way, with
+    the events found with the original ones: the showers are detected before
+    any of them are flagged, but the snowballs of a group are detected from
+    the flags of the earlier snowballs, so a full rerun can find slightly
+    different snowballs.
+
+    Parameters
+    ----------
+    gdq : int, 4D array
+        Group dq array, modified in place
+    events : structured array
+        The catalog of events, with EVENT_DTYPE fields
+    sat_flag : int
+        DQ flag for saturation
+    jump_flag : int
+        DQ flag for jump detection
+    expand_factor : float
+        The factor that increases the size of the snowballs
+    sat_expand : int
+        The number of pixels to extend the saturated cores by
+    min_sat_radius_extend : float
+        The smallest radius of the saturated cores that are extended
+    ellipse_expand : float
+        The relative increase in the size of the showers
+    num_grps_masked : int
+        The number of groups after the showers to flag as jump
+    max_extended_radius : int
+        The largest radius that a snowball, core or shower can be extended
+
+    Returns
+    -------
+    gdq : int, 4D array
+        The updated group dq array
+    """
+    keys = zip(events['integration'], events['group'], events['kind'])
+    start = 0
+    for (integration, group, kind), run in itertools.groupby(keys):
+        stop = start + len(list(run))
+        ellipses = event_ellipses(events[start:stop])
+        start = stop
+        if kind == 'saturation':
+            sat_mask = saturation_mask(gdq.shape[2:], ellipses, min_sat_radius_extend,
+                                       expansion=sat_expand,
+                                       max_extended_radius=max_extended_radius)
+            saty, satx = np.nonzero(sat_mask)
+            gdq[integration, group:, saty, satx] = sat_flag
+        elif kind == 'snowball':
+            extend_ellipses(gdq, integration, group, ellipses, sat_flag, jump_flag,
+                            expansion=expand_factor,
+                            max_extended_radius=max_extended_radius)
+        elif kind == 'shower':
+            extend_ellipses(gdq, integration, group, ellipses, sat_flag, jump_flag,
+                            expansion=ellipse_expand, expand_by_ratio=True,
+                            num_grps_masked=num_grps_masked,
+                            max_extended_radius=max_extended_radius)
+        else:
+            raise ValueError(f"Unknown event kind: {kind}")
+    return gdq
+
+
+def map_workers(func, args_list, n_workers, worker_type='thread'):
+    """
+    Call func with each tuple of arguments in args_list, using a pool of
+    n_workers threads or processes. The results are returned in the order of
+    args_list.
+    """
+    n_workers = min(n_workers, len(args_list))
+    if n_workers <= 1:
+        return [func(*args) for args in args_list]
+
+    if worker_type == 'thread':
+        pool = multiprocessing.pool.ThreadPool(processes=n_workers)
+    elif worker_type == 'process':
+        pool = multiprocessing.Pool(processes=n_workers)
+    else:
+        raise ValueError(f"Unknown worker_type: {worker_type}")
+    with pool:
+        results = pool.starmap(func, args_list)
+    return results
+
 
 def extend_saturation(cube, grp, sat_ellipses, sat_flag,
                       min_sat_radius_extend, expansion=2,
                       max_extended_radius=200):
-    image = np.zeros(shape=(cube.shape[1], cube.shape[2], 3), dtype=np.uint8)
     outcube = cube.copy()
+    sat_mask = saturation_mask(cube.shape[1:], sat_ellipses,
+                               min_sat_radius_extend, expansion=expansion,
+                               max_extended_radius=max_extended_radius)
+    saty, satx = np.nonzero(sat_mask)
+    outcube[grp:, saty, satx] = sat_flag
+    return outcube
+
+
+def saturation_mask(shape, sat_ellipses, min_sat_radius_extend, expansion=2,
+                    max_extended_radius=200, mask=None):
+    """
+    Accumulate the pixels of the extended saturated cores in a 2D mask.
+
+    Parameters
+    ----------
+    shape : tuple
+        The (nrows, ncols) shape of the frame
+    sat_ellipses : list
+        The ellipses of the saturated cores
+    min_sat_radius_extend : float
+        The smallest radius to trigger extension of the saturated core
+    expansion : int
+        The number of pixels to extend the saturated core by
+    max_extended_radius : int
+        The largest radius that a saturated core can be extended
+    mask : bool, 2D array
+        The mask to update in place. A new mask is created if None.
+
+    Returns
+    -------
+    mask : bool, 2D array
+        True for the pixels within the extended saturated cores
+    """
+    if mask is None:
+        mask = np.zeros(shape, dtype=bool)
     for ellipse in sat_ellipses:
         ceny = ellipse[0][0]
         cenx = ellipse[0][1]
@@ -495,13 +1030,12 @@ def extend_saturation(cube, grp, sat_ellipses, sat_flag,
             alpha = ellipse[2]
             axis1 = min(axis1, max_extended_radius)
             axis2 = min(axis2, max_extended_radius)
-            image = cv.ellipse(image, (round(ceny), round(cenx)),
-                               (round(axis1/2),
-                               round(axis2/2)), alpha, 0, 360, (0, 0, 22), -1)
-            sat_ellipse = image[:, :, 2]
-            saty, satx = np.where(sat_ellipse == 22)
-            outcube[grp:, saty, satx] = sat_flag
-    return outcube
+            rows, cols, sat_ellipse = ellipse_window(shape,
+                                                     (round(ceny), round(cenx)),
+                                                     (round(axis1 / 2),
+                                                      round(axis2 / 2)), alpha)
+            mask[rows, cols] |= sat_ellipse
+    return mask
 
 
 def extend_ellipses(gdq_cube, intg, grp, ellipses, sat_flag, jump_flag,
@@ -510,9 +1044,8 @@ def extend_ellipses(gdq_cube, intg, grp, ellipses, sat_flag, jump_flag,
     # For a given DQ plane it will use the list of ellipses to create
     #  expanded ellipses of pixels with
     # the jump flag set.
-    plane = gdq_cube[intg, grp, :, :]
-    image = np.zeros(shape=(plane.shape[0], plane.shape[1], 3), dtype=np.uint8)
     num_ellipses = len(ellipses)
+    last_grp = min(grp + num_grps_masked, gdq_cube.shape[1])
     for ellipse in ellipses:
         ceny = ellipse[0][0]
         cenx = ellipse[0][1]
@@ -536,21 +1069,55 @@ def extend_ellipses(gdq_cube, intg, grp, ellipses, sat_flag, jump_flag,
         axis1 = min(axis1, max_extended_radius)
         axis2 = min(axis2, max_extended_radius)
         alpha = ellipse[2]
-        image = cv.ellipse(image, (round(ceny), round(cenx)), (round(axis1 / 2),
-                           round(axis2 / 2)), alpha, 0, 360,
-                           (0, 0, jump_flag), -1)
-        jump_ellipse = image[:, :, 2]
-        last_grp = min(grp + num_grps_masked, gdq_cube.shape[1])
-        #  This loop will flag the number of groups
-        for flg_grp in range(grp, last_grp):
-            sat_pix = np.bitwise_and(gdq_cube[intg, flg_grp, :, :], sat_flag)
-            saty, satx = np.where(sat_pix == sat_flag)
-            jump_ellipse[saty, satx] = 0
-            gdq_cube[intg, flg_grp, :, :] = \
-                np.bitwise_or(gdq_cube[intg, flg_grp, :, :], jump_ellipse)
+        rows, cols, jump_ellipse = ellipse_window(gdq_cube.shape[2:],
+                                                  (round(ceny), round(cenx)),
+                                                  (round(axis1 / 2),
+                                                   round(axis2 / 2)), alpha)
+        #  Flag the groups within the bounding box of the ellipse. A pixel
+        # is not flagged from the first group where it is saturated on.
+        window = gdq_cube[intg, grp:last_grp, rows, cols]
+        saturated = np.logical_or.accumulate(
+            np.bitwise_and(window, sat_flag) == sat_flag, axis=0)
+        window[jump_ellipse[np.newaxis, :, :] & ~saturated] |= jump_flag
     return gdq_cube, num_ellipses
 
 
+def ellipse_window(shape, center, axes, alpha):
+    """
+    Rasterize a filled ellipse within its bounding box.
+
+    Parameters
+    ----------
+    shape : tuple
+        The (nrows, ncols) shape of the frame
+    center : tuple of int
+        The (x, y) center of the ellipse
+    axes : tuple of int
+        The half lengths of the axes of the ellipse
+    alpha : float
+        The rotation angle of the ellipse in degrees
+
+    Returns
+    -------
+    rows, cols : slice
+        The window of the frame enclosing the ellipse
+    mask : bool, 2D array
+        True for the pixels of the window inside the ellipse
+    """
+    radius = max(axes) + 1
+    row_start = min(max(center[1] - radius, 0), shape[0])
+    row_stop = max(min(center[1] + radius + 1, shape[0]), row_start)
+    col_start = min(max(center[0] - radius, 0), shape[1])
+    col_stop = max(min(center[0] + radius + 1, shape[1]), col_start)
+    image = np.zeros(shape=(row_stop - row_start, col_stop - col_start),
+                     dtype=np.uint8)
+    if image.size > 0:
+        image = cv.ellipse(image, (center[0] - col_start, center[1] - row_start),
+                           axes, alpha, 0, 360, 1, -1)
+    return (slice(row_start, row_stop), slice(col_start, col_stop),
+            image.astype(bool))
+
+
 def find_circles(dqplane, bitmask, min_area):
     # Using an input DQ plane this routine will find the groups of pixels with at least the minimum
     # area and return a list of the minimum enclosing circle parameters.
@@ -581,28 +1148,77 @@ def make_snowballs(gdq, integration, group, jump_ellipses, sat_ellipses,
                    min_sat_radius, expansion, sat_flag, max_extended_radius):
     # Ths routine will create a list of snowballs (ellipses) that have the
     # center
-    # of the saturation circle within the enclosing jump rectangle.
+    # of the saturation circle within the enclosing jump rectangle, and
+    # extend their saturated cores in place, in one pass.
+    snowballs, sat_cores = find_snowballs(gdq, integration, group, jump_ellipses,
+                                          sat_ellipses, low_threshold, high_threshold,
+                                          min_sat_radius, expansion, sat_flag,
+                                          max_extended_radius)
+    if len(sat_cores) > 0:
+        sat_mask = saturation_mask(gdq.shape[2:], sat_cores, min_sat_radius,
+                                   expansion=expansion,
+                                   max_extended_radius=max_extended_radius)
+        saty, satx = np.nonzero(sat_mask)
+        gdq[integration, group:, saty, satx] = sat_flag
+    return gdq, snowballs
+
+
+def find_snowballs(gdq, integration, group, jump_ellipses, sat_ellipses,
+                   low_threshold, high_threshold,
+                   min_sat_radius, expansion, sat_flag, max_extended_radius):
+    """
+    Find the snowballs of a group, the jump ellipses that are near the edge
+    or have a saturated core within their minor axis, as make_snowballs,
+    without extending the cores.
+
+    Returns
+    -------
+    snowballs : list
+        The jump ellipses of the snowballs
+    sat_cores : list
+        The saturated core extended for each snowball that has one
+    """
     snowballs = []
+    sat_cores = []
+    # the snowballs found so far, to check for duplicates
+    snowball_set = set()
+    sat_mask = None
+    if len(sat_ellipses) > 0:
+        # index the centers of the saturation, so that each jump is only
+        # tested against the saturation near its center
+        sat_tree = KDTree([sat[0] for sat in sat_ellipses])
     for jump in jump_ellipses:
         if near_edge(jump, low_threshold, high_threshold):
             snowballs.append(jump)
-        else:
-            for sat in sat_ellipses:
+            snowball_set.add(jump)
+        elif len(sat_ellipses) > 0 and jump not in snowball_set:
+            # candidates within the minor axis of the jump, with a small
+            # margin for rounding. point_inside_ellipse does the exact test.
+            minor_axis = min(jump[1][0], jump[1][1])
+            near_sats = sorted(sat_tree.query_ball_point(
+                jump[0], minor_axis * (1 + 1e-6) + 1e-6))
+            for sat_index in near_sats:
+                sat = sat_ellipses[sat_index]
                 # center of saturation is within the enclosing jump rectangle
                 if point_inside_ellipse(sat[0], jump):
-                    # center of jump should be saturated
-                    jump_center = jump[0]
-                    if gdq[integration, group, round(jump_center[1]),
-                           round(jump_center[0])] == sat_flag:
-                        if jump not in snowballs:
-                            snowballs.append(jump)
-                            gdq[integration, :, :, :] = \
-                                extend_saturation(gdq[integration, :, :, :],
-                                                  group, [sat], sat_flag,
-                                                  min_sat_radius,
-                                                  expansion=expansion,
-                                                  max_extended_radius=max_extended_radius)
-    return gdq, snowballs
+                    # center of jump should be saturated, including by the
+                    # saturated cores already extended in this group
+                    jump_center = (round(jump[0][1]), round(jump[0][0]))
+                    if gdq[integration, group, jump_center[0],
+                           jump_center[1]] == sat_flag or \
+                            (sat_mask is not None and sat_mask[jump_center]):
+                        snowballs.append(jump)
+                        snowball_set.add(jump)
+                        sat_cores.append(sat)
+                        sat_mask = saturation_mask(gdq.shape[2:], [sat],
+                                                   min_sat_radius,
+                                                   expansion=expansion,
+                                                   max_extended_radius=max_extended_radius,
+                                                   mask=sat_mask)
+                        # only the first saturated core of a snowball is
+                        # extended
+                        break
+    return snowballs, sat_cores
 
 
 def point_inside_ellipse(point, ellipse):
@@ -629,7 +1245,8 @@ def near_edge(jump, low_threshold, high_threshold):
 def find_faint_extended(indata, gdq, readnoise_2d, nframes, snr_threshold=1.3,
                         min_shower_area=40, inner=1, outer=2, sat_flag=2,
                         jump_flag=4, ellipse_expand=1.1, num_grps_masked=25,
-                        max_extended_radius=200):
+                        max_extended_radius=200, n_workers=1, worker_type='thread',
+                        convolve_method='astropy', gain_2d=None):
     """
     Parameters
     ----------
@@ -661,80 +1278,251 @@ def find_faint_extended(indata, gdq, readnoise_2d, nframes, snr_threshold=1.3,
         The number of groups after the detected shower to be flagged as jump.
     max_extended_radius: int
         The upper limit for the extension of saturation and jump
+    n_workers : int
+        The number of workers detecting showers in the groups of an
+        integration in parallel.
+    worker_type : str
+        'thread' or 'process' workers
+    convolve_method : str
+        'astropy' (default) for `~astropy.convolution.convolve`, or
+        'filter2d' for the fast NaN-aware convolution of nan_convolve. Both
+        interpolate over the NaN pixels with the normalized kernel, and agree
+        to rounding, so pixels at the SNR threshold can differ.
+    gain_2d : float, 2D array
+        The gain of each pixel. If given, the science array and readnoise are
+        in units of DN and are converted to electrons one integration at a
+        time, without modifying them.
     Returns
     -------
     gdq : int, 4D array
       updated group dq array.
     number_ellipse : int
-    Total number of showers detected.
+    Total number of groups with showers detected.
 
     """
-    read_noise_2 = readnoise_2d**2
-    data = indata.copy()
-    data[gdq == sat_flag] = np.nan
-    data[gdq == 1] = np.nan
-    data[gdq == jump_flag] = np.nan
-    all_ellipses = []
-    for intg in range(data.shape[0]):
-        diff = np.diff(data[intg], axis=0)
-        median_diffs = np.nanmedian(diff, axis=0)
-        # calculate sigma for each pixel
-        sigma = np.sqrt(np.abs(median_diffs) + read_noise_2 / nframes)
-
-        # The difference from the median difference for each group
-        e_jump = diff - median_diffs[np.newaxis, :, :]
-
-        ratio = np.abs(e_jump) / sigma[np.newaxis, :, :]  # SNR ratio of
-        # each diff.
-
-        #  The convolution kernal creation
-        ring_2D_kernel = Ring2DKernel(inner, outer)
-        for grp in range(1, ratio.shape[0] + 1):
-            masked_ratio = ratio[grp-1].copy()
-            jumpy, jumpx = np.where(gdq[intg, grp, :, :] == jump_flag)
-            #  mask pix. that are already flagged as jump
-            masked_ratio[jumpy, jumpx] = np.nan
-
-            saty, satx = np.where(gdq[intg, grp, :, :] == sat_flag)
-
-            #  mask pix. that are already flagged as sat.
-            masked_ratio[saty, satx] = np.nan
-
-            masked_smoothed_ratio = convolve(masked_ratio, ring_2D_kernel)
-            extended_emission = np.zeros(shape=(ratio.shape[1],
-                                                ratio.shape[2]), dtype=np.uint8)
-            exty, extx = np.where(masked_smoothed_ratio > snr_threshold)
-            extended_emission[exty, extx] = 1
-            #  find the contours of the extended emission
-            contours, hierarchy = cv.findContours(extended_emission,
-                                                  cv.RETR_EXTERNAL,
-                                                  cv.CHAIN_APPROX_SIMPLE)
-            #  get the countours that are above the minimum size
-            bigcontours = [con for con in contours if cv.contourArea(con) >
-                           min_shower_area]
-            #  get the minimum enclosing rectangle which is the same as the
-            # minimum enclosing ellipse
-            ellipses = [cv.minAreaRect(con) for con in bigcontours]
-            if len(ellipses) > 0:
-                # add all the showers for this integration to the list
-                all_ellipses.append([intg, grp, ellipses])
-    if all_ellipses:
-        #  Now we actually do the flagging of the pixels inside showers.
-        # This is deferred until all showers are detected. because the showers
-        # can flag future groups and would confuse the detection algorthim if
-        # we worked on groups that already had some flagged showers.
-        for showers in all_ellipses:
-            intg = showers[0]
-            grp = showers[1]
-            ellipses = showers[2]
-            gdq, num = extend_ellipses(gdq, intg, grp, ellipses, sat_flag,
-                                       jump_flag, expansion=ellipse_expand,
-                                       expand_by_ratio=True,
-                                       num_grps_masked=num_grps_masked,
-                                       max_extended_radius=max_extended_radius)
-    if np.all(all_ellipses == 0):
+    #  Detect all the showers first, then flag them. The flagging is deferred
+    # until all showers are detected, because the showers can flag future
+    # groups and would confuse the detection algorthim if we worked on groups
+    # that already had some flagged showers.
+    events = find_shower_events(indata, gdq, readnoise_2d, nframes,
+                                snr_threshold=snr_threshold,
+                                min_shower_area=min_shower_area, inner=inner,
+                                outer=outer, sat_flag=sat_flag, jump_flag=jump_flag,
+                                n_workers=n_workers, worker_type=worker_type,
+                                convolve_method=convolve_method, gain_2d=gain_2d)
+    gdq = flag_events(gdq, events, sat_flag, jump_flag, ellipse_expand=ellipse_expand,
+                      num_grps_masked=num_grps_masked,
+                      max_extended_radius=max_extended_radius)
+    num_showers = len(np.unique(events[['integration', 'group']]))
+    if num_showers == 0:
         log.info('No showers found in exposure.')
     else:
-        num_showers = len(all_ellipses)
         log.info(f' Number of showers flagged = {num_showers}')
-    return gdq, len(all_ellipses)
+    return gdq, num_showers
+
+
+def find_shower_events(indata, gdq, readnoise_2d, nframes, snr_threshold=1.3,
+                       min_shower_area=40, inner=1, outer=2, sat_flag=2,
+                       jump_flag=4, n_workers=1, worker_type='thread',
+                       convolve_method='astropy', gain_2d=None):
+    """
+    Detect the showers of find_faint_extended, without flagging them.
+
+    The parameters are those of find_faint_extended. The gdq array is not
+    modified.
+
+    Returns
+    -------
+    events : structured array
+        The catalog of the showers, with EVENT_DTYPE fields, which
+        flag_events flags with the expansion parameters of
+        find_faint_extended.
+    """
+    if gain_2d is not None:
+        readnoise_2d = twopt.apply_gain(readnoise_2d, gain_2d)
+    read_noise_2 = readnoise_2d**2
+    read_noise_frame = read_noise_2 / nframes
+    events = []
+    #  The convolution kernal creation
+    ring_2D_kernel = ring_kernel(inner, outer)
+    # The integrations are processed one at a time, so the memory used is a
+    # few times the size of an integration, not of the whole exposure
+    for intg in range(indata.shape[0]):
+        if gain_2d is None:
+            data = indata[intg].copy()
+        else:
+            data = twopt.apply_gain(indata[intg], gain_2d)
+        data[gdq[intg] == sat_flag] = np.nan
+        data[gdq[intg] == 1] = np.nan
+        data[gdq[intg] == jump_flag] = np.nan
+        # The differences of the groups, in place
+        for grp in range(data.shape[0] - 1, 0, -1):
+            data[grp] -= data[grp - 1]
+        diff = data[1:]
+        median_diffs = nanmedian_by_rows(diff)
+        # calculate sigma for each pixel
+        sigma = np.sqrt(np.abs(median_diffs) + read_noise_frame)
+
+        # Detect the showers in each group, in parallel. The SNR ratio of
+        # each diff is computed by the workers.
+        group_ellipses = map_workers(find_showers_in_diff,
+                                     [(diff[grp - 1], median_diffs, sigma,
+                                       gdq[intg, grp, :, :],
+                                       ring_2D_kernel, snr_threshold,
+                                       min_shower_area, sat_flag, jump_flag,
+                                       convolve_method)
+                                      for grp in range(1, diff.shape[0] + 1)],
+                                     n_workers, worker_type)
+        for grp, ellipses in enumerate(group_ellipses, start=1):
+            # add all the showers for this integration to the catalog
+            events.append(events_array(intg, grp, ellipses, 'shower'))
+    return np.concatenate(events) if events else np.zeros(0, dtype=EVENT_DTYPE)
+
+
+def nanmedian_by_rows(data, chunk_size=2**19):
+    """
+    The median over the first axis of a 3D array, ignoring NaNs, computed
+    for blocks of rows.
+
+    This gives the same result as np.nanmedian, with less temporary memory
+    and better use of the cache.
+
+    Parameters
+    ----------
+    data : float, 3D array
+        The (ndiffs, nrows, ncols) array
+    chunk_size : int
+        The approximate number of elements of the blocks
+
+    Returns
+    -------
+    median : float, 2D array
+        The median of each pixel
+    """
+    ndiffs, nrows, ncols = data.shape
+    rows_per_chunk = max(1, min(nrows, chunk_size // max(1, ndiffs * ncols)))
+    median = np.empty((nrows, ncols), dtype=np.result_type(data.dtype, np.float16))
+    for row_start in range(0, nrows, rows_per_chunk):
+        row_stop = row_start + rows_per_chunk
+        median[row_start:row_stop] = np.nanmedian(data[:, row_start:row_stop],
+                                                  axis=0)
+    return median
+
+
+def find_showers_in_diff(diff, median_diffs, sigma, *args):
+    """
+    Compute the SNR ratio of one group difference and detect its showers.
+    The other arguments are those of find_showers_in_group.
+    """
+    ratio = np.abs(diff - median_diffs) / sigma
+    return find_showers_in_group(ratio, *args)
+
+
+def find_showers_in_group(ratio, gdq_plane, ring_2D_kernel, snr_threshold,
+                          min_shower_area, sat_flag, jump_flag,
+                          convolve_method='astropy'):
+    """
+    Detect the extended emission of showers in the SNR ratio of one group
+    difference.
+
+    Parameters
+    ----------
+    ratio : float, 2D array
+        SNR ratio of the difference ending at this group
+    gdq_plane : int, 2D array
+        Group dq of this group, not modified
+    ring_2D_kernel : `~astropy.convolution.Ring2DKernel`
+        The kernel used to smooth the ratio
+    snr_threshold, min_shower_area, sat_flag, jump_flag, convolve_method
+        See find_faint_extended
+
+    Returns
+    -------
+    ellipses : list
+        The minimum enclosing ellipses of the detected showers
+    """
+    masked_ratio = ratio.copy()
+    jumpy, jumpx = np.where(gdq_plane == jump_flag)
+    #  mask pix. that are already flagged as jump
+    masked_ratio[jumpy, jumpx] = np.nan
+
+    saty, satx = np.where(gdq_plane == sat_flag)
+
+    #  mask pix. that are already flagged as sat.
+    masked_ratio[saty, satx] = np.nan
+
+    if convolve_method == 'filter2d':
+        masked_smoothed_ratio = nan_convolve(masked_ratio, ring_2D_kernel.array)
+    elif convolve_method == 'astropy':
+        masked_smoothed_ratio = convolve(masked_ratio, ring_2D_kernel)
+    else:
+        raise ValueError(f"Unknown convolve_method: {convolve_method}")
+    extended_emission = np.zeros(shape=(ratio.shape[0],
+                                        ratio.shape[1]), dtype=np.uint8)
+    exty, extx = np.where(masked_smoothed_ratio > snr_threshold)
+    extended_emission[exty, extx] = 1
+    #  find the contours of the extended emission
+    contours, hierarchy = cv.findContours(extended_emission,
+                                          cv.RETR_EXTERNAL,
+                                          cv.CHAIN_APPROX_SIMPLE)
+    #  get the countours that are above the minimum size
+    bigcontours = [con for con in contours if cv.contourArea(con) >
+                   min_shower_area]
+    #  get the minimum enclosing rectangle which is the same as the
+    # minimum enclosing ellipse
+    return [cv.minAreaRect(con) for con in bigcontours]
+
+
+@functools.lru_cache
+def ring_kernel(inner, outer):
+    """
+    The `~astropy.convolution.Ring2DKernel` used to smooth the ratio, cached
+    for each inner and outer radius.
+    """
+    return Ring2DKernel(inner, outer)
+
+
+def nan_convolve(image, kernel, zero_tol=1e-8):
+    """
+    Normalized convolution of an image with NaN pixels.
+
+    This is equivalent to `~astropy.convolution.convolve` with its default
+    arguments: the image is padded with zeros and the NaN pixels are
+    interpolated over with the normalized kernel. The sums of the data and
+    of the weights of the valid pixels are computed with OpenCV filter2D,
+    which switches to a DFT for large kernels.
+
+    Parameters
+    ----------
+    image : float, 2D array
+        The image to convolve
+    kernel : float, 2D array
+        The kernel, with odd dimensions
+    zero_tol : float
+        Pixels with weights below zero_tol times the kernel sum have no valid
+        neighbors and keep their input value, as in astropy.
+
+    Returns
+    -------
+    result : float, 2D array
+        The convolved image
+    """
+    # filter2D computes a correlation
+    kernel = cv.flip(np.asarray(kernel, dtype=np.float64), -1)
+    kernel_sum = kernel.sum()
+    image = np.asarray(image, dtype=np.float64)
+    nan_pix = np.isnan(image)
+    result = cv.filter2D(np.where(nan_pix, 0., image), -1, kernel,
+                         borderType=cv.BORDER_CONSTANT)
+    if not np.any(nan_pix):
+        return result / kernel_sum
+
+    # The padding is valid data, so the weights are the kernel sum minus the
+    # weights of the NaN pixels
+    weights = kernel_sum - cv.filter2D(nan_pix.astype(np.float64), -1, kernel,
+                                       borderType=cv.BORDER_CONSTANT)
+    no_weight = weights < zero_tol * kernel_sum
+    weights[no_weight] = 1.
+    result /= weights
+    result[no_weight] = image[no_weight]
+    return result
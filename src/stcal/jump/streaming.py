@@ -0,0 +1,288 @@
+import logging
+
+import numpy as np
+
+from .twopoint_difference import apply_gain, calc_med_first_diffs, rejection_thresholds
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# the offsets of the four neighbors of a pixel, in the order of their bits in
+# the neighbor masks
+NEIGHBORS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+
+class StreamingJumpDetector:
+    """
+    Two-point difference jump detection of one integration, for groups
+    that arrive one at a time.
+
+    Each pixel keeps a window of its most recent first differences that
+    are not jumps. A new difference is compared to the clipped median of
+    the window and the new difference, as `find_crs` compares each
+    difference to the clipped median of all of them, and flagged as a jump
+    if its ratio exceeds the threshold for the number of usable
+    differences. The first differences of a pixel are pending until it has
+    four usable differences, so that a jump in the first groups does not
+    bias the median, and are then decided together. The memory used is
+    about `window` frames, not the whole ramp.
+
+    The flags can differ from `find_crs`, which uses the median of all the
+    differences and clips the jumps iteratively. As in `find_crs`, the
+    neighbors of a jump are flagged unless they are SATURATED or DO_NOT_USE
+    in the group of the jump. The flags of the neighbors in that group are
+    kept with each difference of the window for the pending ones.
+
+    Parameters
+    ----------
+    read_noise : float, 2D array
+        The read noise of each pixel
+    rejection_thresh : float
+        cosmic ray sigma rejection threshold
+    two_diff_rej_thresh : float
+        cosmic ray sigma rejection threshold for ramps having 3 groups
+    three_diff_rej_thresh : float
+        cosmic ray sigma rejection threshold for ramps having 4 groups
+    nframes : int
+        The number of frames that are included in the group average
+    flag_4_neighbors : bool
+        If True, the four perpendicular neighbors of the jumps are also
+        flagged as jumps
+    max_jump_to_flag_neighbors : float
+        value in units of sigma that sets the upper limit for flagging of
+        neighbors
+    min_jump_to_flag_neighbors : float
+        value in units of sigma that sets the lower limit for flagging of
+        neighbors
+    dqflags : dict
+        A dictionary with at least the DO_NOT_USE, SATURATED and JUMP_DET
+        keywords
+    window : int
+        The number of recent differences kept for each pixel, at least 4
+    gain_2d : float, 2D array, optional
+        The gain of each pixel. If given, the groups and read noise are in
+        units of DN and are converted to electrons.
+    """
+
+    def __init__(self, read_noise, rejection_thresh, two_diff_rej_thresh,
+                 three_diff_rej_thresh, nframes, flag_4_neighbors,
+                 max_jump_to_flag_neighbors, min_jump_to_flag_neighbors, dqflags,
+                 window=8, gain_2d=None):
+        if window < 4:
+            raise ValueError(f"The window must hold at least 4 differences, not {window}")
+        if gain_2d is not None:
+            read_noise = apply_gain(read_noise, gain_2d)
+        self.read_noise_frame = read_noise.astype(np.float64) ** 2 / nframes
+        self.rejection_thresh = rejection_thresh
+        self.two_diff_rej_thresh = two_diff_rej_thresh
+        self.three_diff_rej_thresh = three_diff_rej_thresh
+        self.flag_4_neighbors = flag_4_neighbors
+        self.max_jump_to_flag_neighbors = max_jump_to_flag_neighbors
+        self.min_jump_to_flag_neighbors = min_jump_to_flag_neighbors
+        self.sat_flag = dqflags["SATURATED"]
+        self.dnu_flag = dqflags["DO_NOT_USE"]
+        self.jump_flag = dqflags["JUMP_DET"]
+        self.gain_2d = gain_2d
+
+        nrows, ncols = read_noise.shape
+        self.ngroups = 0
+        self.last_group = None
+        # the recent differences that are not jumps, NaN for empty slots,
+        # the group of each difference, the mask of its neighbors that are
+        # unusable in that group, and the next slot of each pixel
+        self.window = np.full((window, nrows, ncols), np.nan)
+        self.window_group = np.zeros((window, nrows, ncols), dtype=np.int32)
+        self.window_neighbors = np.zeros((window, nrows, ncols), dtype=np.uint8)
+        self.next_slot = np.zeros((nrows, ncols), dtype=np.intp)
+        # differences waiting for enough usable differences to be decided
+        self.pending = np.zeros((window, nrows, ncols), dtype=bool)
+        self.settled = np.zeros((nrows, ncols), dtype=bool)
+        # the (group, row, col) of the jumps flagged so far
+        self.jumps = []
+        self.reconciliation = None
+
+    def push(self, data, group_dq=None):
+        """
+        Add the next group and flag the jumps that can be decided.
+
+        Parameters
+        ----------
+        data : float, 2D array
+            The next group of the ramps
+        group_dq : int, 2D array, optional
+            The group DQ flags of the next group. Saturated and do not use
+            pixels are not used.
+
+        Returns
+        -------
+        groups, rows, cols : int, 1D arrays
+            The new jump flags, in this group or in earlier groups whose
+            differences were pending
+        """
+        group = self.ngroups
+        self.ngroups += 1
+        frame = data.astype(np.float64) if self.gain_2d is None else \
+            apply_gain(data.astype(np.float64), self.gain_2d)
+        neighbors = np.zeros(frame.shape, dtype=np.uint8)
+        if group_dq is not None:
+            unusable = np.bitwise_and(group_dq, self.sat_flag | self.dnu_flag) != 0
+            frame[unusable] = np.nan
+            neighbors = self.unusable_neighbors(unusable)
+        if self.last_group is None:
+            self.last_group = frame
+            return self.no_jumps()
+        diff = frame - self.last_group
+        self.last_group = frame
+
+        # the ratio of the window and of the new difference, with the
+        # clipped median of both
+        stack = np.concatenate((self.window, diff[np.newaxis]))
+        median_diffs = calc_med_first_diffs(stack)
+        sigma = np.sqrt(np.abs(median_diffs) + self.read_noise_frame)
+        ratio = np.abs(stack - median_diffs) / sigma
+        num_usable = np.sum(~np.isnan(stack), axis=0)
+        rej_thresh = rejection_thresholds(num_usable, self.rejection_thresh,
+                                          self.two_diff_rej_thresh, self.three_diff_rej_thresh)
+        usable = ~np.isnan(diff)
+
+        # the pending differences are decided when a pixel has enough
+        # usable differences, and the new ones after that
+        settling = usable & ~self.settled & (num_usable >= 4)
+        self.settled |= settling
+        decided = usable & self.settled
+        with np.errstate(invalid='ignore'):
+            is_jump = decided & (ratio[-1] > rej_thresh)
+            pending_jumps = self.pending & settling & (ratio[:-1] > rej_thresh)
+        self.pending[:, settling] = False
+
+        slot, jump_row, jump_col = np.nonzero(pending_jumps)
+        new_row, new_col = np.nonzero(is_jump)
+        groups = np.concatenate((self.window_group[slot, jump_row, jump_col],
+                                 np.full(len(new_row), group)))
+        rows = np.concatenate((jump_row, new_row))
+        cols = np.concatenate((jump_col, new_col))
+        jump_ratio = np.concatenate((ratio[slot, jump_row, jump_col], ratio[-1, new_row, new_col]))
+        jump_neighbors = np.concatenate((self.window_neighbors[slot, jump_row, jump_col],
+                                         neighbors[new_row, new_col]))
+
+        # the jumps are removed from the window, and the other new
+        # differences replace the oldest one
+        self.window[pending_jumps] = np.nan
+        keep_row, keep_col = np.nonzero(usable & ~is_jump)
+        slots = self.next_slot[keep_row, keep_col]
+        self.window[slots, keep_row, keep_col] = diff[keep_row, keep_col]
+        self.window_group[slots, keep_row, keep_col] = group
+        self.window_neighbors[slots, keep_row, keep_col] = neighbors[keep_row, keep_col]
+        self.pending[slots, keep_row, keep_col] = ~self.settled[keep_row, keep_col]
+        self.next_slot[keep_row, keep_col] = (slots + 1) % self.window.shape[0]
+
+        return self.add_jumps(groups, rows, cols, jump_ratio, jump_neighbors)
+
+    def finalize(self, group_dq=None, batch_gdq=None):
+        """
+        Decide the pending differences and return the jump flags.
+
+        The pixels that never had four usable differences are decided as
+        in `find_crs`: the difference with the largest ratio is a jump if
+        it exceeds the threshold for the number of usable differences.
+
+        Parameters
+        ----------
+        group_dq : int, 3D array (num_groups, num_rows, num_cols), optional
+            The group DQ flags of the integration, to which the jump flags
+            are added in a copy
+        batch_gdq : int, 3D array (num_groups, num_rows, num_cols), optional
+            The group DQ flags from `find_crs` on the whole integration, to
+            reconcile with. The numbers of jumps flagged by both, only by
+            the streaming detection and only by `find_crs` are logged and
+            stored in the `reconciliation` dict.
+
+        Returns
+        -------
+        gdq : int, 3D array (num_groups, num_rows, num_cols)
+            The group DQ flags with the jumps
+        """
+        self.decide_unsettled()
+
+        if group_dq is None:
+            gdq = np.zeros((self.ngroups,) + self.window.shape[1:], dtype=np.uint8)
+        else:
+            gdq = group_dq.copy()
+        groups, rows, cols = (np.concatenate(index) for index in zip(*self.jumps)) \
+            if self.jumps else self.no_jumps()
+        gdq[groups, rows, cols] |= self.jump_flag
+
+        if batch_gdq is not None:
+            stream_jumps = np.bitwise_and(gdq, self.jump_flag) != 0
+            batch_jumps = np.bitwise_and(batch_gdq, self.jump_flag) != 0
+            self.reconciliation = {
+                'matched': int(np.count_nonzero(stream_jumps & batch_jumps)),
+                'streaming_only': int(np.count_nonzero(stream_jumps & ~batch_jumps)),
+                'batch_only': int(np.count_nonzero(~stream_jumps & batch_jumps)),
+            }
+            log.info(f"Jumps flagged by the streaming and batch detection: {self.reconciliation}")
+        return gdq
+
+    def decide_unsettled(self):
+        """
+        Decide the pending differences of the pixels that never had four
+        usable differences, as in `find_crs`.
+        """
+        unsettled = self.pending & ~self.settled
+        self.pending[:] = False
+        if not np.any(unsettled):
+            return
+        median_diffs = calc_med_first_diffs(self.window)
+        sigma = np.sqrt(np.abs(median_diffs) + self.read_noise_frame)
+        ratio = np.where(unsettled, np.abs(self.window - median_diffs) / sigma, np.nan)
+        row, col = np.nonzero(np.any(~np.isnan(ratio), axis=0))
+        if len(row) == 0:
+            return
+        num_usable = np.sum(unsettled[:, row, col], axis=0)
+        slot = np.nanargmax(ratio[:, row, col], axis=0)
+        max_ratio = ratio[slot, row, col]
+        rej_thresh = rejection_thresholds(num_usable, self.rejection_thresh,
+                                          self.two_diff_rej_thresh, self.three_diff_rej_thresh)
+        jump = max_ratio > rej_thresh
+        self.add_jumps(self.window_group[slot[jump], row[jump], col[jump]], row[jump], col[jump],
+                       max_ratio[jump], self.window_neighbors[slot[jump], row[jump], col[jump]])
+
+    def add_jumps(self, groups, rows, cols, jump_ratio, jump_neighbors):
+        """
+        Record new jumps and the neighbors to flag with them, which are not
+        flagged if they are unusable in the group of the jump, as given by
+        the bits of `jump_neighbors`.
+        """
+        if self.flag_4_neighbors and len(rows) > 0:
+            nrows, ncols = self.window.shape[1:]
+            in_range = (jump_ratio < self.max_jump_to_flag_neighbors) & \
+                (jump_ratio > self.min_jump_to_flag_neighbors)
+            neighbors = []
+            for bit, (drow, dcol) in enumerate(NEIGHBORS):
+                flag = in_range & (np.bitwise_and(jump_neighbors, 1 << bit) == 0)
+                neighbors.append((groups[flag], rows[flag] + drow, cols[flag] + dcol))
+            groups = np.concatenate([groups] + [neighbor[0] for neighbor in neighbors])
+            rows = np.concatenate([rows] + [neighbor[1] for neighbor in neighbors])
+            cols = np.concatenate([cols] + [neighbor[2] for neighbor in neighbors])
+            inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+            groups, rows, cols = groups[inside], rows[inside], cols[inside]
+        jumps = (groups.astype(np.intp), rows.astype(np.intp), cols.astype(np.intp))
+        self.jumps.append(jumps)
+        return jumps
+
+    @staticmethod
+    def unusable_neighbors(unusable):
+        """
+        Mask of the neighbors of each pixel that are unusable, with one bit
+        for each neighbor in the order of `NEIGHBORS`.
+        """
+        neighbors = np.zeros(unusable.shape, dtype=np.uint8)
+        neighbors[1:, :] |= unusable[:-1, :].astype(np.uint8)
+        neighbors[:-1, :] |= unusable[1:, :].astype(np.uint8) << 1
+        neighbors[:, 1:] |= unusable[:, :-1].astype(np.uint8) << 2
+        neighbors[:, :-1] |= unusable[:, 1:].astype(np.uint8) << 3
+        return neighbors
+
+    @staticmethod
+    def no_jumps():
+        return tuple(np.zeros(0, dtype=np.intp) for _ in range(3))
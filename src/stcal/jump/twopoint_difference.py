@@ -13,13 +13,18 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
              after_jump_flag_n1=0,
              after_jump_flag_e2=0.0,
              after_jump_flag_n2=0,
-             copy_arrs=True):
+             copy_arrs=True,
+             after_jump_flag_method='mask',
+             precision='float64',
+             gain_2d=None,
+             prefilter=True):
 
     """
     Find CRs/Jumps in each integration within the input data array. The input
     data array is assumed to be in units of electrons, i.e. already multiplied
-    by the gain. We also assume that the read noise is in units of electrons.
-    We also assume that there are at least three groups in the integrations.
+    by the gain, unless `gain_2d` is given. We also assume that the read noise
+    is in units of electrons, unless `gain_2d` is given. We also assume that
+    there are at least three groups in the integrations.
     This was checked by jump_step before this routine is called.
 
     Parameters
@@ -83,6 +88,32 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
         Flag for making internal copies of the arrays so the input isn't modified,
         defaults to True.
 
+    after_jump_flag_method : str
+        Implementation used to flag groups after jumps: 'mask' (default)
+        propagates a mask of the large jumps along the group axis, 'loop'
+        flags the groups of each jump one at a time. Both give the same
+        flags; 'loop' is kept for validation.
+
+    precision : str
+        Floating point precision of the first differences, median differences,
+        sigma, e_jump and ratio arrays: 'float64' (default) or 'float32',
+        which halves the memory used by the temporary arrays of each
+        integration. The flags can differ for jumps within rounding errors of
+        the thresholds.
+
+    gain_2d : float, 2D array, optional
+        The gain of each pixel. If given, the data and read noise are in units
+        of DN and are converted to electrons one integration at a time, so the
+        input arrays are not modified and do not need to be copied.
+
+    prefilter : bool
+        If True (default), the median, sigma and ratio of the differences are
+        only computed for the pixels that can have a jump, found by
+        `cr_candidates`, and for the pixels that are already flagged as
+        jumps. The flags are the same, and the fraction of pruned pixels is
+        logged. When more than half the pixels of an integration are
+        candidates, all the pixels are processed.
+
     Returns
     -------
     gdq : int, 4D array
@@ -96,9 +127,16 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
 
     """
 
-    # copy data and group DQ array
+    if after_jump_flag_method not in ('mask', 'loop'):
+        raise ValueError(f"Unknown after_jump_flag_method: {after_jump_flag_method}")
+    if precision not in ('float64', 'float32'):
+        raise ValueError(f"Unknown precision: {precision}")
+
+    # copy data and group DQ array. The data is not copied when the gain is
+    # applied, since each integration is then a new array.
     if copy_arrs:
-        dataa = dataa.copy()
+        if gain_2d is None:
+            dataa = dataa.copy()
         gdq = group_dq.copy()
     else:
         gdq = group_dq
@@ -108,7 +146,12 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
     ndiffs = ngroups - 1
 
     # get readnoise, squared
+    if gain_2d is not None:
+        read_noise = apply_gain(read_noise, gain_2d)
+    if precision == 'float32':
+        read_noise = read_noise.astype(np.float32, copy=False)
     read_noise_2 = read_noise**2
+    read_noise_frame = read_noise_2 / nframes
 
     # create arrays for output
     row_above_gdq = np.zeros((nints, ngroups, ncols), dtype=np.uint8)
@@ -119,12 +162,21 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
     dnu_flag = dqflags["DO_NOT_USE"]
     jump_flag = dqflags["JUMP_DET"]
 
+    # array to store the median difference of each pixel
+    median_diffs = np.empty((nrows, ncols), dtype=precision)
+
+    # pixels whose largest ratio can't exceed the lowest threshold are pruned
+    min_rej_thresh = min(rejection_thresh, two_diff_rej_thresh, three_diff_rej_thresh)
+
     for integ in range(nints):
 
         log.info(f'Working on integration {integ + 1}:')
 
         # get data, gdq for this integration
-        dat = dataa[integ]
+        if gain_2d is None:
+            dat = dataa[integ]
+        else:
+            dat = apply_gain(dataa[integ], gain_2d)
         gdq_integ = gdq[integ]
 
         # set 'saturated' or 'do not use' pixels to nan in data
@@ -134,28 +186,29 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
         # calculate the differences between adjacent groups (first diffs)
         # use mask on data, so the results will have sat/donotuse groups masked
         first_diffs = np.diff(dat, axis=0)
-
-        # calc. the median of first_diffs for each pixel along the group axis
-        median_diffs = calc_med_first_diffs(first_diffs)
-
-        # calculate sigma for each pixel
-        sigma = np.sqrt(np.abs(median_diffs) + read_noise_2 / nframes)
-
-        # reset sigma so pxels with 0 readnoise are not flagged as jumps
-        sigma[np.where(sigma == 0.)] = np.nan
-
-        # compute 'ratio' for each group. this is the value that will be
-        # compared to 'threshold' to classify jumps. subtract the median of
-        # first_diffs from first_diffs, take the abs. value and divide by sigma.
-        e_jump = first_diffs - median_diffs[np.newaxis, :, :]
-        ratio = np.abs(e_jump) / sigma[np.newaxis, :, :]
+        if precision == 'float32':
+            first_diffs = first_diffs.astype(np.float32, copy=False)
+
+        # select the pixels to process. With the prefilter, the candidates are
+        # gathered along the last axis of `diffs`, and pixel_index gives the
+        # position of each pixel of the frame in it.
+        pixels, pixel_index = None, None
+        if prefilter:
+            pixels, pixel_index = prefilter_pixels(first_diffs, gdq_integ, read_noise_frame,
+                                                   min_rej_thresh, jump_flag)
+
+        # calculate the median, 'e_jump' and 'ratio' of the differences of
+        # each pixel. 'ratio' is the value that will be compared to
+        # 'threshold' to classify jumps.
+        diffs, rn_2, e_jump, ratio = calc_ratio(first_diffs, read_noise_2, nframes, precision,
+                                                pixels, out=median_diffs)
 
         # create a 2d array containing the value of the largest 'ratio' for each group
-        max_ratio = np.nanmax(ratio, axis=0)
+        max_ratio = np.nanmax(ratio, axis=0).astype(np.float64, copy=False)
 
         # now see if the largest ratio of all groups for each pixel exceeds the threshold.
         # there are different threshold for 4+, 3, and 2 usable groups
-        num_unusable_groups = np.sum(np.isnan(first_diffs), axis=0)
+        num_unusable_groups = np.sum(np.isnan(diffs), axis=0)
         row4cr, col4cr = np.where(np.logical_and(ndiffs - num_unusable_groups >= 4,
                                   max_ratio > rejection_thresh))
         row3cr, col3cr = np.where(np.logical_and(ndiffs - num_unusable_groups == 3,
@@ -174,137 +227,406 @@ def find_crs(dataa, group_dq, read_noise, rejection_thresh,
         # flag and clip the first CR found. recompute median/sigma/ratio
         # and repeat the above steps of comparing the max 'ratio' for each pixel
         # to the threshold to determine if another CR can be flagged and clipped.
-        # repeat this process until no more CRs are found.
-        for j in range(len(all_crs_row)):
-
-            # get arrays of abs(diffs), ratio, readnoise for this pixel
-            pix_first_diffs = first_diffs[:, all_crs_row[j], all_crs_col[j]]
-            pix_ratio = ratio[:, all_crs_row[j], all_crs_col[j]]
-            pix_rn2 = read_noise_2[all_crs_row[j], all_crs_col[j]]
-
-            # Create a mask to flag CRs. pix_cr_mask = 0 denotes a CR
-            pix_cr_mask = np.ones(pix_first_diffs.shape, dtype=bool)
-
-            # set the largest ratio as a CR
-            pix_cr_mask[np.nanargmax(pix_ratio)] = 0
-            new_CR_found = True
-
-            # loop and check for more CRs, setting the mask as you go and
-            # clipping the group with the CR. stop when no more CRs are found
-            # or there is only one two diffs left (which means there is
-            # actually one left, since the next CR will be masked after
-            # checking that condition)
-
-            while new_CR_found and ((ndiffs - np.sum(np.isnan(pix_first_diffs))) > 2):
-
-                new_CR_found = False
-
-                # set CRs to nans in first diffs to clip them
-                pix_first_diffs[~pix_cr_mask] = np.nan
-
-                # recalculate median, sigma, and ratio
-                new_pix_median_diffs = calc_med_first_diffs(pix_first_diffs)
-
-                new_pix_sigma = np.sqrt(np.abs(new_pix_median_diffs) + pix_rn2 / nframes)
-                new_pix_ratio = np.abs(pix_first_diffs - new_pix_median_diffs) / new_pix_sigma
-
-                # check if largest ratio exceeds threhold appropriate for num remaining groups
-
-                # select appropriate thresh. based on number of remaining groups
-                rej_thresh = rejection_thresh
-                if ndiffs - np.sum(np.isnan(pix_first_diffs)) == 3:
-                    rej_thresh = three_diff_rej_thresh
-                if ndiffs - np.sum(np.isnan(pix_first_diffs)) == 2:
-                    rej_thresh = two_diff_rej_thresh
-                new_pix_max_ratio_idx = np.nanargmax(new_pix_ratio)  # index of largest ratio
-                if new_pix_ratio[new_pix_max_ratio_idx] > rej_thresh:
-                    new_CR_found = True
-                    pix_cr_mask[new_pix_max_ratio_idx] = 0
-
-            # Found all CRs for this pix - set flags in input DQ array
-            gdq[integ, 1:, all_crs_row[j], all_crs_col[j]] = \
-                np.bitwise_or(gdq[integ, 1:, all_crs_row[j], all_crs_col[j]],
-                              dqflags["JUMP_DET"] * np.invert(pix_cr_mask))
-
-        if flag_4_neighbors:  # iterate over each 'jump' pixel
-            cr_group, cr_row, cr_col = np.where(np.bitwise_and(gdq[integ], jump_flag))
-
-            for j in range(len(cr_group)):
-
-                ratio_this_pix = ratio[cr_group[j] - 1, cr_row[j], cr_col[j]]
-
-                # Jumps must be in a certain range to have neighbors flagged
-                if ratio_this_pix < max_jump_to_flag_neighbors and \
-                        ratio_this_pix > min_jump_to_flag_neighbors:
-                    group = cr_group[j]
-                    row = cr_row[j]
-                    col = cr_col[j]
-
-                    # This section saves flagged neighbors that are above or
-                    # below the current range of row. If this method
-                    # running in a single process, the row above and below are
-                    # not used. If it is running in multiprocessing mode, then
-                    # the rows above and below need to be returned to
-                    # find_jumps to use when it reconstructs the full group dq
-                    # array from the slices.
-
-                    # Only flag adjacent pixels if they do not already have the
-                    # 'SATURATION' or 'DONOTUSE' flag set
-                    if row != 0:
-                        if (gdq[integ, group, row - 1, col] & sat_flag) == 0:
-                            if (gdq[integ, group, row - 1, col] & dnu_flag) == 0:
-                                gdq[integ, group, row - 1, col] =\
-                                    np.bitwise_or(gdq[integ, group, row - 1, col], jump_flag)
-                    else:
-                        row_below_gdq[integ, cr_group[j], cr_col[j]] = jump_flag
-
-                    if row != nrows - 1:
-                        if (gdq[integ, group, row + 1, col] & sat_flag) == 0:
-                            if (gdq[integ, group, row + 1, col] & dnu_flag) == 0:
-                                gdq[integ, group, row + 1, col] = \
-                                    np.bitwise_or(gdq[integ, group, row + 1, col], jump_flag)
-                    else:
-                        row_above_gdq[integ, cr_group[j], cr_col[j]] = jump_flag
-
-                    # Here we are just checking that we don't flag neighbors of
-                    # jumps that are off the detector.
-                    if cr_col[j] != 0:
-                        if (gdq[integ, group, row, col - 1] & sat_flag) == 0:
-                            if (gdq[integ, group, row, col - 1] & dnu_flag) == 0:
-                                gdq[integ, group, row, col - 1] =\
-                                    np.bitwise_or(gdq[integ, group, row, col - 1], jump_flag)
-
-                    if cr_col[j] != ncols - 1:
-                        if (gdq[integ, group, row, col + 1] & sat_flag) == 0:
-                            if (gdq[integ, group, row, col + 1] & dnu_flag) == 0:
-                                gdq[integ, group, row, col + 1] =\
-                                    np.bitwise_or(gdq[integ, group, row, col + 1], jump_flag)
+        # repeat this process until no more CRs are found. All pixels are
+        # processed together, dropping out as they converge.
+        if len(all_crs_row) > 0:
+            cr_mask = clip_crs(diffs[:, all_crs_row, all_crs_col],
+                               ratio[:, all_crs_row, all_crs_col],
+                               rn_2[all_crs_row, all_crs_col], nframes,
+                               rejection_thresh, two_diff_rej_thresh,
+                               three_diff_rej_thresh)
+            if pixels is not None:
+                all_crs_row, all_crs_col = pixels[0][all_crs_col], pixels[1][all_crs_col]
+
+            # Found all CRs for these pix - set flags in input DQ array
+            gdq_integ[1:, all_crs_row, all_crs_col] = \
+                np.bitwise_or(gdq_integ[1:, all_crs_row, all_crs_col],
+                              jump_flag * cr_mask)
+
+        if flag_4_neighbors:
+            # This saves flagged neighbors that are above or below the current
+            # range of rows. If this method is running in a single process,
+            # the row above and below are not used. If it is running in
+            # multiprocessing mode, then the rows above and below need to be
+            # returned to find_jumps to use when it reconstructs the full
+            # group dq array from the slices.
+            row_below_gdq[integ], row_above_gdq[integ] = \
+                flag_neighbors(gdq_integ, ratio, max_jump_to_flag_neighbors,
+                               min_jump_to_flag_neighbors, sat_flag, dnu_flag,
+                               jump_flag, pixel_index)
 
         # flag n groups after jumps above the specified thresholds to account for
         # the transient seen after ramp jumps
         flag_e_threshold = [after_jump_flag_e1, after_jump_flag_e2]
         flag_groups = [after_jump_flag_n1, after_jump_flag_n2]
 
-        cr_group, cr_row, cr_col = np.where(np.bitwise_and(gdq[integ], jump_flag))
+        cr_group, cr_row, cr_col = np.where(np.bitwise_and(gdq_integ, jump_flag))
+        if pixel_index is not None and max(flag_groups) > 0:
+            e_jump = add_e_jump(e_jump, pixel_index, first_diffs, cr_row, cr_col, precision)
+
         for cthres, cgroup in zip(flag_e_threshold, flag_groups):
             if cgroup > 0:
                 log.info(f"Flagging {cgroup} groups after detected jumps with e >= {np.mean(cthres)}.")
 
-                for j in range(len(cr_group)):
-                    group = cr_group[j]
-                    row = cr_row[j]
-                    col = cr_col[j]
-                    if e_jump[group - 1, row, col] >= cthres[row, col]:
-                        for kk in range(group, min(group + cgroup + 1, ngroups)):
-                            if (gdq[integ, kk, row, col] & sat_flag) == 0:
-                                if (gdq[integ, kk, row, col] & dnu_flag) == 0:
-                                    gdq[integ, kk, row, col] =\
-                                        np.bitwise_or(gdq[integ, kk, row, col], jump_flag)
+                if after_jump_flag_method == 'loop':
+                    flag_after_jumps_loop(gdq_integ, e_jump, cr_group, cr_row, cr_col,
+                                          cthres, cgroup, sat_flag, dnu_flag, jump_flag,
+                                          pixel_index)
+                else:
+                    flag_after_jumps(gdq_integ, e_jump, cr_group, cr_row, cr_col,
+                                     cthres, cgroup, sat_flag, dnu_flag, jump_flag,
+                                     pixel_index)
 
     return gdq, row_below_gdq, row_above_gdq
 
 
-def calc_med_first_diffs(first_diffs):
+def find_crs_sweep(dataa, group_dq, read_noise, settings, nframes,
+                   flag_4_neighbors, dqflags,
+                   after_jump_flag_e1=0.0,
+                   after_jump_flag_n1=0,
+                   after_jump_flag_e2=0.0,
+                   after_jump_flag_n2=0,
+                   return_flags=True,
+                   precision='float64',
+                   gain_2d=None):
+
+    """
+    Find CRs/Jumps with several settings of the thresholds, as if `find_crs`
+    was called with each of them, for the cost of about one call.
+
+    The differences, medians and ratios of each integration are computed
+    once, and the CRs are clipped once for the lowest thresholds of all the
+    settings. The group clipped in each pass doesn't depend on the
+    thresholds, so the CRs of each setting are found from the history of the
+    passes, before its neighbors and the groups after jumps are flagged.
+
+    Parameters
+    ----------
+    dataa : float, 4D array (num_ints, num_groups, num_rows,  num_cols)
+        input ramp data, in units of electrons unless `gain_2d` is given. It
+        is not modified.
+
+    group_dq : int, 4D array
+        group DQ flags, not modified
+
+    read_noise : float, 2D array
+        The read noise of each pixel
+
+    settings : list of dict
+        The settings to evaluate, each with the `find_crs` parameters
+        'rejection_thresh', 'two_diff_rej_thresh', 'three_diff_rej_thresh',
+        'max_jump_to_flag_neighbors' and 'min_jump_to_flag_neighbors'. The
+        three_grp_thresh and four_grp_thresh of `detect_jumps` are the
+        two_diff_rej_thresh and three_diff_rej_thresh.
+
+    nframes : int
+        The number of frames that are included in the group average
+
+    flag_4_neighbors : bool
+        if set to True, the four perpendicular neighbors of all detected
+        jumps are also flagged as a jump.
+
+    dqflags : dict
+        A dictionary with at least the following keywords:
+        DO_NOT_USE, SATURATED, JUMP_DET
+
+    after_jump_flag_e1, after_jump_flag_n1, after_jump_flag_e2, after_jump_flag_n2
+        flagging of the groups after jumps, as for `find_crs`
+
+    return_flags : bool
+        If True (default), return the group DQ array of each setting. If
+        False, only the numbers of CRs are returned, which saves the memory
+        of the group DQ arrays and the flagging of neighbors and groups after
+        jumps.
+
+    precision : str
+        Floating point precision of the temporary arrays, as for `find_crs`
+
+    gain_2d : float, 2D array, optional
+        The gain of each pixel, as for `find_crs`
+
+    Returns
+    -------
+    gdqs : list of int 4D arrays, or None
+        group DQ array of each setting, the same as returned by `find_crs`,
+        None if `return_flags` is False
+
+    cr_counts : int, 1D array (num_settings)
+        number of groups flagged as CRs by the two-point difference method
+        for each setting, without their neighbors and the groups after them
+    """
+
+    if precision not in ('float64', 'float32'):
+        raise ValueError(f"Unknown precision: {precision}")
+
+    nints, ngroups, nrows, ncols = dataa.shape
+    sat_flag = dqflags["SATURATED"]
+    dnu_flag = dqflags["DO_NOT_USE"]
+    jump_flag = dqflags["JUMP_DET"]
+
+    if gain_2d is not None:
+        read_noise = apply_gain(read_noise, gain_2d)
+    if precision == 'float32':
+        read_noise = read_noise.astype(np.float32, copy=False)
+    read_noise_2 = read_noise**2
+    read_noise_frame = read_noise_2 / nframes
+
+    # the history of the CRs is found for the lowest thresholds
+    thresh_names = ['rejection_thresh', 'two_diff_rej_thresh', 'three_diff_rej_thresh']
+    min_thresh = [min(setting[name] for setting in settings) for name in thresh_names]
+
+    gdqs = [group_dq.copy() for _ in settings] if return_flags else None
+    cr_counts = np.zeros(len(settings), dtype=np.int64)
+    median_diffs = np.empty((nrows, ncols), dtype=precision)
+    flag_e_threshold = [after_jump_flag_e1, after_jump_flag_e2]
+    flag_groups = [after_jump_flag_n1, after_jump_flag_n2]
+
+    for integ in range(nints):
+
+        log.info(f'Working on integration {integ + 1}:')
+
+        # get a copy of the data, with the 'saturated' or 'do not use'
+        # pixels set to nan, and its first differences
+        if gain_2d is None:
+            dat = dataa[integ].copy()
+        else:
+            dat = apply_gain(dataa[integ], gain_2d)
+        gdq_integ = group_dq[integ]
+        dat[np.bitwise_and(gdq_integ, sat_flag | dnu_flag) != 0] = np.nan
+        first_diffs = np.diff(dat, axis=0)
+        if precision == 'float32':
+            first_diffs = first_diffs.astype(np.float32, copy=False)
+
+        pixels, pixel_index = prefilter_pixels(first_diffs, gdq_integ, read_noise_frame,
+                                               min(min_thresh), jump_flag)
+        diffs, rn_2, e_jump, ratio = calc_ratio(first_diffs, read_noise_2, nframes, precision,
+                                                pixels, out=median_diffs)
+
+        # pixels with an initial CR for the lowest thresholds
+        max_ratio = np.nanmax(ratio, axis=0).astype(np.float64, copy=False)
+        num_usable = ngroups - 1 - np.sum(np.isnan(diffs), axis=0)
+        cr_row, cr_col = np.where(max_ratio > rejection_thresholds(num_usable, *min_thresh))
+        if len(cr_row) > 0:
+            history = clip_crs_history(diffs[:, cr_row, cr_col], ratio[:, cr_row, cr_col],
+                                       rn_2[cr_row, cr_col], nframes, *min_thresh)
+        if pixels is not None:
+            cr_row, cr_col = pixels[0][cr_col], pixels[1][cr_col]
+
+        for index, setting in enumerate(settings):
+            if len(cr_row) > 0:
+                cr_mask = accepted_crs(*history, *[setting[name] for name in thresh_names])
+                cr_counts[index] += np.count_nonzero(cr_mask)
+            if not return_flags:
+                continue
+
+            gdq_setting = gdqs[index][integ]
+            if len(cr_row) > 0:
+                gdq_setting[1:, cr_row, cr_col] = np.bitwise_or(gdq_setting[1:, cr_row, cr_col],
+                                                                jump_flag * cr_mask)
+            if flag_4_neighbors:
+                flag_neighbors(gdq_setting, ratio, setting['max_jump_to_flag_neighbors'],
+                               setting['min_jump_to_flag_neighbors'], sat_flag, dnu_flag,
+                               jump_flag, pixel_index)
+
+            jump_group, jump_row, jump_col = np.where(np.bitwise_and(gdq_setting, jump_flag))
+            if pixel_index is not None and max(flag_groups) > 0:
+                e_jump = add_e_jump(e_jump, pixel_index, first_diffs, jump_row, jump_col,
+                                    precision)
+            for cthres, cgroup in zip(flag_e_threshold, flag_groups):
+                if cgroup > 0:
+                    flag_after_jumps(gdq_setting, e_jump, jump_group, jump_row, jump_col,
+                                     cthres, cgroup, sat_flag, dnu_flag, jump_flag,
+                                     pixel_index)
+
+    return gdqs, cr_counts
+
+
+def apply_gain(arr, gain_2d):
+
+    """ Convert an array from DN to electrons.
+
+        Parameters
+        -----------
+        arr : float, array
+            array in units of DN, whose last two axes are rows and columns
+
+        gain_2d : float, 2D array
+            the gain of each pixel
+
+        Returns
+        -------
+        arr : float, array
+            a new array in units of electrons, with the dtype of the input,
+            as if it was multiplied by the gain in place
+        """
+
+    return np.multiply(arr, gain_2d).astype(arr.dtype, copy=False)
+
+
+def prefilter_pixels(first_diffs, gdq_integ, read_noise_frame, rejection_thresh,
+                     jump_flag):
+
+    """ Select the pixels of an integration that can have a jump, found by
+        `cr_candidates`, or that are flagged as jumps.
+
+        Parameters
+        -----------
+        first_diffs : float, 3D array (num_diffs, num_rows, num_cols)
+            first differences of the integration, with unusable groups set
+            to NaN
+
+        gdq_integ : int, 3D array (num_groups, num_rows, num_cols)
+            group DQ flags of the integration
+
+        read_noise_frame : float, 2D array (num_rows, num_cols)
+            read noise squared divided by the number of frames per group
+
+        rejection_thresh : float
+            the lowest cosmic ray sigma rejection threshold
+
+        jump_flag : int
+            DQ flag for jump detection
+
+        Returns
+        -------
+        pixels : tuple of int 1D arrays, or None
+            rows and columns of the selected pixels, or None if more than
+            half the pixels are selected, in which case it is faster to
+            process all of them
+
+        pixel_index : int, 2D array (num_rows, num_cols), or None
+            position of each pixel in the selected pixels, -1 if it is not
+            selected
+        """
+
+    nrows, ncols = read_noise_frame.shape
+    candidates = cr_candidates(first_diffs, read_noise_frame, rejection_thresh)
+    candidates |= np.bitwise_and(np.bitwise_or.reduce(gdq_integ, axis=0), jump_flag) > 0
+    cand_row, cand_col = np.nonzero(candidates)
+    log.info(f'Prefilter pruned {1 - len(cand_row) / (nrows * ncols):.1%} of the pixels.')
+    if 2 * len(cand_row) > nrows * ncols:
+        return None, None
+
+    pixel_index = np.full((nrows, ncols), -1, dtype=np.intp)
+    pixel_index[cand_row, cand_col] = np.arange(len(cand_row))
+    return (cand_row, cand_col), pixel_index
+
+
+def calc_ratio(first_diffs, read_noise_2, nframes, precision='float64', pixels=None,
+               out=None):
+
+    """ Calculate the median, sigma, e_jump and ratio of the differences of
+        each pixel.
+
+        Parameters
+        -----------
+        first_diffs : float, 3D array (num_diffs, num_rows, num_cols)
+            first differences of one integration, with unusable groups set
+            to NaN
+
+        read_noise_2 : float, 2D array (num_rows, num_cols)
+            read noise squared
+
+        nframes : int
+            The number of frames that are included in the group average
+
+        precision : str
+            'float64' or 'float32' precision of the median and sigma
+
+        pixels : tuple of int 1D arrays, optional
+            rows and columns of the pixels to process, which are gathered
+            along the last axis of the outputs. All pixels by default.
+
+        out : float, 2D array (num_rows, num_cols), optional
+            preallocated array for the median of all pixels
+
+        Returns
+        -------
+        diffs : float, 3D array (num_diffs, num_rows, num_cols)
+            the differences of the processed pixels, or (num_diffs, 1,
+            num_pix) for the selected pixels
+
+        read_noise_2 : float, 2D array
+            the read noise squared of the processed pixels
+
+        e_jump : float, 3D array
+            difference from the median difference
+
+        ratio : float, 3D array
+            absolute value of e_jump divided by sigma
+        """
+
+    if pixels is not None:
+        first_diffs = first_diffs[:, pixels[0], pixels[1]][:, np.newaxis, :]
+        read_noise_2 = read_noise_2[pixels][np.newaxis, :]
+        out = None
+    if out is None:
+        out = np.empty(read_noise_2.shape, dtype=precision)
+    read_noise_frame = read_noise_2 / nframes
+
+    # calc. the median of first_diffs for each pixel along the group axis
+    median_diffs = calc_med_first_diffs(first_diffs, out=out)
+
+    # calculate sigma for each pixel
+    sigma = np.sqrt(np.abs(median_diffs) + read_noise_frame)
+    if precision == 'float32':
+        sigma = sigma.astype(np.float32, copy=False)
+
+    # reset sigma so pxels with 0 readnoise are not flagged as jumps
+    sigma[np.where(sigma == 0.)] = np.nan
+
+    # subtract the median of first_diffs from first_diffs, take the abs.
+    # value and divide by sigma.
+    e_jump = first_diffs - median_diffs[np.newaxis, :, :]
+    ratio = np.abs(e_jump) / sigma[np.newaxis, :, :]
+
+    return first_diffs, read_noise_2, e_jump, ratio
+
+
+def add_e_jump(e_jump, pixel_index, first_diffs, row, col, precision='float64'):
+
+    """ Add the e_jump of the pixels that were not selected by
+        `prefilter_pixels`, such as the neighbors of jumps, to the e_jump of
+        the selected pixels.
+
+        Parameters
+        -----------
+        e_jump : float, 3D array (num_diffs, 1, num_pix)
+            e_jump of the selected pixels
+
+        pixel_index : int, 2D array (num_rows, num_cols)
+            position of each pixel in e_jump, -1 if it is not selected, which
+            is updated in place
+
+        first_diffs : float, 3D array (num_diffs, num_rows, num_cols)
+            first differences of the integration
+
+        row, col : int, 1D arrays
+            locations of the pixels that need an e_jump
+
+        precision : str
+            'float64' or 'float32' precision of the median
+
+        Returns
+        -------
+        e_jump : float, 3D array (num_diffs, 1, num_pix)
+            e_jump of the selected and the new pixels
+        """
+
+    ncols = pixel_index.shape[1]
+    new_row, new_col = np.divmod(np.unique(row * ncols + col), ncols)
+    new_pix = pixel_index[new_row, new_col] < 0
+    new_row, new_col = new_row[new_pix], new_col[new_pix]
+    if len(new_row) == 0:
+        return e_jump
+
+    new_diffs = first_diffs[:, new_row, new_col][:, np.newaxis, :]
+    new_med = calc_med_first_diffs(new_diffs, out=np.empty((1, len(new_row)), dtype=precision))
+    pixel_index[new_row, new_col] = e_jump.shape[-1] + np.arange(len(new_row))
+    return np.concatenate((e_jump, new_diffs - new_med[np.newaxis, :, :]), axis=-1)
+
+
+def calc_med_first_diffs(first_diffs, out=None):
 
     """ Calculate the median of `first diffs` along the group axis.
 
@@ -322,6 +644,10 @@ def calc_med_first_diffs(first_diffs):
             array containing the first differences of adjacent groups
             for a single integration. Can be 3d or 1d (for a single pix)
 
+        out : array, float, optional
+            preallocated 2d array where the medians are written when the
+            input is 3d
+
         Returns
         -------
         median_diffs : float or array, float
@@ -346,36 +672,607 @@ def calc_med_first_diffs(first_diffs):
             return np.nan
 
     # if input is multi-dimensional
+    nrows, ncols = first_diffs.shape[1:]
+    if out is None:
+        out = np.empty((nrows, ncols))  # array to store median for each pix
+
+    return clipped_median(first_diffs, out)
+
+
+def clipped_median(first_diffs, out, chunk_size=2**20):
+
+    """ Calculate the clipped median of `first_diffs` along the group axis.
+
+        This is the kernel used by `calc_med_first_diffs` for 3D arrays, and
+        gives the same results. The cube is processed in blocks of rows that
+        are copied into a single scratch buffer and partitioned in place, so
+        no copies are made for each class of usable groups. Pixels where
+        every group is usable take a fast path: the clipped difference is
+        either the smallest or the largest one, so the median is found from
+        a few order statistics. Pixels with unusable (NaN) groups are
+        gathered and processed separately.
+
+        Parameters
+        -----------
+        first_diffs : array, float (num_diffs, num_rows, num_cols)
+            array containing the first differences of adjacent groups
+            for a single integration. It is not modified.
+
+        out : array, float (num_rows, num_cols)
+            preallocated array where the median for each pixel is written
+
+        chunk_size : int
+            approximate number of elements of `first_diffs` to process at a
+            time, which sets the size of the scratch buffer
+
+        Returns
+        -------
+        out : array, float (num_rows, num_cols)
+            the median for each pixel
+        """
+
+    ndiffs, nrows, ncols = first_diffs.shape
+    rows_per_chunk = max(1, min(nrows, chunk_size // max(1, ndiffs * ncols)))
+    scratch = np.empty((ndiffs, rows_per_chunk, ncols), dtype=first_diffs.dtype)
+
+    # order statistics needed for the fast path: the smallest and largest
+    # values, and the middle values once either of them is clipped
+    num_med = ndiffs - 1
+    k_low, k_high = (num_med - 1) // 2, num_med // 2
+    kth = sorted({0, k_low, k_high, k_low + 1, k_high + 1, ndiffs - 1})
+
+    for row_start in range(0, nrows, rows_per_chunk):
+        row_stop = min(row_start + rows_per_chunk, nrows)
+        diffs = first_diffs[:, row_start:row_stop]
+        out_chunk = out[row_start:row_stop]
+
+        if ndiffs >= 4:  # clip largest abs. value and return median
+            buf = scratch[:, :row_stop - row_start]
+            np.copyto(buf, diffs)
+            buf.partition(kth, axis=0)
+            vmin, vmax = buf[0], buf[-1]
+            abs_min, abs_max = np.abs(vmin), np.abs(vmax)
+            clip_max = abs_max > abs_min
+
+            # when the smallest and largest values have the same abs. value
+            # the first of them along the group axis is clipped
+            tie = np.logical_and(abs_max == abs_min, vmax != vmin)
+            if np.any(tie):
+                tie_diffs = diffs[:, tie]
+                first_max = tie_diffs[np.argmax(np.abs(tie_diffs), axis=0),
+                                      np.arange(tie_diffs.shape[1])]
+                clip_max[tie] = first_max == vmax[tie]
+
+            out_chunk[...] = np.where(clip_max, (buf[k_low] + buf[k_high]) / 2,
+                                      (buf[k_low + 1] + buf[k_high + 1]) / 2)
+        elif ndiffs == 3:  # no clipping just return median
+            buf = scratch[:, :row_stop - row_start]
+            np.copyto(buf, diffs)
+            buf.partition(1, axis=0)
+            out_chunk[...] = buf[1]
+        elif ndiffs == 2:  # return diff with the smaller abs. value
+            out_chunk[...] = np.where(np.abs(diffs[0]) >= np.abs(diffs[1]),
+                                      diffs[1], diffs[0])
+        else:
+            out_chunk[...] = np.nan
+
+        # pixels with unusable groups
+        has_nan = np.any(np.isnan(diffs), axis=0)
+        if np.any(has_nan):
+            out_chunk[has_nan] = clipped_median_masked(diffs[:, has_nan])
+
+    return out
+
+
+def clipped_median_masked(first_diffs):
+
+    """ Calculate the clipped median of `first_diffs` for pixels that have
+        unusable (NaN) groups.
+
+        The same rules as `calc_med_first_diffs` are applied to each pixel
+        based on its number of usable groups.
+
+        Parameters
+        -----------
+        first_diffs : array, float (num_diffs, num_pix)
+            array containing the first differences of adjacent groups for a
+            set of pixels
+
+        Returns
+        -------
+        median_diffs : array, float (num_pix)
+            the median for each pixel, NaN if there are fewer than two usable
+            groups
+        """
+
+    ndiffs, npix = first_diffs.shape
+    pix = np.arange(npix)
+    nans = np.isnan(first_diffs)
+    num_usable_groups = ndiffs - np.sum(nans, axis=0)
+
+    # clip the largest abs. value if there are 4+ usable groups, and the
+    # larger one if there are 2 (keeping the other as the median)
+    clip = np.logical_or(num_usable_groups >= 4, num_usable_groups == 2)
+    diffs = first_diffs.copy()
+    abs_diffs = np.abs(diffs[:, clip])
+    abs_diffs[nans[:, clip]] = -np.inf
+    diffs[np.argmax(abs_diffs, axis=0), pix[clip]] = np.nan
+
+    diffs.sort(axis=0)
+    num_med = num_usable_groups - clip
+    low = diffs[np.maximum(num_med - 1, 0) // 2, pix]
+    high = diffs[num_med // 2, pix]
+    median_diffs = np.where(num_med == 1, high, (low + high) / 2)
+
+    # set the medians all groups with less than 2 usable groups to nan to skip
+    # further calculations for these pixels
+    median_diffs[num_usable_groups < 2] = np.nan
+
+    return median_diffs
+
+
+def flag_neighbors(gdq_integ, ratio, max_jump_to_flag_neighbors,
+                   min_jump_to_flag_neighbors, sat_flag, dnu_flag, jump_flag,
+                   pixel_index=None):
+
+    """ Flag the four perpendicular neighbors of each jump as a jump.
+
+        Only jumps with a ratio between `min_jump_to_flag_neighbors` and
+        `max_jump_to_flag_neighbors` have their neighbors flagged, and
+        neighbors that are already flagged as saturated or do not use are
+        left unchanged. Each group is processed by shifting the mask of jumps
+        to flag one pixel in each of the four directions.
+
+        Parameters
+        -----------
+        gdq_integ : int, 3D array (num_groups, num_rows, num_cols)
+            group DQ flags of one integration, modified in place
+
+        ratio : float, 3D array (num_diffs, num_rows, num_cols)
+            ratio of each difference, used to select the jumps to expand
+
+        max_jump_to_flag_neighbors : float
+            value in units of sigma that sets the upper limit for flagging of
+            neighbors.
+
+        min_jump_to_flag_neighbors : float
+            value in units of sigma that sets the lower limit for flagging of
+            neighbors.
+
+        sat_flag : int
+            DQ flag for saturation
+
+        dnu_flag : int
+            DQ flag for do not use
+
+        jump_flag : int
+            DQ flag for jump detection
+
+        pixel_index : int, 2D array (num_rows, num_cols), optional
+            position of each pixel along the last axis of `ratio`, when it
+            holds only some pixels. See `diff_values`.
+
+        Returns
+        -------
+        row_below_gdq : int, 2D array (num_groups, num_cols)
+            neighbors of jumps in the first row, which fall below the array
+
+        row_above_gdq : int, 2D array (num_groups, num_cols)
+            neighbors of jumps in the last row, which fall above the array
+        """
+
+    ngroups, nrows, ncols = gdq_integ.shape
+    row_below_gdq = np.zeros((ngroups, ncols), dtype=np.uint8)
+    row_above_gdq = np.zeros((ngroups, ncols), dtype=np.uint8)
+
+    for group in range(ngroups):
+        jump_row, jump_col = np.where(np.bitwise_and(gdq_integ[group], jump_flag))
+        if len(jump_row) == 0:
+            continue
+
+        # Jumps must be in a certain range to have neighbors flagged. The
+        # ratio of a jump in the first group comes from the last difference.
+        jump_ratio = diff_values(ratio, group - 1, jump_row, jump_col,
+                                 pixel_index).astype(np.float64)
+        in_range = np.logical_and(jump_ratio < max_jump_to_flag_neighbors,
+                                  jump_ratio > min_jump_to_flag_neighbors)
+        expand = np.zeros((nrows, ncols), dtype=bool)
+        expand[jump_row[in_range], jump_col[in_range]] = True
+
+        neighbors = np.zeros((nrows, ncols), dtype=bool)
+        neighbors[:-1, :] |= expand[1:, :]
+        neighbors[1:, :] |= expand[:-1, :]
+        neighbors[:, :-1] |= expand[:, 1:]
+        neighbors[:, 1:] |= expand[:, :-1]
+
+        # Only flag adjacent pixels if they do not already have the
+        # 'SATURATION' or 'DONOTUSE' flag set
+        neighbors &= np.bitwise_and(gdq_integ[group], sat_flag | dnu_flag) == 0
+        gdq_integ[group][neighbors] = np.bitwise_or(gdq_integ[group][neighbors], jump_flag)
+
+        row_below_gdq[group, expand[0, :]] = jump_flag
+        row_above_gdq[group, expand[-1, :]] = jump_flag
+
+    return row_below_gdq, row_above_gdq
+
+
+def cr_candidates(first_diffs, read_noise_frame, rejection_thresh):
+
+    """ Find the pixels whose largest ratio can exceed a rejection threshold.
+
+        The median difference of a pixel is between its smallest and largest
+        usable differences, so the ratio of each difference is at most the
+        range of the differences divided by the smallest sigma the median
+        allows. The pixels where this bound is below the threshold can't have
+        a jump. The bound is loosened slightly to allow for rounding errors.
+
+        Parameters
+        -----------
+        first_diffs : array, float (num_diffs, num_rows, num_cols)
+            first differences of one integration, with unusable groups set
+            to NaN
+
+        read_noise_frame : array, float (num_rows, num_cols)
+            read noise squared divided by the number of frames per group
+
+        rejection_thresh : float
+            the lowest cosmic ray sigma rejection threshold
+
+        Returns
+        -------
+        candidates : array, bool (num_rows, num_cols)
+            True for the pixels that can have a jump
+        """
+
+    max_diffs = np.fmax.reduce(first_diffs, axis=0).astype(np.float64)
+    min_diffs = np.fmin.reduce(first_diffs, axis=0).astype(np.float64)
+    min_abs_median = np.maximum(np.maximum(min_diffs, -max_diffs), 0)
+    min_sigma = np.sqrt(min_abs_median + read_noise_frame)
+    return (max_diffs - min_diffs) * (1 + 1e-4) > rejection_thresh * min_sigma
+
+
+def diff_values(diffs, group, row, col, pixel_index=None):
+
+    """ Get the values of an array of differences at groups, rows and columns.
+
+        Parameters
+        -----------
+        diffs : array, float (num_diffs, num_rows, num_cols)
+            differences of all the pixels, or of (num_diffs, 1, num_pix) for
+            some pixels when `pixel_index` is given
+
+        group, row, col : int or int arrays
+            locations of the values
+
+        pixel_index : int, 2D array (num_rows, num_cols), optional
+            position of each pixel along the last axis of `diffs`
+
+        Returns
+        -------
+        values : float or float array
+            the values at the locations
+        """
+
+    if pixel_index is None:
+        return diffs[group, row, col]
+    return diffs[group, 0, pixel_index[row, col]]
+
+
+def flag_after_jumps(gdq_integ, e_jump, cr_group, cr_row, cr_col, cthres,
+                     cgroup, sat_flag, dnu_flag, jump_flag, pixel_index=None):
+
+    """ Flag the groups after jumps above a threshold as jumps.
+
+        The groups with a jump of at least `cthres` are marked in a mask,
+        which is propagated `cgroup` groups along the group axis as the
+        difference of its cumulative sum over a sliding window. Groups that
+        are flagged as saturated or do not use are left unchanged.
+
+        Parameters
+        -----------
+        gdq_integ : int, 3D array (num_groups, num_rows, num_cols)
+            group DQ flags of one integration, modified in place
+
+        e_jump : float, 3D array (num_diffs, num_rows, num_cols)
+            amplitude of each difference relative to the median difference
+
+        cr_group, cr_row, cr_col : int, 1D arrays
+            locations of the jumps
+
+        cthres : float, 2D array (num_rows, num_cols)
+            minimum jump amplitude for flagging subsequent groups
+
+        cgroup : int
+            number of groups after each jump to flag
+
+        sat_flag : int
+            DQ flag for saturation
+
+        dnu_flag : int
+            DQ flag for do not use
+
+        jump_flag : int
+            DQ flag for jump detection
+
+        pixel_index : int, 2D array (num_rows, num_cols), optional
+            position of each pixel along the last axis of `e_jump`, when it
+            holds only some pixels. See `diff_values`.
+        """
+
+    ngroups, nrows, ncols = gdq_integ.shape
+
+    # select the jumps above the threshold, comparing in double precision
+    # as was done for one jump at a time
+    large = diff_values(e_jump, cr_group - 1, cr_row, cr_col, pixel_index).astype(np.float64) >= \
+        cthres[cr_row, cr_col].astype(np.float64)
+    if not np.any(large):
+        return
+
+    # work only on the pixels that have a large jump
+    pix, pix_index = np.unique(cr_row[large] * ncols + cr_col[large], return_inverse=True)
+    rows, cols = np.divmod(pix, ncols)
+    large_mask = np.zeros((ngroups, len(pix)), dtype=bool)
+    large_mask[cr_group[large], pix_index] = True
+
+    # a group is flagged if there is a large jump in it or in any of the
+    # cgroup groups before it
+    num_large = np.cumsum(large_mask, axis=0, dtype=np.int32)
+    num_in_window = num_large.copy()
+    if cgroup + 1 < ngroups:
+        num_in_window[cgroup + 1:] -= num_large[:-(cgroup + 1)]
+
+    pix_gdq = gdq_integ[:, rows, cols]
+    after_jump = np.logical_and(num_in_window > 0,
+                                np.bitwise_and(pix_gdq, sat_flag | dnu_flag) == 0)
+    gdq_integ[:, rows, cols] = np.bitwise_or(pix_gdq, jump_flag * after_jump)
+
+
+def flag_after_jumps_loop(gdq_integ, e_jump, cr_group, cr_row, cr_col, cthres,
+                          cgroup, sat_flag, dnu_flag, jump_flag, pixel_index=None):
+
+    """ Flag the groups after jumps above a threshold as jumps, one jump at a
+        time.
+
+        This gives the same result as `flag_after_jumps`, and is kept to
+        validate it. See `flag_after_jumps` for the parameters.
+        """
+
+    ngroups = gdq_integ.shape[0]
+    for j in range(len(cr_group)):
+        group = cr_group[j]
+        row = cr_row[j]
+        col = cr_col[j]
+        if diff_values(e_jump, group - 1, row, col, pixel_index) >= cthres[row, col]:
+            for kk in range(group, min(group + cgroup + 1, ngroups)):
+                if (gdq_integ[kk, row, col] & sat_flag) == 0:
+                    if (gdq_integ[kk, row, col] & dnu_flag) == 0:
+                        gdq_integ[kk, row, col] = \
+                            np.bitwise_or(gdq_integ[kk, row, col], jump_flag)
+
+
+def clip_crs(first_diffs, ratio, read_noise_2, nframes, rejection_thresh,
+             two_diff_rej_thresh, three_diff_rej_thresh):
+
+    """ Iteratively flag and clip CRs for a set of pixels with an initial CR.
+
+        The group with the largest ratio of each pixel is flagged as a CR.
+        Each pass then clips the CRs found so far, recomputes the median,
+        sigma and ratio, and flags the group with the largest new ratio if it
+        exceeds the threshold appropriate for the number of remaining groups.
+        All still-active pixels are processed together in each pass; a pixel
+        drops out once no new CR is found or only two differences remain.
+
+        Parameters
+        -----------
+        first_diffs : float, 2D array (num_diffs, num_pix)
+            first differences of the pixels to process, with unusable groups
+            set to NaN
+
+        ratio : float, 2D array (num_diffs, num_pix)
+            initial ratio of each difference for the pixels to process
+
+        read_noise_2 : float, 1D array (num_pix)
+            read noise squared of the pixels to process
+
+        nframes : int
+            The number of frames that are included in the group average
+
+        rejection_thresh : float
+            cosmic ray sigma rejection threshold
+
+        two_diff_rej_thresh : float
+            cosmic ray sigma rejection threshold for ramps having 3 groups
+
+        three_diff_rej_thresh : float
+            cosmic ray sigma rejection threshold for ramps having 4 groups
+
+        Returns
+        -------
+        cr_mask : bool, 2D array (num_diffs, num_pix)
+            True for each difference flagged as a CR
+        """
+
+    cr_pass = clip_crs_history(first_diffs, ratio, read_noise_2, nframes, rejection_thresh,
+                               two_diff_rej_thresh, three_diff_rej_thresh)[0]
+    return cr_pass >= 0
+
+
+def clip_crs_history(first_diffs, ratio, read_noise_2, nframes, rejection_thresh,
+                     two_diff_rej_thresh, three_diff_rej_thresh):
+
+    """ Iteratively flag and clip CRs as `clip_crs`, and record the passes.
+
+        The group clipped in each pass does not depend on the thresholds,
+        which only decide when a pixel drops out. So the history of the
+        passes for the lowest thresholds gives the CRs for any higher
+        thresholds with `accepted_crs`. See `clip_crs` for the parameters.
+
+        Returns
+        -------
+        cr_pass : int, 2D array (num_diffs, num_pix)
+            pass in which each difference was flagged as a CR, -1 if it
+            was not. The initial CR is flagged in pass 0.
+
+        pass_ratio : float, 2D array (num_passes, num_pix)
+            largest ratio of each pass, in double precision, NaN after the
+            last pass of a pixel
+
+        pass_usable : int, 2D array (num_passes, num_pix)
+            number of usable differences of each pass, after clipping the CRs
+            of the previous passes
+        """
+
+    ndiffs, npix = first_diffs.shape
+    first_diffs = first_diffs.copy()
+
+    # set the largest ratio as a CR
+    cr_pass = np.full(first_diffs.shape, -1, dtype=np.int32)
+    max_ratio_idx = np.nanargmax(ratio, axis=0)
+    cr_pass[max_ratio_idx, np.arange(npix)] = 0
+    pass_ratio = [ratio[max_ratio_idx, np.arange(npix)].astype(np.float64)]
+    pass_usable = [ndiffs - np.sum(np.isnan(first_diffs), axis=0)]
+
+    # keep iterating on pixels while there are more than two usable
+    # differences before clipping the CR found in the previous pass
+    active = np.arange(npix)
+    while len(active) > 0:
+        active_diffs = first_diffs[:, active]
+        active = active[ndiffs - np.sum(np.isnan(active_diffs), axis=0) > 2]
+        if len(active) == 0:
+            break
+
+        # set CRs to nans in first diffs to clip them
+        active_diffs = first_diffs[:, active]
+        active_diffs[cr_pass[:, active] >= 0] = np.nan
+        first_diffs[:, active] = active_diffs
+
+        # recalculate median, sigma, and ratio. sigma is calculated in double
+        # precision and cast back, as was done for one pixel at a time.
+        new_median_diffs = calc_med_first_diffs_pixels(active_diffs)
+        new_sigma = np.sqrt(np.abs(new_median_diffs).astype(np.float64) +
+                            read_noise_2[active].astype(np.float64) / nframes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_ratio = np.abs(active_diffs - new_median_diffs) / \
+                new_sigma.astype(active_diffs.dtype)
+
+        # select appropriate thresh. based on number of remaining groups
+        num_usable = ndiffs - np.sum(np.isnan(active_diffs), axis=0)
+        rej_thresh = rejection_thresholds(num_usable, rejection_thresh, two_diff_rej_thresh,
+                                          three_diff_rej_thresh)
+
+        # check if largest ratio exceeds threshold
+        max_ratio_idx = np.nanargmax(new_ratio, axis=0)
+        max_ratio = new_ratio[max_ratio_idx, np.arange(len(active))].astype(np.float64)
+        new_cr_found = max_ratio > rej_thresh
+        cr_pass[max_ratio_idx[new_cr_found], active[new_cr_found]] = len(pass_ratio)
+
+        pass_ratio.append(np.full(npix, np.nan))
+        pass_ratio[-1][active] = max_ratio
+        pass_usable.append(np.zeros(npix, dtype=pass_usable[0].dtype))
+        pass_usable[-1][active] = num_usable
+        active = active[new_cr_found]
+
+    return cr_pass, np.array(pass_ratio), np.array(pass_usable)
+
+
+def accepted_crs(cr_pass, pass_ratio, pass_usable, rejection_thresh,
+                 two_diff_rej_thresh, three_diff_rej_thresh):
+
+    """ Find the CRs flagged by `clip_crs` for a set of thresholds, from the
+        history of the passes of `clip_crs_history` for the same or lower
+        thresholds.
+
+        The passes of a pixel are accepted until the largest ratio of a pass
+        does not exceed the threshold for its number of usable differences,
+        including the initial CR of pass 0.
+
+        Parameters
+        -----------
+        cr_pass, pass_ratio, pass_usable : 2D arrays
+            history of the passes returned by `clip_crs_history`
+
+        rejection_thresh : float
+            cosmic ray sigma rejection threshold
+
+        two_diff_rej_thresh : float
+            cosmic ray sigma rejection threshold for ramps having 3 groups
+
+        three_diff_rej_thresh : float
+            cosmic ray sigma rejection threshold for ramps having 4 groups
+
+        Returns
+        -------
+        cr_mask : bool, 2D array (num_diffs, num_pix)
+            True for each difference flagged as a CR
+        """
+
+    rej_thresh = rejection_thresholds(pass_usable, rejection_thresh, two_diff_rej_thresh,
+                                      three_diff_rej_thresh)
+    num_accepted = np.sum(np.logical_and.accumulate(pass_ratio > rej_thresh, axis=0), axis=0)
+    return np.logical_and(cr_pass >= 0, cr_pass < num_accepted)
+
+
+def rejection_thresholds(num_usable, rejection_thresh, two_diff_rej_thresh,
+                         three_diff_rej_thresh):
+
+    """ Select the rejection threshold for each number of usable differences:
+        `rejection_thresh` for 4 or more, `three_diff_rej_thresh` for 3,
+        `two_diff_rej_thresh` for 2, and infinity for fewer, which can't have
+        a CR.
+        """
+
+    rej_thresh = np.full(num_usable.shape, rejection_thresh, dtype=np.float64)
+    rej_thresh[num_usable == 3] = three_diff_rej_thresh
+    rej_thresh[num_usable == 2] = two_diff_rej_thresh
+    rej_thresh[num_usable < 2] = np.inf
+    return rej_thresh
+
+
+def calc_med_first_diffs_pixels(first_diffs):
+
+    """ Calculate the median of `first diffs` for each pixel of a 2D array.
+
+        This gives the same result as calling `calc_med_first_diffs` on each
+        pixel (column) separately.
+
+        Parameters
+        -----------
+        first_diffs : array, float (num_diffs, num_pix)
+            array containing the first differences of adjacent groups for a
+            set of pixels
+
+        Returns
+        -------
+        median_diffs : array, float (num_pix)
+            the median for each pixel, NaN if there are fewer than two usable
+            groups
+        """
 
-    ngroups, nrows, ncols = first_diffs.shape
-    num_usable_groups = ngroups - np.sum(np.isnan(first_diffs), axis=0)
-    median_diffs = np.zeros((nrows, ncols))  # empty array to store median for each pix
-
-    # process groups with >=4 usable groups
-    row4, col4 = np.where(num_usable_groups >= 4)  # locations of >= 4 usable group pixels
-    if len(row4) > 0:
-        four_slice = first_diffs[:, row4, col4]
-        four_slice[np.nanargmax(np.abs(four_slice), axis=0),
-                   np.arange(four_slice.shape[1])] = np.nan  # mask largest group in slice
-        median_diffs[row4, col4] = np.nanmedian(four_slice, axis=0)  # add median to return arr for these pix
-
-    # process groups with 3 usable groups
-    row3, col3 = np.where(num_usable_groups == 3)  # locations of >= 4 usable group pixels
-    if len(row3) > 0:
-        three_slice = first_diffs[:, row3, col3]
-        median_diffs[row3, col3] = np.nanmedian(three_slice, axis=0)  # add median to return arr for these pix
-
-    # process groups with 2 usable groups
-    row2, col2 = np.where(num_usable_groups == 2)  # locations of >= 4 usable group pixels
-    if len(row2) > 0:
-        two_slice = first_diffs[:, row2, col2]
-        two_slice[np.nanargmax(np.abs(two_slice), axis=0),
-                  np.arange(two_slice.shape[1])] = np.nan  # mask larger abs. val
-        median_diffs[row2, col2] = np.nanmin(two_slice, axis=0)  # add med. to return arr
-
-    # set the medians all groups with less than 2 usable groups to nan to skip further
-    # calculations for these pixels
-    row_none, col_none = np.where(num_usable_groups < 2)
-    median_diffs[row_none, col_none] = np.nan
+    ndiffs, npix = first_diffs.shape
+    pix = np.arange(npix)
+    nans = np.isnan(first_diffs)
+    num_usable_groups = ndiffs - np.sum(nans, axis=0)
+    median_diffs = np.full(npix, np.nan, dtype=first_diffs.dtype)
+
+    # if 4+, clip largest and return median; if 3, return median
+    med_pix = np.where(num_usable_groups >= 3)[0]
+    if len(med_pix) > 0:
+        med_slice = first_diffs[:, med_pix]
+        clip = num_usable_groups[med_pix] >= 4
+        abs_slice = np.abs(med_slice)
+        abs_slice[nans[:, med_pix]] = -np.inf
+        med_slice[np.argmax(abs_slice[:, clip], axis=0), np.where(clip)[0]] = np.nan
+        med_slice.sort(axis=0)
+        num_med = num_usable_groups[med_pix] - clip
+        low = med_slice[(num_med - 1) // 2, np.arange(len(med_pix))]
+        high = med_slice[num_med // 2, np.arange(len(med_pix))]
+        median_diffs[med_pix] = np.where(num_med % 2 == 1, high, (low + high) / 2)
+
+    # if 2, return diff with minimum abs
+    two_pix = pix[num_usable_groups == 2]
+    if len(two_pix) > 0:
+        two_slice = first_diffs[:, two_pix]
+        median_diffs[two_pix] = \
+            two_slice[np.nanargmin(np.abs(two_slice), axis=0), np.arange(len(two_pix))]
 
     return median_diffs
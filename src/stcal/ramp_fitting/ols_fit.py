@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+import functools
 import logging
 from multiprocessing.pool import Pool as Pool
 import numpy as np
@@ -16,12 +17,18 @@ log.setLevel(logging.DEBUG)
 
 BUFSIZE = 1024 * 300000  # 300Mb cache size for data section
 
+# Weighting exponents of calc_power, for increasing SNR, and the largest
+#   number of groups for which the optimal weights are tabulated
+WEIGHT_POWERS = (0., 0.4, 1., 3., 6., 10.)
+MAX_WEIGHT_TABLE_NGROUPS = 256
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
 def ols_ramp_fit_multi(
-        ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting, max_cores):
+        ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting, max_cores,
+        ols_engine="iterative"):
     """
     Setup the inputs to ols_ramp_fit with and without multiprocessing. The
     inputs will be sliced into the number of cores that are being used for
@@ -59,6 +66,10 @@ def ols_ramp_fit_multi(
         'half', and 'all'. This is the fraction of cores to use for multi-proc. The
         total number of cores includes the SMT cores (Hyper Threading for Intel).
 
+    ols_engine : str
+        'iterative' fits the next segment of all pixels in each iteration;
+        'table' fits all the segments at once from a table of segments.
+
     Returns
     -------
     image_info : tuple
@@ -98,7 +109,7 @@ def ols_ramp_fit_multi(
     if number_slices == 1:
         # Single threaded computation
         image_info, integ_info, opt_info = ols_ramp_fit_single(
-            ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting)
+            ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting, ols_engine)
         if image_info is None or integ_info is None:
             return None, None, None
 
@@ -108,14 +119,14 @@ def ols_ramp_fit_multi(
     else:
         image_info, integ_info, opt_info = ols_ramp_fit_multiprocessing(
             ramp_data, buffsize, save_opt,
-            readnoise_2d, gain_2d, weighting, number_slices)
+            readnoise_2d, gain_2d, weighting, number_slices, ols_engine)
 
         return image_info, integ_info, opt_info
 
 
 def ols_ramp_fit_multiprocessing(
         ramp_data, buffsize, save_opt,
-        readnoise_2d, gain_2d, weighting, number_slices):
+        readnoise_2d, gain_2d, weighting, number_slices, ols_engine="iterative"):
     """
     Fit a ramp using ordinary least squares. Calculate the count rate for each
     pixel in all data cube sections and all integrations, equal to the weighted
@@ -146,6 +157,9 @@ def ols_ramp_fit_multiprocessing(
     number_slices: int
         The number of slices to partition the data into for multiprocessing.
 
+    ols_engine : str
+        'iterative' or 'table', the engine fitting the segments
+
     Return
     ------
     image_info: tuple
@@ -160,7 +174,7 @@ def ols_ramp_fit_multiprocessing(
     log.info(f"Number of processors used for multiprocessing: {number_slices}")
     slices, rows_per_slice = compute_slices_for_starmap(
         ramp_data, buffsize, save_opt,
-        readnoise_2d, gain_2d, weighting, number_slices)
+        readnoise_2d, gain_2d, weighting, number_slices, ols_engine)
 
     pool = Pool(processes=number_slices)
     pool_results = pool.starmap(ols_ramp_fit_single, slices)
@@ -428,7 +442,7 @@ def get_max_segs_crs(pool_results):
 
 def compute_slices_for_starmap(
         ramp_data, buffsize, save_opt,
-        readnoise_2d, gain_2d, weighting, number_slices):
+        readnoise_2d, gain_2d, weighting, number_slices, ols_engine="iterative"):
     """
     Creates the slices needed for each process for multiprocessing.  The slices
     for the arguments needed for ols_ramp_fit_single.
@@ -454,6 +468,9 @@ def compute_slices_for_starmap(
     number_slices: int
         The number of slices to partition the data into for multiprocessing.
 
+    ols_engine : str
+        'iterative' or 'table', the engine fitting the segments
+
     Return
     ------
     slices : list
@@ -473,7 +490,7 @@ def compute_slices_for_starmap(
         slices.insert(
             k,
             (ramp_slice, buffsize, save_opt,
-             rnoise_slice, gain_slice, weighting))
+             rnoise_slice, gain_slice, weighting, ols_engine))
         start_row = start_row + rslices[k]
 
     return slices, rslices
@@ -612,7 +629,8 @@ def find_0th_one_good_group(ramp_data):
 
 
 def ols_ramp_fit_single(
-        ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting):
+        ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting,
+        ols_engine="iterative"):
     """
     Fit a ramp using ordinary least squares. Calculate the count rate for each
     pixel in all data cube sections and all integrations, equal to the weighted
@@ -639,6 +657,9 @@ def ols_ramp_fit_single(
     weighting : str
         'optimal' is the only valid value
 
+    ols_engine : str
+        'iterative' or 'table', the engine fitting the segments
+
     Return
     ------
     image_info : tuple
@@ -664,6 +685,10 @@ def ols_ramp_fit_single(
             ramp_data.zframe_locs = zframe_locs
             ramp_data.cnt = cnt
 
+    # Find the ramps without flagged groups, which are fit directly instead
+    #   of with the segment logic
+    clean_ramps = find_clean_ramps(ramp_data)
+
     # Save original shapes for writing to log file, as these may change for MIRI
     n_int, ngroups, nrows, ncols = ramp_data.data.shape
     orig_ngroups = ngroups
@@ -681,7 +706,7 @@ def ols_ramp_fit_single(
     #   saturated groups have already been flagged. The actual, fit, slopes for
     #   each segment are also calculated here.
     fit_slopes_ans = ramp_fit_slopes(
-        ramp_data, gain_2d, readnoise_2d, save_opt, weighting)
+        ramp_data, gain_2d, readnoise_2d, save_opt, weighting, ols_engine, clean_ramps)
     if fit_slopes_ans[0] == "saturated":
         return fit_slopes_ans[1:]
 
@@ -798,7 +823,8 @@ def discard_miri_groups(ramp_data):
     return True
 
 
-def ramp_fit_slopes(ramp_data, gain_2d, readnoise_2d, save_opt, weighting):
+def ramp_fit_slopes(ramp_data, gain_2d, readnoise_2d, save_opt, weighting,
+                    ols_engine="iterative", clean_ramps=None):
     """
     Calculate effective integration time (once EFFINTIM has been populated accessible, will
     use that instead), and other keywords that will needed if the pedestal calculation is
@@ -823,6 +849,14 @@ def ramp_fit_slopes(ramp_data, gain_2d, readnoise_2d, save_opt, weighting):
         'optimal' specifies that optimal weighting should be used;
          currently the only weighting supported.
 
+    ols_engine : str
+        'iterative' fits the segments with `calc_slope`; 'table' fits them
+        with `calc_slope_table`.
+
+    clean_ramps : ndarray, optional
+        True for the ramps of each integration having no flagged group,
+        which are fit directly by `calc_slope_clean`, 3-D bool
+
     Return
     ------
     max_seg : int
@@ -917,6 +951,8 @@ def ramp_fit_slopes(ramp_data, gain_2d, readnoise_2d, save_opt, weighting):
 
     med_rates = utils.compute_median_rates(ramp_data)
 
+    slope_fitter = calc_slope_table if ols_engine == "table" else calc_slope
+
     # Loop over data integrations:
     for num_int in range(0, n_int):
         # Loop over data sections
@@ -952,9 +988,15 @@ def ramp_fit_slopes(ramp_data, gain_2d, readnoise_2d, save_opt, weighting):
             # is deceiving; this in fact contains all the per-integration and
             # per-segment results that will eventually be used to compute the
             # final slopes, sigmas, etc. for the main (non-optional) products
-            t_dq_cube, inv_var, opt_res, f_max_seg, num_seg = \
-                calc_slope(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
-                           gain_sect, max_seg, ngroups, weighting, f_max_seg, ramp_data)
+            if clean_ramps is None:
+                t_dq_cube, inv_var, opt_res, f_max_seg, num_seg = \
+                    slope_fitter(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
+                                 gain_sect, max_seg, ngroups, weighting, f_max_seg, ramp_data)
+            else:
+                t_dq_cube, inv_var, opt_res, f_max_seg, num_seg = \
+                    calc_slope_clean(slope_fitter, clean_ramps[num_int, rlo:rhi, :], data_sect,
+                                     gdq_sect, frame_time, opt_res, save_opt, rn_sect, gain_sect,
+                                     max_seg, ngroups, weighting, f_max_seg, ramp_data)
 
             del gain_sect
 
@@ -1490,15 +1532,78 @@ def calc_power(snr):
         weighting exponent, 1-D float
     """
     pow_wt = snr.copy() * 0.0
-    pow_wt[np.where(snr > 5.)] = 0.4
-    pow_wt[np.where(snr > 10.)] = 1.0
-    pow_wt[np.where(snr > 20.)] = 3.0
-    pow_wt[np.where(snr > 50.)] = 6.0
-    pow_wt[np.where(snr > 100.)] = 10.0
+    for snr_min, power in zip([5., 10., 20., 50., 100.], WEIGHT_POWERS[1:]):
+        pow_wt[np.where(snr > snr_min)] = power
 
     return pow_wt.ravel()
 
 
+@functools.lru_cache(maxsize=8)
+def optimal_weight_table(ngroups, dtype=np.float32):
+    """
+    Tabulate the optimal weights of `calc_opt_sums`, before the division by
+    the read noise squared, for every group, number of nonzero groups and
+    weighting exponent of `calc_power`. The table is computed once for each
+    number of groups and data type.
+
+    Parameters
+    ----------
+    ngroups : int
+        number of groups per integration
+
+    dtype : numpy dtype
+        data type of the weighting exponents
+
+    Returns
+    -------
+    weight_table : ndarray
+        weight of each group (row) for each number of nonzero groups and
+        exponent, at column `num_nz * len(WEIGHT_POWERS) + power_index`,
+        2-D float, read-only
+    """
+    jj_rd = np.arange(ngroups)[:, np.newaxis, np.newaxis]
+    nrd_prime = ((np.arange(ngroups + 1) - 1) / 2.)[np.newaxis, :, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight_table = abs((abs(jj_rd - nrd_prime) / nrd_prime)
+                           ** np.array(WEIGHT_POWERS, dtype=dtype))
+    weight_table = weight_table.reshape(ngroups, -1)
+    weight_table.flags.writeable = False
+
+    return weight_table
+
+
+def opt_weight_index(ngroups, num_nz, power_wt_r):
+    """
+    Find the columns of `optimal_weight_table` holding the weights of each
+    pixel.
+
+    Parameters
+    ----------
+    ngroups : int
+        number of groups per integration
+
+    num_nz : ndarray
+        number of nonzero groups of each pixel, 1-D int
+
+    power_wt_r : ndarray
+        weighting exponent of each pixel from `calc_power`, 1-D float
+
+    Returns
+    -------
+    weight_index : ndarray or None
+        column of the weights of each pixel, 1-D int, or None if there are
+        too many groups to tabulate the weights or some exponents are not
+        in `WEIGHT_POWERS`
+    """
+    if ngroups > MAX_WEIGHT_TABLE_NGROUPS:
+        return None
+    powers = np.array(WEIGHT_POWERS, dtype=power_wt_r.dtype)
+    power_index = np.minimum(np.searchsorted(powers, power_wt_r), len(powers) - 1)
+    if not np.all(powers[power_index] == power_wt_r):
+        return None
+    return num_nz * len(WEIGHT_POWERS) + power_index
+
+
 def interpolate_power(snr):
     """
     Using the given SNR, interpolate the weighting exponent, which is from
@@ -1619,13 +1724,6 @@ def calc_slope(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
     end_st = np.zeros((ngroups + 1, npix), dtype=np.int32)
     end_st[0, :] = ngroups - 1
 
-    # end_heads is initially a tuple populated with every pixel that is
-    # either saturated or contains a cosmic ray based on the input DQ
-    # array, so is sized to accomodate the maximum possible number of
-    # pixels flagged. It is later compressed to be an array denoting
-    # the number of endpoints per pixel.
-    end_heads = np.ones(npix * ngroups, dtype=np.int32)
-
     # Create nominal 2D ERR array, which is 1st slice of
     #    avged_data_cube * readtime
     err_2d_array = data_sect[0, :, :] * frame_time
@@ -1653,29 +1751,18 @@ def calc_slope(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
     start = np.argmax(mask_2d, 0)  # start with the first True value
     # Reset the initial False groups to be True so that the first False is now either a jump or sat
     # Because start was set to be the first True, the initial False values will not be included
-    for pixel in range(npix):
-        mask_2d[:start[pixel], pixel] = True
-
-    wh_f = np.where(np.logical_not(mask_2d))
-
-    these_p = wh_f[1]  # coordinates of pixels flagged as False
-    these_r = wh_f[0]  # reads of pixels flagged as False
-
-    del wh_f
-
-    # Populate end_st to contain the set of end points for each pixel.
-    # Populate end_heads to initially include every pixel that is either
-    # saturated or contains a cosmic ray. Skips the duplicated final group
-    # for saturated pixels. Saturated pixels resulting in a contiguous set
-    # of intervals of length 1 will later be flagged as too short
-    # to fit well.
-    for ii, val in enumerate(these_p):
-        if these_r[ii] != (ngroups - 1):
-            end_st[end_heads[these_p[ii]], these_p[ii]] = these_r[ii]
-            end_heads[these_p[ii]] += 1
-
-    # Sort and reverse array to handle the order that saturated pixels
-    # were added
+    mask_2d |= arange_ngroups_col < start[np.newaxis, :]
+
+    # Populate end_st to contain the set of end points for each pixel: the
+    # groups that are either saturated or contain a cosmic ray, below the
+    # final read. The other groups are 0, as the unused end points. Skips
+    # the duplicated final group for saturated pixels. Saturated pixels
+    # resulting in a contiguous set of intervals of length 1 will later be
+    # flagged as too short to fit well.
+    end_st[1:ngroups] = np.where(mask_2d[:-1], 0, arange_ngroups_col[:-1])
+
+    # Sort and reverse array to put the end points of each pixel in
+    # decreasing order
     end_st.sort(axis=0)
     end_st = end_st[::-1]
 
@@ -1737,6 +1824,428 @@ def calc_slope(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
     return gdq_sect, inv_var, opt_res, f_max_seg, num_seg
 
 
+def find_clean_ramps(ramp_data):
+    """
+    Find the ramps that have no flagged groups, which are fit as a single
+    segment without the segment logic of `calc_slope`.
+
+    Parameters
+    ----------
+    ramp_data : RampData
+        Input data necessary for computing ramp fitting.
+
+    Returns
+    -------
+    clean_ramps : ndarray
+        True for the ramps of each integration having no flagged group,
+        3-D bool (nints, nrows, ncols)
+    """
+    return ~np.any(ramp_data.groupdq, axis=1)
+
+
+def calc_slope_clean(slope_fitter, clean, data_sect, gdq_sect, frame_time, opt_res, save_opt,
+                     rn_sect, gain_sect, i_max_seg, ngroups, weighting, f_max_seg, ramp_data):
+    """
+    Compute the slope of each segment for each pixel in the data cube section
+    for the current integration, fitting the clean ramps directly.
+
+    The clean ramps are a single segment of all the groups, which is fit by
+    `fit_segment_table` from the weighted sums over the whole ramp. The
+    other ramps are fit by `slope_fitter`, and the results are merged in
+    `opt_res`. Datasets with fewer than 3 groups, unweighted fits and
+    sections with fewer than 2 clean ramps are all fit by `slope_fitter`.
+
+    Parameters
+    ----------
+    slope_fitter : function
+        `calc_slope` or `calc_slope_table`, fitting the ramps with flagged
+        groups
+
+    clean : ndarray
+        True for the ramps having no flagged group, 2-D bool
+
+    The other parameters and the returns are those of `calc_slope`.
+    """
+    npix = clean.size
+    clean_pix = np.where(clean.ravel())[0]
+    if ngroups < 3 or weighting.lower() != 'optimal' or len(clean_pix) < 2:
+        return slope_fitter(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
+                            gain_sect, i_max_seg, ngroups, weighting, f_max_seg, ramp_data)
+
+    data_sect_r = np.reshape(data_sect, (ngroups, npix))
+    inv_var = np.zeros(npix, dtype=np.float32)
+    num_seg = np.zeros(npix, dtype=np.int32)
+
+    # Fit the flagged ramps as a section of one row
+    flag_pix = np.where(~clean.ravel())[0]
+    flag_res = {}
+    if len(flag_pix) > 0:
+        flag_shape = (1, len(flag_pix))
+        _, flag_inv_var, opt_res, f_max_seg, flag_num_seg = slope_fitter(
+            data_sect_r[:, flag_pix].reshape((ngroups,) + flag_shape),
+            np.reshape(gdq_sect, (ngroups, npix))[:, flag_pix].reshape((ngroups,) + flag_shape),
+            frame_time, opt_res, save_opt, rn_sect.ravel()[flag_pix].reshape(flag_shape),
+            gain_sect.ravel()[flag_pix].reshape(flag_shape), i_max_seg, ngroups, weighting,
+            f_max_seg, ramp_data)
+        inv_var[flag_pix] = flag_inv_var
+        num_seg[flag_pix] = flag_num_seg
+        flag_res = {name: arr for name, arr in vars(opt_res).items() if name.endswith('_2d')}
+
+    opt_res.init_2d(npix, i_max_seg, save_opt)
+    for name, arr in flag_res.items():
+        getattr(opt_res, name)[:, flag_pix] = arr
+
+    # Fit the clean ramps, which are appended if their variance is positive
+    slope, intercept, variance, sig_intercept, sig_slope = fit_segment_table(
+        data_sect_r, rn_sect, gain_sect, clean_pix, np.zeros_like(clean_pix),
+        np.full_like(clean_pix, ngroups))
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "invalid value.*", RuntimeWarning)
+        keep = variance > 0.
+    g_pix = clean_pix[keep]
+    inv_var[g_pix] += 1.0 / variance[keep]
+    opt_res.slope_2d[0, g_pix] = slope[keep]
+    if save_opt:
+        opt_res.interc_2d[0, g_pix] = intercept[keep]
+        opt_res.siginterc_2d[0, g_pix] = sig_intercept[keep]
+        opt_res.sigslope_2d[0, g_pix] = sig_slope[keep]
+        opt_res.inv_var_2d[0, g_pix] = inv_var[g_pix]
+    num_seg[g_pix] = 1
+    if len(g_pix) > 0:
+        f_max_seg = max(f_max_seg, 1)
+
+    return gdq_sect, inv_var, opt_res, f_max_seg, num_seg
+
+
+def calc_slope_table(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
+                     gain_sect, i_max_seg, ngroups, weighting, f_max_seg, ramp_data):
+    """
+    Compute the slope of each segment for each pixel in the data cube section
+    for the current integration, as `calc_slope` does, from a table of the
+    segments of all pixels. The table is built from the group DQ flags by
+    `build_segment_table`, and all the segments are fit at once by
+    `fit_segment_table`, instead of fitting the next segment of all pixels
+    in each iteration. Datasets with fewer than 3 groups and unweighted fits
+    are passed to `calc_slope`.
+
+    Parameters and returns are those of `calc_slope`.
+    """
+    if ngroups < 3 or weighting.lower() != 'optimal':
+        return calc_slope(data_sect, gdq_sect, frame_time, opt_res, save_opt, rn_sect,
+                          gain_sect, i_max_seg, ngroups, weighting, f_max_seg, ramp_data)
+
+    npix = data_sect.shape[1] * data_sect.shape[2]
+    gdq_sect_r = np.reshape(gdq_sect, (ngroups, npix))
+    data_sect_r = np.reshape(data_sect, (ngroups, npix))
+
+    opt_res.init_2d(npix, i_max_seg, save_opt)
+    inv_var = np.zeros(npix, dtype=np.float32)
+
+    pix, first, nfit, check_var = build_segment_table(gdq_sect_r, ramp_data.flags_jump_det)
+    slope, intercept, variance, sig_intercept, sig_slope = fit_segment_table(
+        data_sect_r, rn_sect, gain_sect, pix, first, nfit)
+
+    # As in the CASE functions, the long segments and the segments at the
+    #   end of a ramp are only appended if their variance is positive
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "invalid value.*", RuntimeWarning)
+        keep = ~check_var | (variance > 0.)
+    pix, slope, intercept, variance, sig_intercept, sig_slope = (
+        arr[keep] for arr in (pix, slope, intercept, variance, sig_intercept, sig_slope))
+
+    # The segments of each pixel are numbered in the order they were found
+    order = np.argsort(pix, kind='stable')
+    num_seg = np.bincount(pix, minlength=npix).astype(np.int32)
+    first_of_pix = np.cumsum(num_seg) - num_seg
+    seg = np.empty(len(pix), dtype=np.intp)
+    seg[order] = np.arange(len(pix)) - first_of_pix[pix[order]]
+
+    # The inverse variances are accumulated segment by segment
+    inv_var_seg = np.zeros(len(pix), dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "divide by zero.*", RuntimeWarning)
+        for ii_seg in range(num_seg.max() if len(pix) > 0 else 0):
+            these = np.where(seg == ii_seg)[0]
+            inv_var[pix[these]] += 1.0 / variance[these]
+            inv_var_seg[these] = inv_var[pix[these]]
+
+    opt_res.slope_2d[seg, pix] = slope
+    if save_opt:
+        opt_res.interc_2d[seg, pix] = intercept
+        opt_res.siginterc_2d[seg, pix] = sig_intercept
+        opt_res.sigslope_2d[seg, pix] = sig_slope
+        opt_res.inv_var_2d[seg, pix] = inv_var_seg
+
+    if len(pix) > 0:
+        f_max_seg = max(f_max_seg, num_seg.max())
+
+    return gdq_sect, inv_var, opt_res, f_max_seg, num_seg
+
+
+def build_segment_table(gdq_sect_r, jump_det):
+    """
+    Find the segments that `calc_slope` fits in the ramps of a data section.
+
+    The end point stacks of `calc_slope` are walked for all pixels, with the
+    cases of `fit_next_segment` but without fitting, so the table lists the
+    same segments in the same order.
+
+    Parameters
+    ----------
+    gdq_sect_r : ndarray
+        group DQ flags of the section, 2-D int (ngroups, npix)
+
+    jump_det : int
+        the JUMP_DET flag; a group flagged only as a jump just before a
+        segment is included in it
+
+    Returns
+    -------
+    pix : ndarray
+        pixel of each segment, 1-D int
+
+    first : ndarray
+        first group fit in each segment, 1-D int
+
+    nfit : ndarray
+        number of groups fit in each segment, 1-D int
+
+    check_var : ndarray
+        True for the segments that are only kept if their variance is
+        positive, 1-D bool
+    """
+    ngroups, npix = gdq_sect_r.shape
+    arange_ngroups_col = np.arange(ngroups)[:, np.newaxis]
+
+    good = gdq_sect_r == 0
+    ramp_mask_sum = good.sum(axis=0)
+    # number of good groups from each group to the end of the ramp
+    good_from = np.cumsum(good[::-1], axis=0, dtype=np.uint16)[::-1]
+    jump_before = np.zeros_like(good)
+    jump_before[1:] = gdq_sect_r[:-1] == jump_det
+
+    # End point stacks, as in calc_slope
+    start = np.argmax(good, axis=0)
+    end_st = np.zeros((ngroups + 1, npix), dtype=np.int32)
+    end_st[0, :] = ngroups - 1
+    end_st[1:ngroups] = np.where(
+        good[:-1] | (arange_ngroups_col[:-1] < start[np.newaxis, :]), 0, arange_ngroups_col[:-1])
+    end_st.sort(axis=0)
+    end_st = end_st[::-1]
+    end_heads = (end_st > 0).sum(axis=0)
+
+    # pixels not done, and the segments found in each iteration and case
+    active = np.arange(npix)
+    segments = []
+
+    def add_segments(pix, seg_start, seg_end, check_var):
+        # the good groups from start to end, and the jump just before them
+        first = seg_start + ~good[seg_start, pix]
+        last = seg_end - ~good[seg_end, pix]
+        nfit = np.maximum(last - first + 1, 0)
+        add_back = (nfit > 0) & jump_before[np.minimum(first, ngroups - 1), pix]
+        segments.append((pix, first - add_back, nfit + add_back, np.full(len(pix), check_var)))
+
+    for _ in range(ngroups):
+        if len(active) == 0:
+            break
+        pix = active
+        cur_start = start[pix]
+        heads = end_heads[pix]
+        end_locs = end_st[heads - 1, pix]
+        l_interval = end_locs - cur_start
+        done = np.zeros(len(pix), dtype=bool)
+        got_case = np.zeros(len(pix), dtype=bool)
+        at_end = end_locs == ngroups - 1
+
+        # CASE: long enough, at end of ramp
+        these = (l_interval > 1) & at_end
+        add_segments(pix[these], cur_start[these], end_locs[these], True)
+        done |= these
+
+        # CASE: long enough, not at end of ramp
+        these = (l_interval > 2) & ~at_end
+        add_segments(pix[these], cur_start[these], end_locs[these], True)
+        start[pix[these]] = end_locs[these]
+        heads[these] -= 1
+        got_case |= these
+
+        # CASE: 2 groups at end of ramp, with at least 1 good group
+        these = (l_interval == 1) & at_end & (good_from[cur_start, pix] > 0)
+        add_segments(pix[these], cur_start[these], end_locs[these], True)
+        done |= these
+
+        # CASE: 2 groups not at end of ramp
+        these = (l_interval == 2) & ~at_end
+        add_segments(pix[these], cur_start[these], end_locs[these], False)
+        more = these & (good_from[cur_start, pix] > 1)
+        start[pix[more]] = end_locs[more]
+        heads[more] -= 1
+        done |= these & ~more
+        got_case |= these
+
+        # CASE: only the 0th group of the ramp is good
+        only_0th = good[0, pix] & ~good[1, pix]
+        these = only_0th & (ramp_mask_sum[pix] == 1) & ~done
+        add_segments(pix[these], cur_start[these], end_locs[these], False)
+        done |= these
+
+        # CASE: good 0th group and bad 1st group; and all other cases
+        these = only_0th & ~done & (end_locs == 1) & (start[pix] == 0)
+        these |= ~done & ~got_case
+        start[pix[these]] = np.minimum(start[pix[these]] + 1, ngroups - 1)
+        heads[these] -= 1
+
+        end_heads[pix] = np.maximum(heads, 0)
+        active = pix[~done]
+
+    pix, first, nfit, check_var = (np.concatenate(arrs) for arrs in zip(*segments))
+
+    return pix, first, nfit, check_var
+
+
+def fit_segment_table(data_sect_r, rn_sect, gain_sect, pix, first, nfit):
+    """
+    Fit all the segments of a segment table at once, as `fit_lines` fits
+    them with optimal weighting.
+
+    Segments of more than 2 groups are fit with the weights of
+    `calc_opt_sums`. The weighted sums of all the segments are taken in one
+    pass from cumulative sums over the position in each segment, accumulated
+    in float64. `calc_opt_sums` accumulates the sums of the data in float32,
+    so the results agree with `calc_slope` to float32 precision, not bit for
+    bit.
+
+    Parameters
+    ----------
+    data_sect_r : ndarray
+        data of the section, with NaN for saturated groups, 2-D float
+        (ngroups, npix)
+
+    rn_sect : ndarray
+        read noise values for all pixels in data section
+
+    gain_sect : ndarray
+        gain values for all pixels in data section
+
+    pix, first, nfit : ndarray
+        pixel, first group and number of groups of the segments, as
+        returned by `build_segment_table`
+
+    Returns
+    -------
+    slope, intercept, variance, sig_intercept, sig_slope : ndarray
+        fit results of the segments, 1-D float
+    """
+    nseg = len(pix)
+    slope = np.zeros(nseg, dtype=np.float32)
+    variance = np.zeros(nseg, dtype=np.float32)
+    intercept = np.zeros(nseg, dtype=np.float32)
+    sig_intercept = np.zeros(nseg, dtype=np.float32)
+    sig_slope = np.zeros(nseg, dtype=np.float32)
+
+    # Single good 0th group, as in fit_single_read
+    these = (nfit == 1) & (first == 0)
+    slope[these] = data_sect_r[0, pix[these]]
+    variance[these] = utils.LARGE_VARIANCE
+
+    # Two good groups, as in fit_double_read
+    these = np.where(nfit == 2)[0]
+    rn = rn_sect.flatten()[pix[these]].astype(np.float64)
+    data_0 = data_sect_r[first[these], pix[these]]
+    data_1 = data_sect_r[first[these] + 1, pix[these]]
+    second_read = first[these] + 1
+    slope[these] = data_1 - data_0
+    intercept[these] = data_1 * (1. - second_read) + data_0.astype(np.float64) * second_read
+    variance[these] = 2.0 * rn * rn
+    sig_slope[these] = np.sqrt(2) * rn
+    sig_intercept[these] = np.sqrt(2) * rn
+
+    # More than 2 good groups, as in calc_opt_sums
+    these = np.where(nfit > 2)[0]
+    if len(these) == 0:
+        return slope, intercept, variance, sig_intercept, sig_slope
+    s_pix, s_first, s_nfit = pix[these], first[these], nfit[these]
+    s_last = s_first + s_nfit - 1
+    ngroups = data_sect_r.shape[0]
+
+    # Groups of each segment, one column per segment and one row per
+    #   position in the segment
+    positions = np.arange(s_nfit.max())[:, np.newaxis]
+    in_segment = positions < s_nfit
+    xvalues = np.minimum(s_first + positions, ngroups - 1)
+    group_data = data_sect_r[xvalues, s_pix]
+
+    rn_sect_rav = np.float32(rn_sect).flatten()[s_pix]
+    rn_2_r = rn_sect_rav * rn_sect_rav
+    gain_sect_r = gain_sect.flatten()[s_pix]
+
+    data_zero = data_sect_r[s_first, s_pix]
+    data_final = data_sect_r[s_last, s_pix]
+    data_diff = data_final - data_zero
+
+    sigma_ir = data_final.copy() * 0.0
+    numer_ir = data_final.copy() * 0.0
+    sqrt_arg = rn_2_r + data_diff * gain_sect_r
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "invalid value.*", RuntimeWarning)
+        wh_pos = np.where((sqrt_arg >= 0.) & (gain_sect_r != 0.))
+    numer_ir[wh_pos] = \
+        np.sqrt(rn_2_r[wh_pos] + data_diff[wh_pos] * gain_sect_r[wh_pos])
+    sigma_ir[wh_pos] = numer_ir[wh_pos] / gain_sect_r[wh_pos]
+    snr = data_diff * 0.
+    snr[wh_pos] = data_diff[wh_pos] / sigma_ir[wh_pos]
+    snr[np.isnan(snr)] = 0.0
+    snr[snr < 0.] = 0.0
+    power_wt_r = calc_power(snr)
+
+    # The nonzero groups counted by calc_opt_sums are those of the segment
+    #   and the non-finite groups outside it
+    num_nz = np.sum(~np.isfinite(data_sect_r), axis=0)[s_pix]
+    num_nz += np.sum(in_segment & (group_data != 0.) & np.isfinite(group_data), axis=0)
+    nrd_prime = (num_nz - 1) / 2.
+    weight_index = opt_weight_index(ngroups, num_nz, power_wt_r)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "divide by zero.*", RuntimeWarning)
+        warnings.filterwarnings("ignore", "invalid value.*", RuntimeWarning)
+        invrdns2_r = 1. / rn_2_r
+        if weight_index is not None:
+            wt_h = np.float32(optimal_weight_table(ngroups, power_wt_r.dtype)[
+                positions, weight_index] * invrdns2_r)
+        else:
+            wt_h = np.float32(abs((abs(positions - nrd_prime) / nrd_prime) ** power_wt_r)
+                              * invrdns2_r)
+    wt_h[~np.isfinite(wt_h) | ~in_segment] = 0.
+    group_data = np.where(in_segment & ~np.isnan(group_data), group_data, 0.)
+
+    # The weighted sums are read from the cumulative sums over the position
+    #   in each segment, at its last group, accumulated in float64. The
+    #   weights depend on the length and SNR of each segment, so the sums
+    #   can't be differences of cumulative sums over the whole ramp.
+    last = (s_nfit - 1, np.arange(len(these)))
+    cumsum_buf = np.empty(wt_h.shape, dtype=np.float64)
+
+    def segment_sums(values):
+        return np.cumsum(values, axis=0, dtype=np.float64, out=cumsum_buf)[last]
+
+    nreads_wtd = segment_sums(wt_h)
+    sumx = segment_sums(xvalues * wt_h)
+    sumxx = segment_sums(xvalues**2 * wt_h)
+    sumy = segment_sums(group_data * wt_h)
+    sumxy = segment_sums(xvalues * wt_h * group_data)
+
+    s_slope, s_intercept, s_sig_slope, s_sig_intercept = \
+        calc_opt_fit(nreads_wtd, sumxx, sumx, sumxy, sumy)
+    slope[these] = s_slope
+    variance[these] = s_sig_slope**2.
+    intercept[these] = s_intercept
+    sig_intercept[these] = s_sig_intercept
+    sig_slope[these] = s_sig_slope
+
+    return slope, intercept, variance, sig_intercept, sig_slope
+
+
 def fit_next_segment(start, end_st, end_heads, pixel_done, data_sect, mask_2d,
                      mask_2d_init, inv_var, num_seg, opt_res, save_opt, rn_sect,
                      gain_sect, ngroups, weighting, f_max_seg, gdq_sect_r, ramp_data):
@@ -2203,7 +2712,7 @@ def fit_next_segment_short_seg_not_at_end(
     # create array: 0...ngroups-1 in a column for each pixel
     arr_ind_all = np.array(
         [np.arange(ngroups), ] * c_mask_2d_init.shape[1]).transpose()
-    wh_c_start_all = np.zeros(mask_2d_init.shape[1], dtype=np.uint8)
+    wh_c_start_all = np.zeros(mask_2d_init.shape[1], dtype=start.dtype)
     wh_c_start_all[these_pix] = start[these_pix]
 
     # set to False all groups before start group
@@ -2471,7 +2980,7 @@ def fit_next_segment_long_not_end_of_ramp(
         arr_ind_all = np.array(
             [np.arange(ngroups), ] * c_mask_2d_init.shape[1]).transpose()
 
-        wh_c_start_all = np.zeros(c_mask_2d_init.shape[1], dtype=np.uint8)
+        wh_c_start_all = np.zeros(c_mask_2d_init.shape[1], dtype=start.dtype)
         wh_c_start_all[g_pix] = start[g_pix]
 
         # set to False all groups before start group
@@ -3617,7 +4126,6 @@ def calc_opt_sums(rn_sect, gain_sect, data_masked, mask_2d, xvalues, good_pix):
     num_nz = 0
 
     nrd_prime = (nrd_data_a - 1) / 2.
-    nrd_data_a = 0
 
     # Calculate inverse read noise^2 for use in weights
     # Suppress, then re-enable, harmless arithmetic warning
@@ -3629,12 +4137,21 @@ def calc_opt_sums(rn_sect, gain_sect, data_masked, mask_2d, xvalues, good_pix):
     fnz = 0
 
     # Set optimal weights for each group of each pixel;
-    #    for all pixels at once, loop over the groups
+    #    for all pixels at once, loop over the groups. The weights are
+    #    taken from the table for the number of nonzero groups and the
+    #    exponent of each pixel when it is small enough.
     wt_h = np.zeros(data_masked.shape, dtype=np.float32)
-
-    for jj_rd in range(data_masked.shape[0]):
-        wt_h[jj_rd, :] = \
-            abs((abs(jj_rd - nrd_prime) / nrd_prime) ** power_wt_r) * invrdns2_r
+    ngroups = data_masked.shape[0]
+    weight_index = opt_weight_index(ngroups, nrd_data_a, power_wt_r)
+    if weight_index is not None:
+        weight_table = optimal_weight_table(ngroups, power_wt_r.dtype)
+
+    for jj_rd in range(ngroups):
+        if weight_index is not None:
+            wt_h[jj_rd, :] = weight_table[jj_rd, weight_index] * invrdns2_r
+        else:
+            wt_h[jj_rd, :] = \
+                abs((abs(jj_rd - nrd_prime) / nrd_prime) ** power_wt_r) * invrdns2_r
 
     wt_h[np.isnan(wt_h)] = 0.
     wt_h[np.isinf(wt_h)] = 0.
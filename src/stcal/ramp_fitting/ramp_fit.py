@@ -83,7 +83,8 @@ def create_ramp_fit_class(model, dqflags=None, suppress_one_group=False):
 
 
 def ramp_fit(model, buffsize, save_opt, readnoise_2d, gain_2d, algorithm,
-             weighting, max_cores, dqflags, suppress_one_group=False):
+             weighting, max_cores, dqflags, suppress_one_group=False,
+             ols_engine="iterative"):
     """
     Calculate the count rate for each pixel in all data cube sections and all
     integrations, equal to the slope for all sections (intervals between
@@ -132,6 +133,10 @@ def ramp_fit(model, buffsize, save_opt, readnoise_2d, gain_2d, algorithm,
         Find ramps with only one good group and treat it like it has zero good
         groups.
 
+    ols_engine : str
+        The engine fitting the segments of the ramps with ordinary least
+        squares; see `ramp_fit_data`.
+
     Returns
     -------
     image_info : tuple
@@ -159,11 +164,11 @@ def ramp_fit(model, buffsize, save_opt, readnoise_2d, gain_2d, algorithm,
 
     return ramp_fit_data(
         ramp_data, buffsize, save_opt, readnoise_2d, gain_2d,
-        algorithm, weighting, max_cores, dqflags)
+        algorithm, weighting, max_cores, dqflags, ols_engine)
 
 
 def ramp_fit_data(ramp_data, buffsize, save_opt, readnoise_2d, gain_2d,
-                  algorithm, weighting, max_cores, dqflags):
+                  algorithm, weighting, max_cores, dqflags, ols_engine="iterative"):
     """
     This function begins the ramp fit computation after the creation of the
     RampData class.  It determines the proper path for computation to take
@@ -205,6 +210,13 @@ def ramp_fit_data(ramp_data, buffsize, save_opt, readnoise_2d, gain_2d,
         A dictionary with at least the following keywords:
         DO_NOT_USE, SATURATED, JUMP_DET, NO_GAIN_VALUE, UNRELIABLE_SLOPE
 
+    ols_engine : str
+        The engine fitting the segments of the ramps with ordinary least
+        squares. 'iterative' (the default) fits the next segment of all
+        pixels in each iteration; 'table' finds the segments of all pixels
+        from the group DQ flags first and fits them all at once, with the
+        same results.
+
     Returns
     -------
     image_info : tuple
@@ -220,6 +232,9 @@ def ramp_fit_data(ramp_data, buffsize, save_opt, readnoise_2d, gain_2d,
         Object containing optional GLS-specific ramp fitting data for the
         exposure
     """
+    if ols_engine not in ("iterative", "table"):
+        raise ValueError(f"Unknown OLS engine {ols_engine!r}, must be 'iterative' or 'table'")
+
     if algorithm.upper() == "GLS":
         image_info, integ_info, gls_opt_info = gls_fit.gls_ramp_fit(
             ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, max_cores)
@@ -236,7 +251,8 @@ def ramp_fit_data(ramp_data, buffsize, save_opt, readnoise_2d, gain_2d,
 
         # Compute ramp fitting using ordinary least squares.
         image_info, integ_info, opt_info = ols_fit.ols_ramp_fit_multi(
-            ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting, max_cores)
+            ramp_data, buffsize, save_opt, readnoise_2d, gain_2d, weighting, max_cores,
+            ols_engine)
         gls_opt_info = None
 
     return image_info, integ_info, opt_info, gls_opt_info
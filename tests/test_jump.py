@@ -1,9 +1,17 @@
+import multiprocessing
+
+import cv2 as cv
 import numpy as np
 import pytest
+from astropy.convolution import convolve
 from astropy.io import fits
 
+from stcal.jump import jump
 from stcal.jump.jump import flag_large_events, find_ellipses, extend_saturation, \
-    point_inside_ellipse, find_faint_extended
+    point_inside_ellipse, find_faint_extended, detect_jumps, plan_jump_slices, \
+    extend_ellipses, ellipse_window, make_snowballs, flag_large_events_integration, \
+    nan_convolve, ring_kernel, nanmedian_by_rows, plan_jump_tiles, tile_grid, \
+    find_shower_events, flag_events, EVENT_DTYPE
 
 DQFLAGS = {'JUMP_DET': 4, 'SATURATED': 2, 'DO_NOT_USE': 1, 'GOOD': 0, 'NO_GAIN_VALUE': 8}
 
@@ -25,6 +33,157 @@ def setup_cube():
     return _cube
 
 
+def test_multiprocessing_shared_memory(setup_cube, monkeypatch):
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 3)
+    data, gdq, nframes, readnoise, rej_threshold = setup_cube(6)
+    rng = np.random.default_rng(7)
+    data[0] = np.cumsum(rng.normal(size=data.shape[1:]) * 10, axis=0)
+    data[0, 3:, 60:70, 100] += 1000  # jumps across the boundary of two slices
+    gdq[0, 4:, 67, 90:110] = DQFLAGS['SATURATED']
+    gain = np.ones(shape=readnoise.shape, dtype=np.float32)
+    pdq = np.zeros(shape=readnoise.shape, dtype=np.uint32)
+    err = np.zeros_like(data)
+
+    gdq_pickled, _ = detect_jumps(nframes, data.copy(), gdq.copy(), pdq.copy(), err, gain,
+                                  readnoise.copy(), rej_threshold, rej_threshold, rej_threshold,
+                                  'all', 200, 4, True, DQFLAGS, after_jump_flag_dn1=500,
+                                  after_jump_flag_n1=1)
+    gdq_shared, _ = detect_jumps(nframes, data.copy(), gdq.copy(), pdq.copy(), err, gain,
+                                 readnoise.copy(), rej_threshold, rej_threshold, rej_threshold,
+                                 'all', 200, 4, True, DQFLAGS, after_jump_flag_dn1=500,
+                                 after_jump_flag_n1=1, use_shared_memory=True)
+
+    assert np.all(gdq_shared[0, 3, 60:70, 100] & DQFLAGS['JUMP_DET'])
+    assert gdq_shared[0, 3, 67, 101] & DQFLAGS['JUMP_DET']
+    assert np.array_equal(gdq_shared, gdq_pickled)
+
+
+def test_plan_jump_slices():
+    # one integration is split by rows, the last slice gets the rest
+    assert plan_jump_slices(1, 10, 3) == [(0, 1, 0, 3), (0, 1, 3, 6), (0, 1, 6, 10)]
+    # many integrations are split by integrations only
+    assert plan_jump_slices(8, 10, 4) == [(0, 2, 0, 10), (2, 4, 0, 10), (4, 6, 0, 10), (6, 8, 0, 10)]
+    # a few integrations are split by both
+    assert plan_jump_slices(2, 10, 4) == [(0, 1, 0, 5), (0, 1, 5, 10), (1, 2, 0, 5), (1, 2, 5, 10)]
+    assert plan_jump_slices(2, 10, 4, 'rows') == [(0, 2, 0, 2), (0, 2, 2, 4), (0, 2, 4, 6),
+                                                  (0, 2, 6, 10)]
+    assert plan_jump_slices(3, 10, 4, 'integrations') == [(0, 1, 0, 10), (1, 2, 0, 10), (2, 3, 0, 10)]
+    # never more slices of rows than rows
+    assert len(plan_jump_slices(1, 2, 8)) == 2
+    with pytest.raises(ValueError):
+        plan_jump_slices(1, 10, 2, 'columns')
+
+
+def test_plan_jump_tiles():
+    # a full frame is split into blocks, a subarray with few rows by columns
+    assert plan_jump_tiles(1, 10, 10, 4) == [(0, 1, 0, 5, 0, 5), (0, 1, 0, 5, 5, 10),
+                                             (0, 1, 5, 10, 0, 5), (0, 1, 5, 10, 5, 10)]
+    assert plan_jump_tiles(1, 4, 100, 4) == [(0, 1, 0, 4, 0, 25), (0, 1, 0, 4, 25, 50),
+                                             (0, 1, 0, 4, 50, 75), (0, 1, 0, 4, 75, 100)]
+    # integrations are split first with 'auto', not with 'tiles'
+    assert plan_jump_tiles(2, 10, 10, 4) == [(0, 1, 0, 10, 0, 5), (0, 1, 0, 10, 5, 10),
+                                             (1, 2, 0, 10, 0, 5), (1, 2, 0, 10, 5, 10)]
+    assert len(plan_jump_tiles(2, 10, 10, 4, 'tiles')) == 4
+    # the tiles of a given shape cover the frame
+    assert plan_jump_tiles(1, 5, 7, 2, 'tiles', tile_shape=(3, 4)) == [
+        (0, 1, 0, 3, 0, 4), (0, 1, 0, 3, 4, 7), (0, 1, 3, 5, 0, 4), (0, 1, 3, 5, 4, 7)]
+    # rows and integrations span all columns
+    assert plan_jump_tiles(1, 10, 8, 3, 'rows') == [(0, 1, 0, 3, 0, 8), (0, 1, 3, 6, 0, 8),
+                                                    (0, 1, 6, 10, 0, 8)]
+    with pytest.raises(ValueError):
+        plan_jump_tiles(1, 10, 10, 2, 'columns')
+    with pytest.raises(ValueError):
+        plan_jump_tiles(1, 10, 10, 2, 'tiles', tile_shape=(0, 4))
+
+
+def test_tile_grid():
+    assert tile_grid(2048, 2048, 16) == (4, 4)
+    assert tile_grid(32, 2048, 8) == (1, 8)
+    assert tile_grid(2048, 64, 8) == (8, 1)
+    # never more tiles than pixels
+    assert tile_grid(1, 3, 8) == (1, 3)
+
+
+@pytest.mark.parametrize('split, tile_shape, use_shared_memory', [
+    ('rows', None, False), ('tiles', None, False), ('tiles', (6, 5), False),
+    ('auto', (1, 1), False), ('tiles', (7, 4), True)])
+def test_multiprocessing_tiles(monkeypatch, split, tile_shape, use_shared_memory):
+    # jumps, saturated pixels and after jump flags at the edges of the tiles
+    # give the same flags as a single process
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+    nints, ngroups, nrows, ncols = 1, 8, 21, 19
+    rng = np.random.default_rng(6)
+    data = np.cumsum(rng.normal(size=(nints, ngroups, nrows, ncols)) * 10, axis=1).astype(np.float32)
+    data[:, 3:] += ((rng.random((nrows, ncols)) < 0.2) * 2000).astype(np.float32)
+    gdq = np.zeros(data.shape, dtype=np.uint32)
+    gdq[rng.random(gdq.shape) < 0.05] = DQFLAGS['SATURATED']
+    gdq[:, :, rng.random((nrows, ncols)) < 0.05] |= DQFLAGS['DO_NOT_USE']
+    readnoise = np.full((nrows, ncols), 10, dtype=np.float32)
+    gain = rng.uniform(1.5, 3.5, size=(nrows, ncols)).astype(np.float32)
+
+    results = []
+    for max_cores in ['none', 'all']:
+        pdq = np.zeros((nrows, ncols), dtype=np.uint32)
+        out_gdq, _ = detect_jumps(1, data.copy(), gdq.copy(), pdq, np.zeros_like(data), gain,
+                                  readnoise.copy(), 4, 5, 6, max_cores, 200, 4, True, DQFLAGS,
+                                  after_jump_flag_dn1=500, after_jump_flag_n1=2,
+                                  use_shared_memory=use_shared_memory, parallel_split=split,
+                                  tile_shape=tile_shape)
+        results.append(out_gdq)
+    assert np.any(results[0] & DQFLAGS['JUMP_DET'])
+    assert np.array_equal(results[0], results[1])
+
+
+@pytest.mark.parametrize('use_shared_memory', [False, True])
+def test_multiprocessing_integrations(monkeypatch, use_shared_memory):
+    # splitting by integrations gives the same flags as a single process
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 2)
+    nints, ngroups, nrows, ncols = 4, 5, 20, 20
+    rng = np.random.default_rng(3)
+    data = np.cumsum(rng.normal(size=(nints, ngroups, nrows, ncols)) * 10, axis=1).astype(np.float32)
+    data[:, 2:, 5, 5] += 500
+    data[3, 3:, 0:3, 7] += 800
+    gdq = np.zeros(data.shape, dtype=np.uint32)
+    readnoise = np.full((nrows, ncols), 10, dtype=np.float32)
+    gain = np.ones((nrows, ncols), dtype=np.float32)
+
+    results = []
+    for max_cores in ['none', 'all']:
+        pdq = np.zeros((nrows, ncols), dtype=np.uint32)
+        out_gdq, _ = detect_jumps(1, data.copy(), gdq.copy(), pdq, np.zeros_like(data), gain,
+                                  readnoise.copy(), 4, 5, 6, max_cores, 200, 4, True, DQFLAGS,
+                                  use_shared_memory=use_shared_memory)
+        results.append(out_gdq)
+    assert np.all(results[0][:, 2, 5, 5] == DQFLAGS['JUMP_DET'])
+    assert np.array_equal(results[0], results[1])
+
+
+@pytest.mark.parametrize('max_cores, use_shared_memory', [('none', False), ('all', False),
+                                                         ('all', True)])
+def test_detect_jumps_inputs_unchanged(monkeypatch, max_cores, use_shared_memory):
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 2)
+    nints, ngroups, nrows, ncols = 2, 6, 20, 20
+    rng = np.random.default_rng(4)
+    data = np.cumsum(rng.normal(size=(nints, ngroups, nrows, ncols)) * 10, axis=1).astype(np.float32)
+    data[:, 3:, 5, 5] += 300
+    gdq = np.zeros(data.shape, dtype=np.uint8)
+    gdq[:, 4:, 10, 10] = DQFLAGS['SATURATED']
+    readnoise = np.full((nrows, ncols), 4, dtype=np.float32)
+    gain = rng.uniform(1.5, 3.5, size=(nrows, ncols)).astype(np.float32)
+    err = rng.uniform(size=data.shape).astype(np.float32)
+    inputs = [arr.copy() for arr in (data, err, readnoise)]
+
+    pdq = np.zeros((nrows, ncols), dtype=np.uint32)
+    out_gdq, _ = detect_jumps(1, data, gdq, pdq, err, gain, readnoise, 4, 5, 6, max_cores,
+                              200, 4, True, DQFLAGS, after_jump_flag_dn1=50, after_jump_flag_n1=1,
+                              find_showers=True, use_shared_memory=use_shared_memory)
+
+    # the jump is found, and the input arrays are not scaled by the gain
+    assert np.all(out_gdq[:, 3:5, 5, 5] == DQFLAGS['JUMP_DET'])
+    for arr, expected in zip((data, err, readnoise), inputs):
+        assert np.array_equal(arr, expected)
+
+
 def test_find_simple_ellipse():
     plane = np.zeros(shape=(5, 5), dtype=np.uint8)
     plane[2, 2] = DQFLAGS['JUMP_DET']
@@ -73,6 +232,80 @@ def test_extend_saturation_simple():
     assert new_cube[grp, 4, 5] == 0
 
 
+def test_ellipse_window_edge():
+    shape = (20, 30)
+    # ellipse clipped by the corner of the frame
+    rows, cols, mask = ellipse_window(shape, (1, 2), (6, 4), 30.0)
+    assert rows == slice(0, 10)
+    assert cols == slice(0, 9)
+    image = np.zeros(shape, dtype=np.uint8)
+    cv.ellipse(image, (1, 2), (6, 4), 30.0, 0, 360, 1, -1)
+    full = np.zeros(shape, dtype=bool)
+    full[rows, cols] = mask
+    assert np.array_equal(full, image.astype(bool))
+
+
+def test_extend_ellipses_saturated_groups():
+    cube = np.zeros(shape=(1, 5, 9, 9), dtype=np.uint8)
+    cube[0, 3:, 4, 4] = DQFLAGS['SATURATED']
+    ellipse = ((4.0, 4.0), (4.0, 4.0), 0.0)
+    cube, num = extend_ellipses(cube, 0, 1, [ellipse], DQFLAGS['SATURATED'],
+                                DQFLAGS['JUMP_DET'], expansion=1.0, num_grps_masked=3)
+    assert num == 1
+    assert np.all(cube[0, 0] == 0)
+    assert np.all(cube[0, 1:3, 4, 2:7] & DQFLAGS['JUMP_DET'])
+    assert np.all(cube[0, 3, 3, 3:6] & DQFLAGS['JUMP_DET'])
+    # saturated pixels are not flagged as jump
+    assert cube[0, 1, 4, 4] == DQFLAGS['JUMP_DET']
+    assert cube[0, 3, 4, 4] == DQFLAGS['SATURATED']
+    assert np.all(cube[0, 4] & DQFLAGS['JUMP_DET'] == 0)
+
+
+def test_make_snowballs_extended_center():
+    gdq = np.zeros(shape=(1, 3, 21, 21), dtype=np.uint8)
+    gdq[0, 1, 10, 10] = DQFLAGS['SATURATED']
+    sat = ((10.0, 10.0), (4.0, 4.0), 0.0)
+    jump1 = ((10.0, 10.0), (8.0, 8.0), 0.0)
+    # The center of the second jump is only saturated after the extension
+    # of the saturated core matched to the first jump
+    jump2 = ((12.0, 10.0), (8.0, 8.0), 0.0)
+    gdq, snowballs = make_snowballs(gdq, 0, 1, [jump1, jump2], [sat], 0, 21, 1, 2,
+                                    DQFLAGS['SATURATED'], 200)
+    assert snowballs == [jump1, jump2]
+    assert np.all(gdq[0, 0] == 0)
+    assert np.all(gdq[0, 1:, 10, 7:14] == DQFLAGS['SATURATED'])
+    assert np.all(gdq[0, 1:, 10, 14:] == 0)
+
+
+def test_make_snowballs_many_cores():
+    gdq = np.zeros(shape=(1, 2, 60, 60), dtype=np.uint8)
+    sats = []
+    for y in range(5, 60, 10):
+        for x in range(5, 60, 10):
+            gdq[0, 1, y, x] = DQFLAGS['SATURATED']
+            sats.append(((float(x), float(y)), (1.0, 1.0), 0.0))
+    # jumps centered on a core, between cores and repeated
+    jumps = [((25.0, 35.0), (6.0, 6.0), 0.0), ((30.0, 30.0), (6.0, 6.0), 0.0),
+             ((45.0, 15.0), (3.0, 3.0), 0.0)]
+    gdq, snowballs = make_snowballs(gdq, 0, 1, jumps + jumps[:1], sats, 0, 60, 2, 2,
+                                    DQFLAGS['SATURATED'], 200)
+    assert snowballs == [jumps[0], jumps[2]]
+
+
+def test_flag_large_events_quiet_groups():
+    cube = np.zeros(shape=(1, 6, 30, 30), dtype=np.uint8)
+    # saturated core with no jump in group 2 and a snowball in group 4
+    cube[0, 2:, 5:10, 5:10] = DQFLAGS['SATURATED']
+    cube[0, 4, 12:23, 12:23] = DQFLAGS['JUMP_DET']
+    cube[0, 4:, 15:20, 15:20] = DQFLAGS['SATURATED']
+    expected = cube.copy()
+    gdq, n_showers_grp, events = flag_large_events_integration(
+        cube, DQFLAGS['JUMP_DET'], DQFLAGS['SATURATED'], 1, 6, 2.0, True, 0.5, 2, 0, 200)
+    assert n_showers_grp == [0, 0, 0, 1, 0]
+    assert np.array_equal(gdq[0, :4], expected[0, :4])
+    assert gdq[0, 5, 16, 14] == DQFLAGS['SATURATED']  # saturation was extended
+
+
 def test_flag_large_events_nosnowball():
     cube = np.zeros(shape=(1, 5, 7, 7), dtype=np.uint8)
     # cross of saturation with no jump
@@ -194,6 +427,179 @@ def test_find_faint_extended():
     assert (np.all(gdq[0, 4, 12:22, 14:23]) == 0)
 
 
+@pytest.mark.parametrize('worker_type', ['thread', 'process'])
+def test_find_faint_extended_workers(worker_type):
+    nint, ngrps, ncols, nrows = 2, 6, 30, 30
+    data = np.zeros(shape=(nint, ngrps, nrows, ncols), dtype=np.float32)
+    gdq = np.zeros_like(data, dtype=np.uint8)
+    readnoise = np.ones(shape=(nrows, ncols), dtype=np.float32) * 6.0 * 4
+    rng = np.random.default_rng(12345)
+    data[:, 1:, 14:20, 15:20] = 6 * 4 * 1.7
+    data = data + rng.normal(size=(nint, ngrps, nrows, ncols)) * readnoise
+    kwargs = {'snr_threshold': 1.3, 'min_shower_area': 20, 'inner': 1, 'outer': 2,
+              'sat_flag': 2, 'jump_flag': 4, 'ellipse_expand': 1.1, 'num_grps_masked': 3}
+    serial_gdq, serial_num = find_faint_extended(data, gdq.copy(), readnoise, 1, **kwargs)
+    gdq, num_showers = find_faint_extended(data, gdq.copy(), readnoise, 1, n_workers=3,
+                                           worker_type=worker_type, **kwargs)
+    assert num_showers == serial_num > 0
+    assert np.array_equal(gdq, serial_gdq)
+
+
+@pytest.mark.parametrize('worker_type', ['thread', 'process'])
+def test_flag_large_events_workers(worker_type):
+    cube = np.zeros(shape=(3, 5, 7, 7), dtype=np.uint8)
+    # cross of saturation surrounded by jump -> snowball in integrations 0 and 2
+    for integration in [0, 2]:
+        cube[integration, 2, 3, 3] = DQFLAGS['SATURATED']
+        cube[integration, 2, 2, 3] = DQFLAGS['SATURATED']
+        cube[integration, 2, 3, 4] = DQFLAGS['SATURATED']
+        cube[integration, 2, 4, 3] = DQFLAGS['SATURATED']
+        cube[integration, 2, 3, 2] = DQFLAGS['SATURATED']
+        cube[integration, 2, 1, 1:6] = DQFLAGS['JUMP_DET']
+        cube[integration, 2, 5, 1:6] = DQFLAGS['JUMP_DET']
+        cube[integration, 2, 1:6, 1] = DQFLAGS['JUMP_DET']
+        cube[integration, 2, 1:6, 5] = DQFLAGS['JUMP_DET']
+    kwargs = {'min_sat_area': 1, 'min_jump_area': 6, 'expand_factor': 1.9, 'edge_size': 0,
+              'sat_required_snowball': True, 'min_sat_radius_extend': .5, 'sat_expand': 1.1}
+    serial_cube = cube.copy()
+    flag_large_events(serial_cube, DQFLAGS['JUMP_DET'], DQFLAGS['SATURATED'], **kwargs)
+    flag_large_events(cube, DQFLAGS['JUMP_DET'], DQFLAGS['SATURATED'], n_workers=2,
+                      worker_type=worker_type, **kwargs)
+    assert cube[2, 2, 1, 0] == DQFLAGS['JUMP_DET']  # Jump was extended
+    assert cube[2, 2, 2, 2] == DQFLAGS['SATURATED']  # Saturation was extended
+    assert np.array_equal(cube, serial_cube)
+
+
+def test_flag_events_snowballs():
+    cube = np.zeros(shape=(2, 5, 30, 30), dtype=np.uint8)
+    # a snowball in group 2 of integration 1, and a snowball at the edge
+    cube[1, 2, 8:19, 8:19] = DQFLAGS['JUMP_DET']
+    cube[1, 2:, 11:16, 11:16] = DQFLAGS['SATURATED']
+    cube[1, 3, 0:6, 20:30] = DQFLAGS['JUMP_DET']
+    kwargs = {'min_sat_area': 1, 'min_jump_area': 6, 'expand_factor': 2.0, 'edge_size': 3,
+              'sat_required_snowball': True, 'min_sat_radius_extend': .5, 'sat_expand': 2}
+    flagged = cube.copy()
+    events = flag_large_events(flagged, DQFLAGS['JUMP_DET'], DQFLAGS['SATURATED'], **kwargs)
+    assert events.dtype == EVENT_DTYPE
+    assert list(zip(events['integration'], events['group'], events['kind'])) == \
+        [(1, 2, 'saturation'), (1, 2, 'snowball'), (1, 3, 'snowball')]
+    # flagging the catalog again gives the same flags without the detection
+    reflagged = flag_events(cube.copy(), events, DQFLAGS['SATURATED'], DQFLAGS['JUMP_DET'],
+                            expand_factor=2.0, sat_expand=2, min_sat_radius_extend=.5)
+    assert np.array_equal(reflagged, flagged)
+    # and other expansion parameters can be tried
+    smaller = flag_events(cube.copy(), events, DQFLAGS['SATURATED'], DQFLAGS['JUMP_DET'],
+                          expand_factor=1.2, sat_expand=1, min_sat_radius_extend=.5)
+    assert np.count_nonzero(smaller) < np.count_nonzero(flagged)
+    assert np.all(smaller[cube != 0] != 0)
+
+
+def test_flag_events_showers():
+    nint, ngrps, ncols, nrows = 2, 6, 30, 30
+    data = np.zeros(shape=(nint, ngrps, nrows, ncols), dtype=np.float32)
+    gdq = np.zeros_like(data, dtype=np.uint8)
+    readnoise = np.ones(shape=(nrows, ncols), dtype=np.float32) * 6.0 * 4
+    rng = np.random.default_rng(12345)
+    data[1, 1:, 14:20, 15:20] = 6 * 4 * 1.7
+    data = data + rng.normal(size=(nint, ngrps, nrows, ncols)) * readnoise
+    events = find_shower_events(data, gdq, readnoise, 1, snr_threshold=1.3,
+                                min_shower_area=20)
+    assert len(events) > 0
+    assert 1 in events['integration']
+    assert np.all(events['kind'] == 'shower')
+    assert np.all(gdq == 0)
+    for ellipse_expand, num_grps_masked in [(1.1, 3), (1.5, 1)]:
+        expected, num_showers = find_faint_extended(data, gdq.copy(), readnoise, 1,
+                                                    snr_threshold=1.3, min_shower_area=20,
+                                                    ellipse_expand=ellipse_expand,
+                                                    num_grps_masked=num_grps_masked)
+        reflagged = flag_events(gdq.copy(), events, DQFLAGS['SATURATED'],
+                                DQFLAGS['JUMP_DET'], ellipse_expand=ellipse_expand,
+                                num_grps_masked=num_grps_masked)
+        assert num_showers == len(np.unique(events[['integration', 'group']]))
+        assert np.array_equal(reflagged, expected)
+
+
+def test_flag_events_unknown_kind():
+    events = np.array([(0, 1, (5.0, 5.0), (2.0, 2.0), 0.0, 'comet')], dtype=EVENT_DTYPE)
+    with pytest.raises(ValueError):
+        flag_events(np.zeros((1, 3, 10, 10), dtype=np.uint8), events, 2, 4)
+
+
+@pytest.mark.parametrize('inner, outer', [(1, 2), (2, 4), (3, 9)])
+@pytest.mark.parametrize('nan_fraction', [0.0, 0.05, 0.5])
+def test_nan_convolve(inner, outer, nan_fraction):
+    rng = np.random.default_rng(42)
+    image = rng.normal(size=(40, 45)) * 5
+    image[rng.random(image.shape) < nan_fraction] = np.nan
+    if nan_fraction > 0:
+        # a region of NaNs larger than the kernel
+        image[10:30, 10:30] = np.nan
+    kernel = ring_kernel(inner, outer)
+    expected = convolve(image, kernel)
+    result = nan_convolve(image, kernel.array)
+    assert ring_kernel(inner, outer) is kernel
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-10)
+
+
+def test_find_faint_extended_convolve_methods():
+    nint, ngrps, ncols, nrows = 1, 6, 30, 30
+    rng = np.random.default_rng(12345)
+    readnoise = np.ones(shape=(nrows, ncols), dtype=np.float32) * 6.0 * 4
+    data = np.zeros(shape=(nint, ngrps, nrows, ncols), dtype=np.float32)
+    data[:, 1:, 14:20, 15:20] = 6 * 4 * 1.7
+    data = data + rng.normal(size=(nint, ngrps, nrows, ncols)) * readnoise
+    gdq = np.zeros_like(data, dtype=np.uint8)
+    gdq[rng.random(gdq.shape) < 0.02] = DQFLAGS['JUMP_DET']
+    results = [find_faint_extended(data, gdq.copy(), readnoise, 1, snr_threshold=1.3,
+                                   min_shower_area=20, num_grps_masked=3,
+                                   convolve_method=method)
+               for method in ['filter2d', 'astropy']]
+    assert results[0][1] == results[1][1] > 0
+    assert np.array_equal(results[0][0], results[1][0])
+    with pytest.raises(ValueError):
+        find_faint_extended(data, gdq.copy(), readnoise, 1, convolve_method='fft')
+
+
+def test_detect_jumps_convolve_method(monkeypatch):
+    # the showers are convolved with astropy unless filter2d is selected
+    calls = []
+    monkeypatch.setattr(jump, 'nan_convolve',
+                        lambda *args: calls.append(args) or convolve(*args))
+    nints, ngroups, nrows, ncols = 1, 5, 20, 20
+    data = np.cumsum(np.ones((nints, ngroups, nrows, ncols), dtype=np.float32), axis=1)
+    readnoise = np.full((nrows, ncols), 4, dtype=np.float32)
+    gain = np.ones((nrows, ncols), dtype=np.float32)
+    for method, num_calls in [('astropy', 0), ('filter2d', ngroups - 1)]:
+        calls.clear()
+        detect_jumps(1, data, np.zeros(data.shape, dtype=np.uint8),
+                     np.zeros((nrows, ncols), dtype=np.uint32), np.zeros_like(data), gain,
+                     readnoise, 4, 5, 6, 'none', 200, 4, True, DQFLAGS, find_showers=True,
+                     extend_convolve_method=method)
+        assert len(calls) == num_calls
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 2**19])
+def test_nanmedian_by_rows(chunk_size):
+    rng = np.random.default_rng(1)
+    data = rng.normal(size=(6, 25, 13)).astype(np.float32)
+    data[rng.random(data.shape) < 0.3] = np.nan
+    expected = np.nanmedian(data, axis=0)
+    median = nanmedian_by_rows(data, chunk_size=chunk_size)
+    assert median.dtype == expected.dtype
+    assert np.array_equal(median, expected, equal_nan=True)
+
+
+def test_find_faint_extended_input_unchanged():
+    rng = np.random.default_rng(2)
+    data = np.cumsum(rng.normal(size=(2, 5, 20, 20)).astype(np.float32), axis=1)
+    gdq = np.zeros(data.shape, dtype=np.uint8)
+    gdq[0, 2, 3, 3] = DQFLAGS['JUMP_DET']
+    data_copy = data.copy()
+    find_faint_extended(data, gdq, np.ones((20, 20), dtype=np.float32), 1)
+    assert np.array_equal(data, data_copy)
+
+
 def test_inside_ellipse5():
     ellipse = ((0, 0), (1, 2), -10)
     point = (1, 0.6)
@@ -1,5 +1,7 @@
 import numpy as np
+import pytest
 
+from stcal.ramp_fitting import ols_fit
 from stcal.ramp_fitting.ramp_fit import ramp_fit_data
 from stcal.ramp_fitting.ramp_fit_class import RampData
 
@@ -1195,6 +1197,155 @@ def test_new_saturation():
     np.testing.assert_allclose(cerr, check, tol, tol)
 
 
+def flagged_ramp_data(ngroups, seed):
+    """
+    Noisy ramps with random jumps, saturation and do not use groups.
+    """
+    nints, nrows, ncols = 2, 20, 20
+    ramp_data, gain, rnoise = create_blank_ramp_data(
+        (nints, ngroups, nrows, ncols), (10., 2.), (10.736, 1, 0))
+    rng = np.random.default_rng(seed)
+    rate = rng.exponential(50., (nrows, ncols))
+    diffs = rate + rng.normal(scale=10., size=ramp_data.data.shape)
+    ramp_data.data[:] = np.cumsum(diffs, axis=1)
+
+    gdq = ramp_data.groupdq
+    gdq[rng.random(gdq.shape) < 0.1] = JUMP
+    gdq[rng.random(gdq.shape) < 0.02] |= DNU
+    sat_start = rng.integers(1, ngroups + 3, (nints, 1, nrows, ncols))
+    gdq[np.arange(ngroups)[np.newaxis, :, np.newaxis, np.newaxis] >= sat_start] |= SAT
+    gdq[0, :, 0, 0] = SAT
+    gdq[0, 1:, 0, 1] = SAT
+    gdq[0, 0, 0, 2] = JUMP
+
+    return ramp_data, gain, rnoise
+
+
+def assert_ramp_fit_equal(res1, res2, slope_atol=0., intercept_atol=0.):
+    """
+    Check that two sets of ramp_fit_data products are identical, except for
+    the slopes, intercepts and their sigmas, which agree within the given
+    tolerances.
+    """
+    # products of the slopes and of the intercepts in the image, integration
+    #   and optional results
+    atols = [{0: slope_atol}, {0: slope_atol},
+             {0: slope_atol, 1: slope_atol, 4: intercept_atol, 5: intercept_atol,
+              6: slope_atol}, {}]
+    for products1, products2, atol in zip(res1, res2, atols):
+        if products1 is None:
+            assert products2 is None
+            continue
+        for index, (arr1, arr2) in enumerate(zip(products1, products2)):
+            np.testing.assert_allclose(arr1, arr2, rtol=0, atol=atol.get(index, 0.))
+
+
+def float32_tolerances(ramp_data):
+    """
+    Tolerances of the slopes and intercepts of the OLS engines.
+
+    The iterative engine accumulates the weighted sums of the data in
+    float32, and the table engine and the fit of the clean ramps in float64.
+    The rounding of a float32 sum of ngroups groups is up to ngroups * eps
+    times the largest data value, which sets the scale of the differences
+    of the slopes and their sigmas. The intercepts are extrapolated to group
+    0 from segments starting up to ngroups groups later, which multiplies
+    it by ngroups. The factor of 4 covers the amplification of the rounding
+    in the fit of short segments. The variances don't depend on these sums
+    and are identical.
+    """
+    ngroups = ramp_data.data.shape[1]
+    slope_atol = 4 * ngroups * np.finfo(np.float32).eps * np.nanmax(np.abs(ramp_data.data))
+    return slope_atol, ngroups * slope_atol
+
+
+@pytest.mark.parametrize("ngroups", [3, 5, 10, 25, 300])
+def test_table_engine(ngroups):
+    """
+    The table engine reproduces the results of the iterative engine to
+    float32 precision, including ramps of more than 256 groups.
+    """
+    results = []
+    for ols_engine in ["iterative", "table"]:
+        ramp_data, gain, rnoise = flagged_ramp_data(ngroups, seed=ngroups)
+        tolerances = float32_tolerances(ramp_data)
+        results.append(ramp_fit_data(
+            ramp_data, 1024 * 30000, True, rnoise, gain, "OLS", "optimal", "none", dqflags,
+            ols_engine=ols_engine))
+
+    assert_ramp_fit_equal(*results, *tolerances)
+
+
+@pytest.mark.parametrize("ols_engine", ["iterative", "table"])
+def test_clean_ramps(ols_engine, monkeypatch):
+    """
+    The ramps without flagged groups are fit directly with the same results
+    as the segment logic, to float32 precision for the iterative engine.
+    """
+    results = []
+    for fit_clean in [True, False]:
+        ramp_data, gain, rnoise = flagged_ramp_data(10, seed=1)
+        ramp_data.groupdq[:, :, :10, :] = GOOD
+        tolerances = float32_tolerances(ramp_data) if ols_engine == "iterative" else (0., 0.)
+        if not fit_clean:
+            monkeypatch.setattr(ols_fit, "find_clean_ramps",
+                                lambda ramp_data: np.zeros((2, 20, 20), dtype=bool))
+        results.append(ramp_fit_data(
+            ramp_data, 1024 * 30000, True, rnoise, gain, "OLS", "optimal", "none", dqflags,
+            ols_engine=ols_engine))
+
+    assert_ramp_fit_equal(*results, *tolerances)
+
+
+@pytest.mark.parametrize("ngroups", [3, 10, 40])
+def test_optimal_weight_table(ngroups):
+    """
+    The tabulated optimal weights match the weights computed from the
+    number of nonzero groups and exponent of each pixel.
+    """
+    power_wt_r = np.array(ols_fit.WEIGHT_POWERS * (ngroups + 1), dtype=np.float32)
+    num_nz = np.repeat(np.arange(ngroups + 1), len(ols_fit.WEIGHT_POWERS))
+    nrd_prime = (num_nz - 1) / 2.
+    weight_index = ols_fit.opt_weight_index(ngroups, num_nz, power_wt_r)
+    weight_table = ols_fit.optimal_weight_table(ngroups, power_wt_r.dtype)
+
+    assert ols_fit.optimal_weight_table(ngroups, power_wt_r.dtype) is weight_table
+    assert not weight_table.flags.writeable
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for jj_rd in range(ngroups):
+            np.testing.assert_array_equal(
+                weight_table[jj_rd, weight_index],
+                abs((abs(jj_rd - nrd_prime) / nrd_prime) ** power_wt_r))
+
+
+def test_optimal_weight_table_limit(monkeypatch):
+    """
+    The weights are computed directly when there are too many groups to
+    tabulate them, with the same results, or when the exponents are not
+    tabulated.
+    """
+    results = []
+    for max_ngroups in [ols_fit.MAX_WEIGHT_TABLE_NGROUPS, 0]:
+        monkeypatch.setattr(ols_fit, "MAX_WEIGHT_TABLE_NGROUPS", max_ngroups)
+        ramp_data, gain, rnoise = flagged_ramp_data(10, seed=2)
+        results.append(ramp_fit_data(
+            ramp_data, 1024 * 30000, True, rnoise, gain, "OLS", "optimal", "none", dqflags))
+    assert ols_fit.opt_weight_index(10, np.zeros(1, dtype=int), np.zeros(1)) is None
+    # exponents that are not tabulated, as from interpolate_power
+    monkeypatch.undo()
+    power_wt_r = ols_fit.interpolate_power(np.array([0., 7., 30., 500.]))
+    assert ols_fit.opt_weight_index(10, np.zeros(4, dtype=int), power_wt_r) is None
+
+    assert_ramp_fit_equal(*results)
+
+
+def test_unknown_ols_engine():
+    ramp_data, gain, rnoise = flagged_ramp_data(5, seed=0)
+    with pytest.raises(ValueError):
+        ramp_fit_data(ramp_data, 1024 * 30000, False, rnoise, gain, "OLS", "optimal", "none",
+                      dqflags, ols_engine="prefix")
+
+
 def create_blank_ramp_data(dims, var, tm):
     """
     Create empty RampData classes, as well as gain and read noise arrays,
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from stcal.jump.streaming import StreamingJumpDetector
+from stcal.jump.twopoint_difference import find_crs
+
+
+DQFLAGS = {'JUMP_DET': 4, 'SATURATED': 2, 'DO_NOT_USE': 1}
+
+
+def stream(data, gdq, read_noise, flag_4_neighbors=False, window=8, **kwargs):
+    detector = StreamingJumpDetector(read_noise, 4.0, 5.0, 6.0, 1, flag_4_neighbors, 200, 10,
+                                     DQFLAGS, window=window)
+    pushed = [detector.push(data[0, group], gdq[0, group]) for group in range(data.shape[1])]
+    return detector, pushed, detector.finalize(gdq[0], **kwargs)
+
+
+def batch(data, gdq, read_noise, flag_4_neighbors=False):
+    return find_crs(data, gdq, read_noise, 4.0, 5.0, 6.0, 1, flag_4_neighbors, 200, 10,
+                    DQFLAGS)[0][0]
+
+
+def make_ramps(ngroups, nrows=20, ncols=20, seed=0):
+    rng = np.random.default_rng(seed)
+    diffs = 100 + rng.normal(size=(1, ngroups, nrows, ncols)) * 10
+    data = np.cumsum(diffs, axis=1).astype(np.float32)
+    gdq = np.zeros(data.shape, dtype=np.uint32)
+    read_noise = np.full((nrows, ncols), 10, dtype=np.float32)
+    return data, gdq, read_noise
+
+
+@pytest.mark.parametrize('flag_4_neighbors', [False, True])
+def test_streaming_single_jumps(flag_4_neighbors):
+    data, gdq, read_noise = make_ramps(12)
+    data[0, 6:, 5, 5] += 500
+    data[0, 9:, 12, 3] += 80
+    data[0, 3:, 15, 15] = np.nan
+    gdq[0, 3:, 15, 15] = DQFLAGS['SATURATED']
+    detector, pushed, gdq_out = stream(data, gdq, read_noise, flag_4_neighbors)
+    assert np.array_equal(gdq_out, batch(data, gdq, read_noise, flag_4_neighbors))
+    assert gdq_out[6, 5, 5] == DQFLAGS['JUMP_DET']
+    # the jumps are flagged as the groups are pushed
+    assert (6, 5, 5) in zip(*pushed[6])
+    assert (9, 12, 3) in zip(*pushed[9])
+
+
+def test_streaming_jump_in_first_groups():
+    data, gdq, read_noise = make_ramps(10)
+    data[0, 1:, 8, 8] += 1000
+    detector, pushed, gdq_out = stream(data, gdq, read_noise)
+    # the first differences are decided when there are four of them
+    assert all(len(pushed[group][0]) == 0 for group in range(4))
+    assert list(zip(*pushed[4])) == [(1, 8, 8)]
+    assert np.array_equal(gdq_out, batch(data, gdq, read_noise))
+
+
+@pytest.mark.parametrize('ngroups', [4, 10])
+def test_streaming_neighbors_of_pending_jumps(ngroups):
+    """
+    The neighbors of jumps decided after their group are checked against
+    the DQ flags of the group of the jump, not of the last group pushed.
+    """
+    data, gdq, read_noise = make_ramps(ngroups)
+    data[0, 1:, 8, 8] += 1000
+    # unusable only in the group of the jump
+    gdq[0, 1, 7, 8] = DQFLAGS['DO_NOT_USE']
+    # unusable only from the group in which the jump is decided
+    gdq[0, 3:, 9, 8] = DQFLAGS['SATURATED']
+    detector, pushed, gdq_out = stream(data, gdq, read_noise, flag_4_neighbors=True)
+    assert gdq_out[1, 8, 8] == DQFLAGS['JUMP_DET']
+    assert gdq_out[1, 7, 8] == DQFLAGS['DO_NOT_USE']
+    assert gdq_out[1, 9, 8] == DQFLAGS['JUMP_DET']
+    assert gdq_out[1, 8, 7] == DQFLAGS['JUMP_DET']
+    assert np.array_equal(gdq_out, batch(data, gdq, read_noise, flag_4_neighbors=True))
+
+
+@pytest.mark.parametrize('ngroups', [3, 4])
+def test_streaming_short_ramps(ngroups):
+    data, gdq, read_noise = make_ramps(ngroups)
+    data[0, 2:, 4, 4] += 1000
+    detector, pushed, gdq_out = stream(data, gdq, read_noise)
+    # the short ramps are decided when the detection is finalized
+    assert all(len(jumps[0]) == 0 for jumps in pushed)
+    assert gdq_out[2, 4, 4] == DQFLAGS['JUMP_DET']
+    assert np.array_equal(gdq_out, batch(data, gdq, read_noise))
+
+
+def test_streaming_reconciliation():
+    rng = np.random.default_rng(1)
+    data, gdq, read_noise = make_ramps(30, 64, 64)
+    jumps = rng.random(data.shape) < 0.01
+    data += np.cumsum(jumps * rng.uniform(50, 2000, data.shape), axis=1).astype(np.float32)
+    batch_gdq = batch(data, gdq, read_noise)
+    detector, pushed, gdq_out = stream(data, gdq, read_noise, window=6, batch_gdq=batch_gdq)
+    num_jumps = np.count_nonzero(batch_gdq)
+    assert detector.reconciliation['matched'] + detector.reconciliation['batch_only'] == num_jumps
+    assert detector.reconciliation['streaming_only'] + detector.reconciliation['matched'] == \
+        np.count_nonzero(gdq_out)
+    assert detector.reconciliation['matched'] > 0.95 * num_jumps
+    # the memory used is a few frames
+    assert detector.window.shape == (6, 64, 64)
+
+
+def test_streaming_window():
+    with pytest.raises(ValueError):
+        StreamingJumpDetector(np.ones((2, 2)), 4.0, 5.0, 6.0, 1, False, 200, 10, DQFLAGS,
+                              window=3)
@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
 
-from stcal.jump.twopoint_difference import find_crs, calc_med_first_diffs
+from stcal.jump.twopoint_difference import find_crs, calc_med_first_diffs, \
+    calc_med_first_diffs_pixels, clip_crs, flag_neighbors, clipped_median, cr_candidates, \
+    find_crs_sweep, clip_crs_history, accepted_crs
 
 
 DQFLAGS = {'JUMP_DET': 4, 'SATURATED': 2, 'DO_NOT_USE': 1}
@@ -1018,3 +1020,256 @@ def test_median_func():
     arr = np.zeros(4 * 2 * 2).reshape(4, 2, 2)
     arr[:, 0, 0] = np.array([-1., -2., np.nan, np.nan])
     assert calc_med_first_diffs(arr)[0, 0] == -1
+
+
+def test_median_pixels_func():
+    """
+      Test that `calc_med_first_diffs_pixels` gives the same median as
+      `calc_med_first_diffs` applied to each pixel separately."""
+
+    arr = np.array([[1., 1., 1., 1., -2., 5.],
+                    [2., 2., 2., np.nan, 2., np.nan],
+                    [3., 3., np.nan, np.nan, np.nan, np.nan],
+                    [4., np.nan, np.nan, np.nan, np.nan, np.nan],
+                    [5., 5., 5., np.nan, np.nan, np.nan],
+                    [-9., 6., np.nan, np.nan, np.nan, np.nan]])
+    medians = calc_med_first_diffs_pixels(arr)
+    for pix in range(arr.shape[1]):
+        expected = calc_med_first_diffs(arr[:, pix].copy())
+        if np.isnan(expected):
+            assert np.isnan(medians[pix])
+        else:
+            assert medians[pix] == expected
+
+
+def test_clip_crs():
+    """
+      Test that `clip_crs` keeps clipping a pixel until no more CRs are
+      found, and stops at the first group for a pixel with a single CR."""
+
+    first_diffs = np.array([[10., 10.],
+                            [1000., 11.],
+                            [12., 500.],
+                            [9., 10.],
+                            [400., 12.],
+                            [11., 9.]])
+    read_noise_2 = np.array([1., 1.])
+    median = np.median(first_diffs, axis=0)
+    ratio = np.abs(first_diffs - median) / np.sqrt(median + read_noise_2)
+    cr_mask = clip_crs(first_diffs, ratio, read_noise_2, 1, 4, 5, 6)
+    assert np.array_equal(np.where(cr_mask[:, 0])[0], [1, 4])
+    assert np.array_equal(np.where(cr_mask[:, 1])[0], [2])
+
+
+def test_flag_neighbors_edges():
+    """
+      Test that `flag_neighbors` skips saturated neighbors and returns the
+      neighbors of jumps in the first and last rows."""
+
+    gdq = np.zeros((3, 4, 5), dtype=np.uint32)
+    ratio = np.full((2, 4, 5), 50.)
+    gdq[1, 0, 2] = DQFLAGS['JUMP_DET']
+    gdq[1, 0, 3] = DQFLAGS['SATURATED']
+    gdq[2, 3, 0] = DQFLAGS['JUMP_DET']
+    gdq[2, 2, 2] = DQFLAGS['JUMP_DET']
+    ratio[1, 2, 2] = 300.  # above the maximum, neighbors not flagged
+    row_below, row_above = flag_neighbors(gdq, ratio, 200, 10, DQFLAGS['SATURATED'],
+                                          DQFLAGS['DO_NOT_USE'], DQFLAGS['JUMP_DET'])
+
+    assert gdq[1, 1, 2] == DQFLAGS['JUMP_DET']
+    assert gdq[1, 0, 1] == DQFLAGS['JUMP_DET']
+    assert gdq[1, 0, 3] == DQFLAGS['SATURATED']
+    assert gdq[2, 2, 0] == DQFLAGS['JUMP_DET']
+    assert gdq[2, 3, 1] == DQFLAGS['JUMP_DET']
+    assert gdq[2, 2, 1] == 0
+    assert gdq[2, 1, 2] == 0
+    assert np.array_equal(np.where(row_below), ([1], [2]))
+    assert np.array_equal(np.where(row_above), ([2], [0]))
+
+
+def test_after_jump_flag_methods_agree(setup_cube):
+    """
+      Test that the mask and loop implementations of after-jump flagging
+      give the same flags, including saturated groups and windows that run
+      past the end of the ramp."""
+
+    ngroups = 8
+    data, gdq, nframes, read_noise, rej_threshold = setup_cube(ngroups, readnoise=10)
+    rng = np.random.default_rng(42)
+    data[0] = np.cumsum(rng.normal(size=data.shape[1:]) * 10, axis=0)
+    data[0] += np.cumsum((rng.random(data.shape[1:]) < 0.05) *
+                         rng.uniform(50, 2000, data.shape[1:]), axis=0)
+    gdq[0, 6:, 0:20, :] = DQFLAGS['SATURATED']
+    after_jump_flag_e1 = np.full(data.shape[2:4], 500.)
+    after_jump_flag_e2 = np.full(data.shape[2:4], 100.)
+
+    results = [find_crs(data, gdq, read_noise, rej_threshold, rej_threshold,
+                        rej_threshold, nframes, False, 200, 10, DQFLAGS,
+                        after_jump_flag_e1=after_jump_flag_e1,
+                        after_jump_flag_n1=10,
+                        after_jump_flag_e2=after_jump_flag_e2,
+                        after_jump_flag_n2=2,
+                        after_jump_flag_method=method)[0]
+               for method in ['mask', 'loop']]
+    assert np.array_equal(results[0], results[1])
+
+
+@pytest.mark.parametrize('ndiffs', [2, 3, 4, 5, 8])
+def test_clipped_median(ndiffs):
+    """
+      Test that the `clipped_median` kernel, processed in small blocks of
+      rows, gives the same median as `calc_med_first_diffs` for each pixel,
+      including pixels with unusable groups and largest values of equal
+      magnitude and opposite sign."""
+
+    rng = np.random.default_rng(1)
+    arr = np.round(rng.normal(size=(ndiffs, 6, 7)) * 3)
+    arr[:, 0, 0] = 5.
+    arr[0, 0, 0] = -5.
+    arr[:, 0, 1] = -5.
+    arr[1, 0, 1] = 5.
+    arr[rng.random(arr.shape) < 0.2] = np.nan
+
+    out = np.zeros((6, 7))
+    clipped_median(arr, out, chunk_size=2 * ndiffs * 7)
+    for row in range(6):
+        for col in range(7):
+            expected = calc_med_first_diffs(arr[:, row:row + 1, col:col + 1].copy())[0, 0]
+            if np.isnan(expected):
+                assert np.isnan(out[row, col])
+            else:
+                assert out[row, col] == expected
+
+
+def test_float32_precision(setup_cube):
+    """
+      Test that the single precision mode finds the same jumps as double
+      precision, for jumps well above the thresholds, and rejects unknown
+      precisions."""
+
+    ngroups = 10
+    data, gdq, nframes, read_noise, rej_threshold = setup_cube(ngroups, readnoise=10)
+    rng = np.random.default_rng(7)
+    data[0] = np.cumsum(rng.normal(size=data.shape[1:]) * 10 + 50, axis=0)
+    data[0, 4:, 100, 100] += 1000.
+    data[0, 7:, 50, 60] += 500.
+    gdq[0, 8:, 10:20, :] = DQFLAGS['SATURATED']
+    after_jump_flag_e1 = np.full(data.shape[2:4], 300.)
+
+    results = [find_crs(data, gdq, read_noise, rej_threshold, rej_threshold,
+                        rej_threshold, nframes, True, 200, 10, DQFLAGS,
+                        after_jump_flag_e1=after_jump_flag_e1,
+                        after_jump_flag_n1=2, precision=precision)[0]
+               for precision in ['float64', 'float32']]
+    assert np.array_equal(results[0], results[1])
+    assert np.all(results[1][0, 4:7, 100, 100] == DQFLAGS['JUMP_DET'])
+    assert results[1][0, 7, 50, 60] == DQFLAGS['JUMP_DET']
+
+    with pytest.raises(ValueError):
+        find_crs(data, gdq, read_noise, rej_threshold, rej_threshold, rej_threshold,
+                 nframes, True, 200, 10, DQFLAGS, precision='float16')
+
+
+@pytest.mark.parametrize('ngroups, precision', [(4, 'float64'), (10, 'float64'),
+                                                (10, 'float32'), (40, 'float64')])
+def test_prefilter(setup_cube, ngroups, precision):
+    """
+      Test that pruning the pixels that can't have a jump gives the same flags,
+      including the neighbors of jumps and of jumps flagged in the input, and
+      the groups after them."""
+
+    data, gdq, nframes, read_noise, rej_threshold = setup_cube(ngroups, readnoise=10)
+    rng = np.random.default_rng(8)
+    data[0] = np.cumsum(rng.normal(size=data.shape[1:]) * 10 +
+                        rng.exponential(100, size=data.shape[2:]), axis=0)
+    data[0, 2:] += (rng.random(data.shape[2:]) < 0.01) * 800.
+    gdq[rng.random(gdq.shape) < 0.01] = DQFLAGS['SATURATED']
+    gdq[rng.random(gdq.shape) < 0.002] = DQFLAGS['JUMP_DET']
+    after_jump_flag_e1 = np.full(data.shape[2:4], 50.)
+
+    results = [find_crs(data, gdq, read_noise, rej_threshold, rej_threshold,
+                        rej_threshold, nframes, True, 200, 4, DQFLAGS,
+                        after_jump_flag_e1=after_jump_flag_e1,
+                        after_jump_flag_n1=2, precision=precision, prefilter=prefilter)
+               for prefilter in [False, True]]
+    assert np.any(results[1][0] & DQFLAGS['JUMP_DET'] != gdq[0] & DQFLAGS['JUMP_DET'])
+    for result, result_prefilter in zip(*results):
+        assert np.array_equal(result, result_prefilter)
+
+
+def test_cr_candidates():
+    """
+      Test that only pixels whose range of differences can exceed the
+      threshold times the smallest sigma are candidates, ignoring NaNs."""
+
+    first_diffs = np.array([[[0., 100., 0., 50.]],
+                            [[3., 110., np.nan, np.nan]],
+                            [[-3., 121., 20., np.nan]]])
+    read_noise_frame = np.full((1, 4), 1.)
+    # ranges of 6, 21, 20 and 0 against a smallest sigma of 1, 10, 1 and 1
+    assert np.array_equal(cr_candidates(first_diffs, read_noise_frame, 3.),
+                          [[True, False, True, False]])
+    assert np.array_equal(cr_candidates(first_diffs, read_noise_frame, 7.),
+                          [[False, False, True, False]])
+
+
+def test_find_crs_sweep(setup_cube):
+    """
+      Test that a sweep of the thresholds gives the flags of find_crs for each
+      setting, and the numbers of CRs found by the two-point method."""
+
+    ngroups = 8
+    data, gdq, nframes, read_noise, rej_threshold = setup_cube(ngroups, readnoise=10)
+    rng = np.random.default_rng(9)
+    data[0] = np.cumsum(rng.normal(size=data.shape[1:]) * 10 + 30, axis=0)
+    data[0, 3:] += (rng.random(data.shape[2:]) < 0.02) * rng.uniform(20, 500, data.shape[2:])
+    data[0, 6:, 100, 100] += 300.
+    gdq[0, 5:, 50:60, 50:60] = DQFLAGS['SATURATED']
+    gdq_in = gdq.copy()
+    after_jump_flag_e1 = np.full(data.shape[2:4], 100.)
+    settings = [{'rejection_thresh': thresh, 'two_diff_rej_thresh': thresh + 1,
+                 'three_diff_rej_thresh': thresh + 2, 'max_jump_to_flag_neighbors': 200,
+                 'min_jump_to_flag_neighbors': min_neighbors}
+                for thresh, min_neighbors in [(3, 4), (5, 10), (8, 4)]]
+
+    gdqs, cr_counts = find_crs_sweep(data, gdq, read_noise, settings, nframes, True, DQFLAGS,
+                                     after_jump_flag_e1=after_jump_flag_e1,
+                                     after_jump_flag_n1=1)
+    assert np.array_equal(gdq, gdq_in)
+    for setting, gdq_setting, cr_count in zip(settings, gdqs, cr_counts):
+        expected = find_crs(data, gdq, read_noise, nframes=nframes, flag_4_neighbors=True,
+                            dqflags=DQFLAGS, after_jump_flag_e1=after_jump_flag_e1,
+                            after_jump_flag_n1=1, **setting)[0]
+        assert np.array_equal(gdq_setting, expected)
+
+        crs_only = find_crs(data, gdq, read_noise, nframes=nframes, flag_4_neighbors=False,
+                            dqflags=DQFLAGS, **setting)[0]
+        assert cr_count == np.count_nonzero(crs_only & DQFLAGS['JUMP_DET'])
+
+    # fewer CRs for higher thresholds, and the counts without the flags
+    assert cr_counts[0] > cr_counts[1] > cr_counts[2] > 0
+    gdqs, counts_only = find_crs_sweep(data, gdq, read_noise, settings, nframes, True, DQFLAGS,
+                                       return_flags=False)
+    assert gdqs is None
+    assert np.array_equal(counts_only, cr_counts)
+
+
+def test_clip_crs_history():
+    """
+      Test that the CRs accepted from the history of the passes for low
+      thresholds are the CRs clipped for higher thresholds."""
+
+    rng = np.random.default_rng(10)
+    first_diffs = rng.normal(size=(12, 500)) * 10
+    first_diffs[rng.random(first_diffs.shape) < 0.2] += 100
+    first_diffs[rng.random(first_diffs.shape) < 0.1] = np.nan
+    read_noise_2 = np.full(500, 100.)
+    ratio = np.abs(first_diffs - np.nanmedian(first_diffs, axis=0)) / 10
+
+    history = clip_crs_history(first_diffs, ratio, read_noise_2, 1, 2., 2., 2.)
+    for thresholds in [(2., 2., 2.), (3., 4., 5.), (6., 3., 3.)]:
+        expected = clip_crs(first_diffs, ratio, read_noise_2, 1, *thresholds)
+        # clip_crs flags the initial CR of all the pixels it is given
+        accepted = accepted_crs(*history, *thresholds)
+        has_initial = np.any(accepted, axis=0)
+        assert np.array_equal(accepted[:, has_initial], expected[:, has_initial])